@@ -0,0 +1,129 @@
+"""
+benchmarks/cold_start.py
+
+Measures the cold start cost of each Lambda handler module: the time taken to import and initialise
+the module in a fresh Python interpreter, and the number of modules it loads. Each measurement is
+repeated in a new interpreter and the median is reported.
+
+The time depends on the machine, so it is not compared with a fixed number of milliseconds. Each run
+first measures a baseline in the same way: importing boto3 and creating one client, which every handler
+does. The time of each handler is then budgeted as a multiple of that baseline.
+
+The script fails (exits with status 1) if a handler exceeds its budget, or if a module that should
+be imported lazily (e.g. google-auth) is loaded during initialisation.
+
+Usage (from the repository root, with boto3 installed):
+
+	python benchmarks/cold_start.py [--runs N]
+"""
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Budgets for the initialisation of each handler module. Most of the cost is importing boto3 and
+# creating its clients, which the baseline also does, so each handler initialises in about 0.9-1.25 times
+# the baseline. The time budgets (as a multiple of the baseline) leave headroom for noise between runs, while
+# the module counts are deterministic and catch new heavy imports.
+HANDLER_BUDGETS = {
+	'lifecheck-verification': {'init_ratio': 1.4, 'modules': 360},
+	'lifecheck-verification-email': {'init_ratio': 1.4, 'modules': 360},
+	'lifecheck-notification': {'init_ratio': 1.4, 'modules': 360},
+	'lifecheck-authorizer': {'init_ratio': 1.4, 'modules': 360},
+	'lifecheck-settings-view': {'init_ratio': 1.4, 'modules': 360},
+	'lifecheck-settings-update': {'init_ratio': 1.4, 'modules': 360},
+	'lifecheck-outbox': {'init_ratio': 1.4, 'modules': 360}
+}
+
+# The baseline that the time budgets are relative to, run in place of a handler module
+BASELINE_CODE = "import boto3\nboto3.client('ssm')\n"
+
+
+# Modules that must not be loaded when a handler module is initialised
+LAZY_MODULES = [
+	'google.auth',
+	'google.oauth2'
+]
+
+# Code run in a fresh interpreter to import a handler module (or run the baseline code if no path is given)
+# and report its cost
+MEASURE_SNIPPET = """
+import sys, time, json, importlib.util
+path, lazy_modules, baseline_code = sys.argv[1], sys.argv[2].split(','), sys.argv[3]
+baseline = len(sys.modules)
+start = time.perf_counter()
+if path:
+	spec = importlib.util.spec_from_file_location('handler', path)
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+else:
+	exec(baseline_code)
+init_ms = (time.perf_counter() - start) * 1000
+print(json.dumps({
+	'init_ms': init_ms,
+	'modules': len(sys.modules) - baseline,
+	'lazy_loaded': [name for name in lazy_modules if name in sys.modules]
+}))
+"""
+
+# Function to import a handler module (or run the baseline if handler is None) in a new interpreter and return its
+# measurements
+def measure(handler):
+	env = dict(os.environ)
+	# The handlers create boto3 clients when they are loaded, which requires a region but no credentials
+	env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+	env.setdefault('REGION', env['AWS_DEFAULT_REGION'])
+	env['PYTHONPATH'] = REPOSITORY_ROOT
+	env['PYTHONDONTWRITEBYTECODE'] = '1'
+
+	result = subprocess.run(
+		[
+			sys.executable, '-c', MEASURE_SNIPPET,
+			os.path.join(REPOSITORY_ROOT, f"{handler}.py") if handler else '',
+			','.join(LAZY_MODULES),
+			BASELINE_CODE
+		],
+		cwd=REPOSITORY_ROOT,
+		env=env,
+		capture_output=True,
+		text=True,
+		check=True
+	)
+	return json.loads(result.stdout)
+
+def main():
+	parser = argparse.ArgumentParser(description="Measure the cold start cost of each Lambda handler")
+	parser.add_argument('--runs', type=int, default=5, help="number of fresh interpreters to measure each handler in")
+	args = parser.parse_args()
+
+	baseline_ms = statistics.median(measure(None)['init_ms'] for _ in range(args.runs))
+	print(f"Baseline (import boto3 and create one client): {baseline_ms:.1f} ms")
+
+	failures = []
+	print(f"{'handler':<32}{'init ms':>10}{'budget':>10}{'modules':>10}{'budget':>10}")
+	for handler, budget in HANDLER_BUDGETS.items():
+		runs = [measure(handler) for _ in range(args.runs)]
+		init_ms = statistics.median(run['init_ms'] for run in runs)
+		init_budget_ms = baseline_ms * budget['init_ratio']
+		modules = max(run['modules'] for run in runs)
+		lazy_loaded = sorted({name for run in runs for name in run['lazy_loaded']})
+		print(f"{handler:<32}{init_ms:>10.1f}{init_budget_ms:>10.1f}{modules:>10}{budget['modules']:>10}")
+
+		if init_ms > init_budget_ms:
+			failures.append(f"{handler}: initialisation took {init_ms:.1f} ms (budget {init_budget_ms:.1f} ms, {budget['init_ratio']:g} times the baseline)")
+		if modules > budget['modules']:
+			failures.append(f"{handler}: loaded {modules} modules (budget {budget['modules']})")
+		if lazy_loaded:
+			failures.append(f"{handler}: loaded {', '.join(lazy_loaded)} during initialisation")
+
+	for failure in failures:
+		print(f"FAILED {failure}")
+	return 1 if failures else 0
+
+if __name__ == '__main__':
+	sys.exit(main())
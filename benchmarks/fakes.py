@@ -0,0 +1,596 @@
+"""
+benchmarks/fakes.py
+
+In-memory stand-ins for the AWS services (SSM Parameter Store, SES, SES v2, EventBridge
+Scheduler, SQS and SNS) and the Google OAuth endpoints used by the Lambda functions, so that the handlers can be
+run locally without credentials or network access.
+
+Every call to a stand-in is recorded in a shared CallLog as <service>.<Operation> (the same names
+used by lifecheck/metrics.py, e.g. ssm.GetParameters), and can be delayed by an injected latency to
+approximate the round trip to the real service. Failures can be injected for an operation with
+fail(), e.g. to exercise retries.
+
+FakeCloud.patch() replaces boto3.client and urllib.request.urlopen with the stand-ins while the
+handler modules are loaded and invoked:
+
+	cloud = FakeCloud(Latency(default_ms=20))
+	with cloud.patch():
+		handler = load_handler('lifecheck-verification')
+		handler.lambda_handler({}, None)
+	print(cloud.log.counts())
+"""
+
+import io
+import json
+import time
+import uuid
+import random
+import datetime
+import threading
+import contextlib
+import collections
+import urllib.parse
+from unittest import mock
+
+GOOGLE_PUBLIC_KEYS_URL = "https://www.googleapis.com/oauth2/v1/certs"
+GOOGLE_TOKEN_ENDPOINT = "https://oauth2.googleapis.com/token"
+GOOGLE_KEYS_MAX_AGE_SECONDS = 21600
+
+# Service limits that the handlers are expected to respect
+GET_PARAMETERS_MAX_NAMES = 10
+DELETE_PARAMETERS_MAX_NAMES = 10
+GET_PARAMETERS_BY_PATH_PAGE_SIZE = 10
+GET_VERIFICATION_ATTRIBUTES_MAX_IDENTITIES = 100
+SEND_BULK_TEMPLATED_EMAIL_MAX_DESTINATIONS = 50
+
+class FakeServiceError(Exception):
+	pass
+
+class Latency:
+
+	def __init__(self, default_ms=0.0, jitter_ms=0.0, services=None, seed=None):
+		self.default_ms = default_ms
+		self.jitter_ms = jitter_ms
+		# service name -> latency in milliseconds, overriding the default
+		self.services = dict(services or {})
+		self.random = random.Random(seed)
+		self.lock = threading.Lock()
+
+	# Function to return the delay in seconds of a call to a service
+	def delay(self, service):
+		latency_ms = self.services.get(service, self.default_ms)
+		if self.jitter_ms:
+			with self.lock:
+				latency_ms += self.random.uniform(0, self.jitter_ms)
+		return latency_ms / 1000
+
+	def wait(self, service):
+		delay = self.delay(service)
+		if delay > 0:
+			time.sleep(delay)
+
+class CallLog:
+
+	def __init__(self):
+		self.calls = []
+		self.lock = threading.Lock()
+
+	def record(self, service, operation):
+		with self.lock:
+			self.calls.append(f"{service}.{operation}")
+
+	# Function to return a position in the log, so that the calls made after it can be counted
+	def mark(self):
+		with self.lock:
+			return len(self.calls)
+
+	# Function to count the calls by operation (only those made after the mark, if provided)
+	def counts(self, mark=0):
+		with self.lock:
+			return collections.Counter(self.calls[mark:])
+
+	def clear(self):
+		with self.lock:
+			self.calls.clear()
+
+# The handlers register botocore event handlers on their clients (see lifecheck/metrics.py), which the
+# stand-ins accept and ignore
+class FakeEvents:
+
+	def register(self, event_name, handler, *args, **kwargs):
+		pass
+
+class FakeClientMeta:
+
+	def __init__(self, service_name):
+		self.service_name = service_name
+		self.events = FakeEvents()
+
+class FakeService:
+
+	service_name = None
+
+	def __init__(self, log, latency):
+		self.log = log
+		self.latency = latency
+		self.meta = FakeClientMeta(self.service_name)
+		self.lock = threading.RLock()
+		# operation -> [remaining failures, exception]
+		self.failures = {}
+
+	# Function to make the next calls of an operation raise an error (times=None fails every call)
+	def fail(self, operation, times=1, error=None):
+		with self.lock:
+			self.failures[operation] = [times, error or FakeServiceError(f"Injected failure of {self.service_name}.{operation}")]
+
+	# Function to record a call, wait for the injected latency and raise any injected failure
+	def call(self, operation):
+		self.log.record(self.service_name, operation)
+		self.latency.wait(self.service_name)
+		with self.lock:
+			failure = self.failures.get(operation)
+			if failure is None:
+				return
+			if failure[0] is not None:
+				failure[0] -= 1
+				if failure[0] <= 0:
+					del self.failures[operation]
+		raise failure[1]
+
+class FakeSSMExceptions:
+
+	class ParameterNotFound(Exception):
+		pass
+
+	class ParameterVersionNotFound(Exception):
+		pass
+
+	class ParameterAlreadyExists(Exception):
+		pass
+
+	class ValidationException(Exception):
+		pass
+
+class FakeSSMPaginator:
+
+	def __init__(self, ssm):
+		self.ssm = ssm
+
+	def paginate(self, Path, Recursive=False, WithDecryption=False, **kwargs):
+		prefix = Path.rstrip('/') + '/'
+		with self.ssm.lock:
+			names = sorted(name for name in self.ssm.parameters if name.startswith(prefix) and (Recursive or '/' not in name[len(prefix):]))
+		# A page is always returned, even if it is empty
+		for start in range(0, max(len(names), 1), GET_PARAMETERS_BY_PATH_PAGE_SIZE):
+			self.ssm.call('GetParametersByPath')
+			with self.ssm.lock:
+				page = [self.ssm.parameter(name) for name in names[start:start + GET_PARAMETERS_BY_PATH_PAGE_SIZE] if name in self.ssm.parameters]
+			yield {'Parameters': page}
+
+class FakeSSM(FakeService):
+
+	service_name = 'ssm'
+	exceptions = FakeSSMExceptions
+
+	def __init__(self, log, latency):
+		super().__init__(log, latency)
+		# name -> (value, version)
+		self.parameters = {}
+		# (name, version) -> value
+		self.history = {}
+
+	# Function to set parameter values without recording any calls
+	def seed(self, values):
+		with self.lock:
+			for name, value in values.items():
+				self._put(name, value)
+
+	# Function to return the current parameter values without recording any calls
+	def values(self):
+		with self.lock:
+			return {name: value for name, (value, version) in self.parameters.items()}
+
+	def clear(self):
+		with self.lock:
+			self.parameters.clear()
+			self.history.clear()
+
+	def _put(self, name, value):
+		version = self.parameters.get(name, (None, 0))[1] + 1
+		self.parameters[name] = (value, version)
+		self.history[(name, version)] = value
+		return version
+
+	def parameter(self, name):
+		value, version = self.parameters[name]
+		return {'Name': name, 'Type': 'String', 'Value': value, 'Version': version}
+
+	def get_parameter(self, Name, WithDecryption=False):
+		self.call('GetParameter')
+		name, _, version = Name.partition(':')
+		with self.lock:
+			if name not in self.parameters:
+				raise self.exceptions.ParameterNotFound(f"Parameter {name} not found")
+			if not version:
+				return {'Parameter': self.parameter(name)}
+			if (name, int(version)) not in self.history:
+				raise self.exceptions.ParameterVersionNotFound(f"Version {version} of parameter {name} not found")
+			return {'Parameter': {'Name': name, 'Type': 'String', 'Value': self.history[(name, int(version))], 'Version': int(version)}}
+
+	def get_parameters(self, Names, WithDecryption=False):
+		self.call('GetParameters')
+		if len(Names) > GET_PARAMETERS_MAX_NAMES:
+			raise self.exceptions.ValidationException(f"GetParameters accepts at most {GET_PARAMETERS_MAX_NAMES} names")
+		with self.lock:
+			return {
+				'Parameters': [self.parameter(name) for name in Names if name in self.parameters],
+				'InvalidParameters': [name for name in Names if name not in self.parameters]
+			}
+
+	def get_paginator(self, operation_name):
+		if operation_name != 'get_parameters_by_path':
+			raise ValueError(f"No paginator for '{operation_name}'")
+		return FakeSSMPaginator(self)
+
+	def put_parameter(self, Name, Value, Type='String', Overwrite=False, Tier=None, **kwargs):
+		self.call('PutParameter')
+		with self.lock:
+			if Name in self.parameters and not Overwrite:
+				raise self.exceptions.ParameterAlreadyExists(f"Parameter {Name} already exists")
+			return {'Version': self._put(Name, Value), 'Tier': Tier or 'Standard'}
+
+	def delete_parameter(self, Name):
+		self.call('DeleteParameter')
+		with self.lock:
+			if Name not in self.parameters:
+				raise self.exceptions.ParameterNotFound(f"Parameter {Name} not found")
+			del self.parameters[Name]
+		return {}
+
+	def delete_parameters(self, Names):
+		self.call('DeleteParameters')
+		if len(Names) > DELETE_PARAMETERS_MAX_NAMES:
+			raise self.exceptions.ValidationException(f"DeleteParameters accepts at most {DELETE_PARAMETERS_MAX_NAMES} names")
+		with self.lock:
+			deleted = [name for name in Names if self.parameters.pop(name, None) is not None]
+		return {'DeletedParameters': deleted, 'InvalidParameters': [name for name in Names if name not in deleted]}
+
+class FakeSESExceptions:
+
+	class MessageRejected(Exception):
+		pass
+
+	class TemplateDoesNotExistException(Exception):
+		pass
+
+	class AlreadyExistsException(Exception):
+		pass
+
+class FakeSES(FakeService):
+
+	service_name = 'ses'
+	exceptions = FakeSESExceptions
+
+	def __init__(self, log, latency, verified=None):
+		super().__init__(log, latency)
+		# The verified identities may be shared with the SES v2 stand-in
+		self.verified = verified if verified is not None else set()
+		self.pending = set()
+		self.templates = {}
+		# The emails sent, as (recipient, subject, body) tuples
+		self.sent = []
+
+	def verify(self, *identities):
+		with self.lock:
+			self.verified.update(identities)
+
+	def get_identity_verification_attributes(self, Identities):
+		self.call('GetIdentityVerificationAttributes')
+		if len(Identities) > GET_VERIFICATION_ATTRIBUTES_MAX_IDENTITIES:
+			raise ValueError(f"GetIdentityVerificationAttributes accepts at most {GET_VERIFICATION_ATTRIBUTES_MAX_IDENTITIES} identities")
+		with self.lock:
+			return {'VerificationAttributes': {
+				identity: {'VerificationStatus': 'Success' if identity in self.verified else 'Pending'}
+				for identity in Identities
+				if identity in self.verified or identity in self.pending
+			}}
+
+	# In the SES sandbox, the sender and every recipient must be verified
+	def _check_verified(self, source, recipient):
+		for identity in (source, recipient):
+			if identity not in self.verified:
+				raise self.exceptions.MessageRejected(f"Email address is not verified: {identity}")
+
+	def send_email(self, Source, Destination, Message, **kwargs):
+		self.call('SendEmail')
+		recipient = Destination['ToAddresses'][0]
+		with self.lock:
+			self._check_verified(Source, recipient)
+			self.sent.append((recipient, Message['Subject']['Data'], Message['Body']['Text']['Data']))
+		return {'MessageId': str(uuid.uuid4())}
+
+	def get_template(self, TemplateName):
+		self.call('GetTemplate')
+		with self.lock:
+			if TemplateName not in self.templates:
+				raise self.exceptions.TemplateDoesNotExistException(f"Template {TemplateName} does not exist")
+			return {'Template': dict(self.templates[TemplateName])}
+
+	def create_template(self, Template):
+		self.call('CreateTemplate')
+		with self.lock:
+			if Template['TemplateName'] in self.templates:
+				raise self.exceptions.AlreadyExistsException(f"Template {Template['TemplateName']} already exists")
+			self.templates[Template['TemplateName']] = dict(Template)
+		return {}
+
+	def update_template(self, Template):
+		self.call('UpdateTemplate')
+		with self.lock:
+			if Template['TemplateName'] not in self.templates:
+				raise self.exceptions.TemplateDoesNotExistException(f"Template {Template['TemplateName']} does not exist")
+			self.templates[Template['TemplateName']] = dict(Template)
+		return {}
+
+	def send_bulk_templated_email(self, Source, Template, Destinations, DefaultTemplateData=None, **kwargs):
+		self.call('SendBulkTemplatedEmail')
+		if len(Destinations) > SEND_BULK_TEMPLATED_EMAIL_MAX_DESTINATIONS:
+			raise ValueError(f"SendBulkTemplatedEmail accepts at most {SEND_BULK_TEMPLATED_EMAIL_MAX_DESTINATIONS} destinations")
+		statuses = []
+		with self.lock:
+			if Template not in self.templates:
+				raise self.exceptions.TemplateDoesNotExistException(f"Template {Template} does not exist")
+			for destination in Destinations:
+				recipient = destination['Destination']['ToAddresses'][0]
+				try:
+					self._check_verified(Source, recipient)
+				except self.exceptions.MessageRejected as e:
+					statuses.append({'Status': 'MessageRejected', 'Error': str(e)})
+					continue
+				data = json.loads(destination.get('ReplacementTemplateData') or DefaultTemplateData or '{}')
+				self.sent.append((recipient, self.templates[Template]['SubjectPart'], json.dumps(data)))
+				statuses.append({'Status': 'Success', 'MessageId': str(uuid.uuid4())})
+		return {'Status': statuses}
+
+	# SES v2 operation used by the settings application to verify new contact addresses
+	def create_email_identity(self, EmailIdentity, **kwargs):
+		self.call('CreateEmailIdentity')
+		with self.lock:
+			if EmailIdentity not in self.verified:
+				self.pending.add(EmailIdentity)
+		return {'IdentityType': 'EMAIL_ADDRESS', 'VerifiedForSendingStatus': EmailIdentity in self.verified}
+
+class FakeSESv2(FakeSES):
+
+	service_name = 'sesv2'
+
+class FakeSchedulerExceptions:
+
+	class ResourceNotFoundException(Exception):
+		pass
+
+	class ConflictException(Exception):
+		pass
+
+class FakeScheduler(FakeService):
+
+	service_name = 'scheduler'
+	exceptions = FakeSchedulerExceptions
+
+	def __init__(self, log, latency):
+		super().__init__(log, latency)
+		# (group name, schedule name) -> request
+		self.schedules = {}
+		# The (group name, schedule name) of every schedule created or updated, in order
+		self.armed = []
+
+	def create_schedule(self, Name, GroupName='default', **kwargs):
+		self.call('CreateSchedule')
+		with self.lock:
+			if (GroupName, Name) in self.schedules:
+				raise self.exceptions.ConflictException(f"Schedule {Name} already exists")
+			self.schedules[(GroupName, Name)] = kwargs
+			self.armed.append((GroupName, Name))
+		return {'ScheduleArn': f"arn:aws:scheduler:::schedule/{GroupName}/{Name}"}
+
+	def update_schedule(self, Name, GroupName='default', **kwargs):
+		self.call('UpdateSchedule')
+		with self.lock:
+			if (GroupName, Name) not in self.schedules:
+				raise self.exceptions.ResourceNotFoundException(f"Schedule {Name} does not exist")
+			self.schedules[(GroupName, Name)] = kwargs
+			self.armed.append((GroupName, Name))
+		return {'ScheduleArn': f"arn:aws:scheduler:::schedule/{GroupName}/{Name}"}
+
+class FakeSQS(FakeService):
+
+	service_name = 'sqs'
+
+	def __init__(self, log, latency, clock=time.monotonic):
+		super().__init__(log, latency)
+		self.clock = clock
+		# message ID -> {"body", "group", "receipt_handle", "receive_count", "visible_at"}
+		self.messages = collections.OrderedDict()
+		# deduplication ID -> time it was sent
+		self.deduplication = {}
+
+	def send_message_batch(self, QueueUrl, Entries):
+		self.call('SendMessageBatch')
+		successful = []
+		with self.lock:
+			now = self.clock()
+			for entry in Entries:
+				deduplication_id = entry.get('MessageDeduplicationId')
+				message_id = str(uuid.uuid4())
+				successful.append({'Id': entry['Id'], 'MessageId': message_id})
+				# FIFO queues accept a duplicate but do not deliver it
+				if deduplication_id and now - self.deduplication.get(deduplication_id, now - 300) < 300:
+					continue
+				self.deduplication[deduplication_id] = now
+				self.messages[message_id] = {'body': entry['MessageBody'], 'group': entry.get('MessageGroupId'), 'receipt_handle': None, 'receive_count': 0, 'visible_at': now}
+		return {'Successful': successful, 'Failed': []}
+
+	def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+		self.call('ChangeMessageVisibility')
+		with self.lock:
+			for message in self.messages.values():
+				if message['receipt_handle'] == ReceiptHandle:
+					message['visible_at'] = self.clock() + VisibilityTimeout
+
+	# Function to receive the visible messages as the records of a Lambda SQS event, as the event source mapping
+	# does (the messages are deleted by delete_records once the handler has returned)
+	def lambda_event(self, max_records=10, visibility_timeout=30):
+		records = []
+		with self.lock:
+			now = self.clock()
+			for message_id, message in self.messages.items():
+				if len(records) >= max_records:
+					break
+				if message['visible_at'] > now:
+					continue
+				message['receive_count'] += 1
+				message['receipt_handle'] = str(uuid.uuid4())
+				message['visible_at'] = now + visibility_timeout
+				records.append({
+					'messageId': message_id,
+					'receiptHandle': message['receipt_handle'],
+					'body': message['body'],
+					'attributes': {'ApproximateReceiveCount': str(message['receive_count']), 'MessageGroupId': message['group']},
+					'eventSourceARN': 'arn:aws:sqs:us-east-1:123456789012:lifecheck-notification-outbox.fifo'
+				})
+		return {'Records': records}
+
+	# Function to delete the messages of an event that the handler did not report as failed
+	def delete_records(self, event, response):
+		failed = {failure['itemIdentifier'] for failure in (response or {}).get('batchItemFailures', [])}
+		with self.lock:
+			for record in event['Records']:
+				if record['messageId'] not in failed:
+					self.messages.pop(record['messageId'], None)
+
+class FakeSNS(FakeService):
+
+	service_name = 'sns'
+
+	def __init__(self, log, latency):
+		super().__init__(log, latency)
+		# The text messages sent, as (phone number, message) tuples
+		self.sent = []
+
+	def publish(self, PhoneNumber=None, Message=None, **kwargs):
+		self.call('Publish')
+		with self.lock:
+			self.sent.append((PhoneNumber, Message))
+		return {'MessageId': str(uuid.uuid4())}
+
+class FakeHTTPResponse(io.BytesIO):
+
+	def __init__(self, body, headers=None, status=200):
+		super().__init__(body)
+		self.headers = headers or {}
+		self.status = status
+
+class FakeGoogle(FakeService):
+
+	service_name = 'google'
+
+	def __init__(self, log, latency, client_id='benchmark-client-id', email='sender@example.com', key_id='benchmark-key'):
+		super().__init__(log, latency)
+		self.client_id = client_id
+		self.email = email
+		self.key_id = key_id
+		# The signing key and certificate are generated when they are first needed, as this requires google-auth
+		# and cryptography (which are only needed by the login function)
+		self.private_key_pem = None
+		self.certificate_pem = None
+
+	def _generate_key(self):
+		from cryptography import x509
+		from cryptography.x509.oid import NameOID
+		from cryptography.hazmat.primitives import hashes, serialization
+		from cryptography.hazmat.primitives.asymmetric import rsa
+
+		key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+		name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "benchmark.googleusercontent.com")])
+		now = datetime.datetime.now(datetime.timezone.utc)
+		certificate = (
+			x509.CertificateBuilder()
+			.subject_name(name)
+			.issuer_name(name)
+			.public_key(key.public_key())
+			.serial_number(x509.random_serial_number())
+			.not_valid_before(now - datetime.timedelta(days=1))
+			.not_valid_after(now + datetime.timedelta(days=1))
+			.sign(key, hashes.SHA256())
+		)
+		self.private_key_pem = key.private_bytes(
+			serialization.Encoding.PEM,
+			serialization.PrivateFormat.PKCS8,
+			serialization.NoEncryption()
+		).decode('ascii')
+		self.certificate_pem = certificate.public_bytes(serialization.Encoding.PEM).decode('ascii')
+
+	# Function to sign an ID token for the configured account, as returned by the token endpoint
+	def id_token(self, email=None):
+		from google.auth import crypt, jwt
+
+		with self.lock:
+			if self.private_key_pem is None:
+				self._generate_key()
+		now = int(time.time())
+		signer = crypt.RSASigner.from_string(self.private_key_pem, key_id=self.key_id)
+		return jwt.encode(signer, {
+			"iss": "https://accounts.google.com",
+			"aud": self.client_id,
+			"sub": "1234567890",
+			"email": email or self.email,
+			"email_verified": True,
+			"iat": now,
+			"exp": now + 3600
+		}).decode('ascii')
+
+	# Replacement for urllib.request.urlopen that serves the Google endpoints
+	def urlopen(self, url, data=None, timeout=None, **kwargs):
+		full_url = getattr(url, 'full_url', url)
+		data = getattr(url, 'data', None) or data
+		if full_url == GOOGLE_TOKEN_ENDPOINT:
+			self.call('token')
+			form = urllib.parse.parse_qs((data or b'').decode('utf-8'))
+			if form.get('client_id') != [self.client_id] or not form.get('code'):
+				raise FakeServiceError("Invalid token request")
+			return FakeHTTPResponse(json.dumps({"id_token": self.id_token(), "token_type": "Bearer"}).encode())
+		if full_url == GOOGLE_PUBLIC_KEYS_URL:
+			self.call('certs')
+			with self.lock:
+				if self.certificate_pem is None:
+					self._generate_key()
+			return FakeHTTPResponse(
+				json.dumps({self.key_id: self.certificate_pem}).encode(),
+				headers={"Cache-Control": f"public, max-age={GOOGLE_KEYS_MAX_AGE_SECONDS}, must-revalidate, no-transform"}
+			)
+		raise FakeServiceError(f"No stand-in for {full_url}")
+
+class FakeCloud:
+
+	def __init__(self, latency=None):
+		self.log = CallLog()
+		self.latency = latency or Latency()
+		self.ssm = FakeSSM(self.log, self.latency)
+		self.ses = FakeSES(self.log, self.latency)
+		self.sesv2 = FakeSESv2(self.log, self.latency, verified=self.ses.verified)
+		self.scheduler = FakeScheduler(self.log, self.latency)
+		self.sqs = FakeSQS(self.log, self.latency)
+		self.sns = FakeSNS(self.log, self.latency)
+		self.google = FakeGoogle(self.log, self.latency)
+
+	# Replacement for boto3.client, returning the same stand-in for every client of a service
+	def client(self, service_name, *args, **kwargs):
+		clients = {'ssm': self.ssm, 'ses': self.ses, 'sesv2': self.sesv2, 'scheduler': self.scheduler, 'sqs': self.sqs, 'sns': self.sns}
+		if service_name not in clients:
+			raise ValueError(f"No stand-in for the '{service_name}' service")
+		return clients[service_name]
+
+	@contextlib.contextmanager
+	def patch(self):
+		with mock.patch('boto3.client', self.client), mock.patch('urllib.request.urlopen', self.google.urlopen):
+			yield self
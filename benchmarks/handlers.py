@@ -0,0 +1,408 @@
+"""
+benchmarks/handlers.py
+
+Runs each Lambda handler against the in-memory stand-ins in benchmarks/fakes.py for a set of
+scenarios, and reports the latency percentiles of the handler and the exact number of remote calls
+(to SSM, SES, EventBridge Scheduler and Google) made by each invocation.
+
+Each scenario loads a fresh copy of its handler module, as Lambda does for a new container, then
+invokes it repeatedly with the same starting state. The first invocation is reported as the cold
+invocation and the rest as warm invocations, since the caches kept in the warm container (e.g. the
+parameter cache and the Google public keys) change the number of calls.
+
+The script fails (exits with status 1) if a scenario makes more remote calls than its budget, so a
+change that adds round trips is caught, or if a handler does not return the expected response. The
+budgets are the current call counts, so when a change removes calls the budgets should be lowered.
+
+Injected latencies approximate the round trip to each service, so the effect of a change on the
+latency of a handler can be measured without deploying it:
+
+	python benchmarks/handlers.py [--iterations N] [--latency-ms MS] [--jitter-ms MS]
+		[--service-latency SERVICE=MS ...] [--scenario NAME ...] [--verbose]
+
+Run it from the repository root with boto3 installed. The login scenario also requires google-auth
+and cryptography, and is skipped if they are not installed.
+"""
+
+import os
+import sys
+import json
+import types
+import logging
+import argparse
+import datetime
+import importlib.util
+from unittest import mock
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_ROOT)
+
+from fakes import FakeCloud, Latency
+
+PARAMETER_PREFIX = '/lifecheck/'
+FUNCTION_ARN = 'arn:aws:lambda:us-east-1:123456789012:function:lifecheck-notification'
+METHOD_ARN = 'arn:aws:execute-api:us-east-1:123456789012:abcdef1234/Prod/GET/settings'
+
+# The parameters of each function, as configured in template.yaml
+PARAMETER_FIELDS = [
+	'last_verification',
+	'next_action_at',
+	'google_account_email',
+	'google_client_id',
+	'google_client_secret',
+	'primary_contact_email',
+	'primary_contact_message',
+	'primary_contact_datetime',
+	'secondary_contact_email',
+	'secondary_contact_message',
+	'secondary_contact_datetime',
+	'emergency_contact_email',
+	'emergency_contact_phone',
+	'emergency_contact_message',
+	'emergency_contact_datetime',
+	'token_keys'
+]
+
+ENVIRONMENT = {
+	**{f"{field.upper()}_PARAM": f"{PARAMETER_PREFIX}{field}" for field in PARAMETER_FIELDS},
+	'AWS_DEFAULT_REGION': 'us-east-1',
+	'REGION': 'us-east-1',
+	'EMAIL_VERIFICATION_API_GATEWAY_URL': 'https://abcdef1234.execute-api.us-east-1.amazonaws.com/Prod/verify-email',
+	'NOTIFICATION_SCHEDULE_GROUP': 'lifecheck-notification-timers',
+	'NOTIFICATION_SCHEDULE_ROLE_ARN': 'arn:aws:iam::123456789012:role/lifecheck-scheduler',
+	'NOTIFICATION_FUNCTION_ARN': FUNCTION_ARN,
+	'HISTORY_PATH': f"{PARAMETER_PREFIX}history",
+	'OUTBOX_QUEUE_URL': 'https://sqs.us-east-1.amazonaws.com/123456789012/lifecheck-notification-outbox.fifo'
+}
+
+# Environment variables that select other modes, which are not benchmarked here
+UNSET_ENVIRONMENT = ['STATE_DOCUMENT_PARAM', 'STATE_TABLE', 'STATE_DATABASE', 'SUBJECTS_PATH', 'ESCALATION_TIERS', 'SES_TEMPLATE_PREFIX']
+
+SENDER = 'sender@example.com'
+CONTACTS = {
+	'primary_contact_email': 'me@example.com',
+	'primary_contact_message': 'Please check in.',
+	'secondary_contact_email': 'friend@example.com',
+	'secondary_contact_message': 'I have not checked in for 40 hours.',
+	'emergency_contact_email': 'family@example.com',
+	'emergency_contact_phone': '+15555550100',
+	'emergency_contact_message': 'I have not checked in for 48 hours.'
+}
+
+# The maximum number of remote calls made by the cold and warm invocations of each scenario. These are the
+# current counts: a change that adds a round trip fails the benchmark, and a change that removes one should
+# lower the budget.
+CALL_BUDGETS = {
+	'no_action': {'cold': 2, 'warm': 2},
+	'primary_reminder': {'cold': 10, 'warm': 6},
+	'secondary': {'cold': 9, 'warm': 6},
+	'emergency': {'cold': 9, 'warm': 6},
+	'send_failure': {'cold': 9, 'warm': 5},
+	'outbox_retry': {'cold': 4, 'warm': 4},
+	# Appending to the verification history in Parameter Store creates and deletes its lock (2 calls)
+	'email_click': {'cold': 10, 'warm': 9},
+	'check_in': {'cold': 8, 'warm': 8},
+	'settings_view': {'cold': 3, 'warm': 3},
+	'settings_update': {'cold': 2, 'warm': 2},
+	'settings_shell': {'cold': 0, 'warm': 0},
+	'settings_api': {'cold': 3, 'warm': 3},
+	'settings_patch': {'cold': 2, 'warm': 2},
+	'login': {'cold': 3, 'warm': 1},
+	'authorize': {'cold': 1, 'warm': 0}
+}
+
+def hours_ago(now, hours):
+	return (now - datetime.timedelta(hours=hours)).isoformat()
+
+# Function to return the stored state with the next_action_at value that the handlers would have stored for it
+def with_next_action(values, now):
+	from lifecheck import escalation
+	return {**values, 'next_action_at': escalation.next_action_at(values, now)}
+
+def is_ok(response):
+	return isinstance(response, dict) and response.get('statusCode') == 200
+
+def is_allowed(response):
+	return response['policyDocument']['Statement'][0]['Effect'] == 'Allow'
+
+def email_click_event(handler, now, iteration):
+	from lifecheck import tokens
+	keyring = json.loads(handler.parameters.ssm.values()[f"{PARAMETER_PREFIX}token_keys"])
+	return {'queryStringParameters': {'token': tokens.mint(keyring, None, now + datetime.timedelta(hours=1))}}
+
+def send_failure_event(handler, now, iteration):
+	# The email is rejected once, so it is queued in the outbox
+	handler.ses.fail('SendEmail')
+	return {}
+
+def outbox_retry_event(handler, now, iteration):
+	# The entry the poller queues when the primary reminder of the outbox_retry state fails to send
+	from lifecheck import outbox
+	last_verification = hours_ago(now, 31)
+	handler.notification_outbox.client.messages.clear()
+	handler.notification_outbox.put([{
+		'key': outbox.idempotency_key(None, 'primary_contact', last_verification, None),
+		'subject_id': None,
+		'contact': 'primary_contact',
+		'source': SENDER,
+		'email': CONTACTS['primary_contact_email'],
+		'subject': 'Lifecheck verification required',
+		'body': CONTACTS['primary_contact_message'],
+		'changes': {'primary_contact_datetime': now.isoformat()},
+		'last_verification': last_verification,
+		'previous_notification': None
+	}])
+	return handler.notification_outbox.client.lambda_event()
+
+def settings_update_event(handler, now, iteration):
+	# The message changes on every invocation, so each update writes one parameter
+	return {'body': f"primary_contact_message=Please+check+in+({iteration})&primary_contact_email={CONTACTS['primary_contact_email']}"}
+
+def settings_shell_event(handler, now, iteration):
+	# After the first request the browser revalidates the cached shell
+	headers = {'Accept-Encoding': 'gzip, deflate, br'}
+	return {'headers': headers if iteration == 0 else {**headers, 'If-None-Match': handler.SHELL_ETAG}}
+
+def settings_patch_event(handler, now, iteration):
+	return {'httpMethod': 'PATCH', 'resource': '/settings/api', 'body': json.dumps({'primary_contact_message': f"Please check in ({iteration})"})}
+
+def login_event(handler, now, iteration):
+	return {'requestContext': {'apiId': 'abcdef1234'}, 'queryStringParameters': {'code': f"code-{iteration}"}}
+
+def authorize_event(handler, now, iteration):
+	session = handler.create_session(SENDER, 'benchmark-client-secret')
+	return {'headers': {'Cookie': f"{handler.SESSION_COOKIE_NAME}={session}"}, 'methodArn': METHOD_ARN}
+
+# Each scenario invokes an entry point of a handler module with a state (a function of the current time) and an
+# event (a function of the loaded handler, the current time and the iteration), and checks the response. A scenario
+# can also set environment variables while its handler is loaded and invoked
+SCENARIOS = {
+	'no_action': {
+		'handler': 'lifecheck-notification',
+		'state': lambda now: with_next_action({'last_verification': hours_ago(now, 2)}, now),
+		'check': is_ok
+	},
+	'primary_reminder': {
+		'handler': 'lifecheck-notification',
+		'state': lambda now: with_next_action({'last_verification': hours_ago(now, 31)}, now),
+		'check': lambda response: is_ok(response) and response['body'].startswith('Primary')
+	},
+	'secondary': {
+		'handler': 'lifecheck-notification',
+		'state': lambda now: with_next_action({
+			'last_verification': hours_ago(now, 41),
+			'primary_contact_datetime': hours_ago(now, 2)
+		}, now),
+		'check': lambda response: is_ok(response) and response['body'].startswith('Secondary')
+	},
+	'emergency': {
+		'handler': 'lifecheck-notification',
+		'state': lambda now: with_next_action({
+			'last_verification': hours_ago(now, 49),
+			'primary_contact_datetime': hours_ago(now, 10),
+			'secondary_contact_datetime': hours_ago(now, 9)
+		}, now),
+		'check': lambda response: is_ok(response) and response['body'].startswith('Emergency')
+	},
+	'send_failure': {
+		'handler': 'lifecheck-notification',
+		'state': lambda now: with_next_action({'last_verification': hours_ago(now, 31)}, now),
+		'event': send_failure_event,
+		'check': lambda response: is_ok(response) and 'queued for retry' in response['body']
+	},
+	'outbox_retry': {
+		'handler': 'lifecheck-outbox',
+		'state': lambda now: with_next_action({'last_verification': hours_ago(now, 31)}, now),
+		'event': outbox_retry_event,
+		'check': lambda response: response == {'batchItemFailures': []}
+	},
+	'email_click': {
+		'handler': 'lifecheck-verification-email',
+		'state': lambda now: with_next_action({
+			'last_verification': hours_ago(now, 31),
+			'primary_contact_datetime': hours_ago(now, 1)
+		}, now),
+		'event': email_click_event,
+		'check': is_ok
+	},
+	'check_in': {
+		'handler': 'lifecheck-verification',
+		'state': lambda now: with_next_action({'last_verification': hours_ago(now, 6)}, now),
+		'check': lambda response: is_ok(response) and 'already recorded' not in response['body']
+	},
+	'settings_view': {
+		'handler': 'lifecheck-settings-view',
+		'state': lambda now: with_next_action({'last_verification': hours_ago(now, 6)}, now),
+		'check': is_ok
+	},
+	'settings_update': {
+		'handler': 'lifecheck-settings-update',
+		'state': lambda now: with_next_action({'last_verification': hours_ago(now, 6)}, now),
+		'event': settings_update_event,
+		'check': is_ok
+	},
+	'settings_shell': {
+		'handler': 'lifecheck-settings-view',
+		'environment': {'SETTINGS_SHELL_MODE': 'true'},
+		'state': lambda now: {},
+		'event': settings_shell_event,
+		'check': lambda response: response.get('statusCode') in (200, 304)
+	},
+	'settings_api': {
+		'handler': 'lifecheck-settings-view',
+		'state': lambda now: with_next_action({'last_verification': hours_ago(now, 6)}, now),
+		'event': lambda handler, now, iteration: {'httpMethod': 'GET', 'resource': '/settings/api'},
+		'check': lambda response: is_ok(response) and 'last_verification' in json.loads(response['body'])
+	},
+	'settings_patch': {
+		'handler': 'lifecheck-settings-update',
+		'state': lambda now: with_next_action({'last_verification': hours_ago(now, 6)}, now),
+		'event': settings_patch_event,
+		'check': is_ok
+	},
+	'login': {
+		'handler': 'lifecheck-authorizer',
+		'entry': 'login_handler',
+		'requires': ['google.auth', 'cryptography'],
+		'state': lambda now: {},
+		'event': login_event,
+		'check': lambda response: response.get('statusCode') == 302
+	},
+	'authorize': {
+		'handler': 'lifecheck-authorizer',
+		'state': lambda now: {},
+		'event': authorize_event,
+		'check': is_allowed
+	}
+}
+
+# Function to load a fresh copy of a handler module, as in a new Lambda container
+def load_handler(handler, instance):
+	spec = importlib.util.spec_from_file_location(f"benchmark_{handler.replace('-', '_')}_{instance}", os.path.join(REPOSITORY_ROOT, f"{handler}.py"))
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+# Function to reset the stored parameters to the state of a scenario
+def seed_state(cloud, state, keyring):
+	cloud.ssm.clear()
+	cloud.ssm.seed({
+		f"{PARAMETER_PREFIX}{field}": value
+		for field, value in {
+			**CONTACTS,
+			'google_account_email': SENDER,
+			'google_client_id': cloud.google.client_id,
+			'google_client_secret': 'benchmark-client-secret',
+			'token_keys': json.dumps(keyring),
+			**state
+		}.items()
+	})
+
+def percentile(values, p):
+	ordered = sorted(values)
+	return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered) + 0.5) - 1))]
+
+def format_counts(counts):
+	return ' '.join(f"{operation}={count}" for operation, count in sorted(counts.items())) or '-'
+
+# Function to run the invocations of a scenario and return the call counts and latencies
+def run_scenario(index, name, scenario, latency, iterations):
+	from lifecheck import tokens
+
+	cloud = FakeCloud(latency)
+	cloud.ses.verify(SENDER, *(value for field, value in CONTACTS.items() if field.endswith('_email')))
+	# The notification timer normally exists already, so arming it is a single update
+	cloud.scheduler.schedules[(ENVIRONMENT['NOTIFICATION_SCHEDULE_GROUP'], 'lifecheck')] = {}
+	keyring = tokens.rotated_keyring()
+	context = types.SimpleNamespace(invoked_function_arn=FUNCTION_ARN, function_name=scenario['handler'])
+
+	results = []
+	with cloud.patch(), mock.patch.dict(os.environ, scenario.get('environment', {})):
+		handler = load_handler(scenario['handler'], index)
+		entry = getattr(handler, scenario.get('entry', 'lambda_handler'))
+		for iteration in range(iterations + 1):
+			now = datetime.datetime.now()
+			seed_state(cloud, scenario['state'](now), keyring)
+			event = scenario['event'](handler, now, iteration) if 'event' in scenario else {}
+
+			mark = cloud.log.mark()
+			start = datetime.datetime.now()
+			try:
+				response = entry(event, context)
+				passed = scenario['check'](response)
+			except Exception as e:
+				response = f"{type(e).__name__}: {e}"
+				passed = False
+			latency_ms = (datetime.datetime.now() - start).total_seconds() * 1000
+			results.append({'counts': cloud.log.counts(mark), 'latency_ms': latency_ms, 'passed': passed, 'response': response})
+	return results
+
+def parse_service_latency(value):
+	service, _, latency_ms = value.partition('=')
+	if not service or not latency_ms:
+		raise argparse.ArgumentTypeError(f"Expected SERVICE=MS, got '{value}'")
+	return service, float(latency_ms)
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark the Lambda handlers against in-memory AWS and Google stand-ins")
+	parser.add_argument('--iterations', type=int, default=20, help="number of warm invocations of each scenario")
+	parser.add_argument('--latency-ms', type=float, default=0.0, help="latency injected into every remote call")
+	parser.add_argument('--jitter-ms', type=float, default=0.0, help="random latency of up to this many milliseconds added to every remote call")
+	parser.add_argument('--service-latency', type=parse_service_latency, action='append', default=[], metavar='SERVICE=MS', help="latency injected into the calls to one service (ssm, ses, sesv2, scheduler, sqs, sns or google)")
+	parser.add_argument('--scenario', action='append', choices=list(SCENARIOS), help="only run the named scenarios")
+	parser.add_argument('--seed', type=int, default=None, help="seed for the injected jitter")
+	parser.add_argument('--verbose', action='store_true', help="show the handler logs and the calls made by each scenario")
+	args = parser.parse_args()
+
+	os.environ.update(ENVIRONMENT)
+	for name in UNSET_ENVIRONMENT:
+		os.environ.pop(name, None)
+
+	# The handler logs and embedded metrics are not shown unless requested
+	from lifecheck import metrics
+	metrics.set_sink(metrics.ListSink())
+	if args.verbose:
+		logging.basicConfig(level=logging.INFO)
+	else:
+		logging.disable(logging.CRITICAL)
+
+	latency = Latency(args.latency_ms, args.jitter_ms, dict(args.service_latency), args.seed)
+	failures = []
+	print(f"{'scenario':<18}{'cold calls':>11}{'warm calls':>11}{'budget':>9}{'cold ms':>10}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}")
+	for index, name in enumerate(args.scenario or SCENARIOS):
+		scenario = SCENARIOS[name]
+		missing = [module for module in scenario.get('requires', []) if importlib.util.find_spec(module.split('.')[0]) is None or importlib.util.find_spec(module) is None]
+		if missing:
+			print(f"{name:<18}skipped (requires {', '.join(missing)})")
+			continue
+
+		results = run_scenario(index, name, scenario, latency, args.iterations)
+		cold, warm = results[0], results[1:] or results[:1]
+		cold_calls = sum(cold['counts'].values())
+		warm_calls = max(sum(result['counts'].values()) for result in warm)
+		warm_latencies = [result['latency_ms'] for result in warm]
+		budget = CALL_BUDGETS.get(name, {})
+		print(
+			f"{name:<18}{cold_calls:>11}{warm_calls:>11}{budget.get('cold', '-')!s:>4}/{budget.get('warm', '-')!s:<4}"
+			f"{cold['latency_ms']:>10.1f}{percentile(warm_latencies, 50):>9.1f}{percentile(warm_latencies, 90):>9.1f}{percentile(warm_latencies, 99):>9.1f}"
+		)
+		if args.verbose:
+			print(f"  cold: {format_counts(cold['counts'])}")
+			print(f"  warm: {format_counts(warm[-1]['counts'])}")
+
+		for label, result in [('cold', cold)] + [('warm', result) for result in warm]:
+			if not result['passed']:
+				failures.append(f"{name}: unexpected {label} response {result['response']!r}")
+				break
+		for label, calls in (('cold', cold_calls), ('warm', warm_calls)):
+			if label in budget and calls > budget[label]:
+				failures.append(f"{name}: {label} invocation made {calls} remote calls (budget {budget[label]})")
+			elif label in budget and calls < budget[label]:
+				print(f"  {label} invocation made fewer calls than its budget of {budget[label]} - the budget can be lowered")
+
+	for failure in failures:
+		print(f"FAILED {failure}")
+	return 1 if failures else 0
+
+if __name__ == '__main__':
+	sys.exit(main())
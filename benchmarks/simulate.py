@@ -0,0 +1,594 @@
+"""
+benchmarks/simulate.py
+
+A time-warp simulator that replays weeks or months of check-ins through the notification poller
+(lifecheck-notification.py), the check-in API (lifecheck-verification.py) and the verification links
+(lifecheck-verification-email.py), to estimate what a number of people will cost to monitor.
+
+By default each subject is simulated as its own single-person deployment, against the in-memory
+stand-ins in benchmarks/fakes.py, so the poller invocations and their Parameter Store reads are
+counted once per subject. With --multi-subject, every subject is instead monitored by one
+deployment in multi-subject mode (with the state of each subject stored as one document under
+SUBJECTS_PATH, as template.yaml requires), so that one poller run evaluates every subject. The
+handlers run on a virtual clock: datetime.datetime.now() in the handler
+modules and the clocks of their warm-container caches return the simulated time, so months of
+events are replayed in seconds. The simulation is driven by a queue of timed events:
+
+- check-ins from the trace, which invoke the check-in API
+- the fallback run of the poller every 2 hours, and the one-shot timers that the handlers arm with
+  EventBridge Scheduler (fired at the time they were last armed for)
+- clicks on the verification link in the primary reminder emails, made by some subjects after a
+  delay (clicks after the link has expired are rejected, as they would be in production)
+
+A Lambda container is reused while it is invoked at least every --container-idle-minutes, and a
+new one (a cold start) is used otherwise.
+
+Check-ins are either generated, as one reboot a day around a preferred time with some days
+skipped and occasional absences of a few days, or replayed from a recorded trace of JSON lines:
+
+	{"subject": "jane", "time": "2025-03-01T08:12:00"}
+
+Single-person deployments are simulated in parallel on a process pool, while a multi-subject
+deployment is simulated in one process. The script reports the invocations, cold starts and remote
+calls, the delay between each tier becoming due and its first notification, and an estimate of the
+monthly AWS cost:
+
+	python benchmarks/simulate.py [--subjects N] [--days N] [--trace FILE] [--multi-subject] [--workers N] [--json]
+
+Run it from the repository root with boto3 installed.
+"""
+
+import os
+import re
+import sys
+import json
+import heapq
+import types
+import random
+import logging
+import argparse
+import datetime
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+from fakes import FakeCloud
+from handlers import CONTACTS, ENVIRONMENT, PARAMETER_PREFIX, SENDER, UNSET_ENVIRONMENT, load_handler
+
+# Approximate us-east-1 list prices in USD, before the free tier (adjust for other regions)
+PRICES = {
+	'lambda_request': 0.20 / 1000000,
+	'lambda_gb_second': 0.0000166667,
+	'api_gateway_request': 3.50 / 1000000,
+	'ses_email': 0.10 / 1000,
+	# Transactional SMS to a US number, including the carrier fee (varies widely by country)
+	'sns_sms': 0.00883,
+	'scheduler_invocation': 1.00 / 1000000,
+	# Parameter Store API calls are free with standard throughput, and charged with higher throughput
+	'ssm_higher_throughput_call': 0.05 / 10000
+}
+LAMBDA_MEMORY_GB = 128 / 1024
+DAYS_PER_MONTH = 30
+
+FALLBACK_INTERVAL = datetime.timedelta(hours=2)
+SUBJECTS_PATH = f"{PARAMETER_PREFIX}subjects"
+# The environment of a multi-subject deployment, which must store the state of each subject as one document
+MULTI_SUBJECT_ENVIRONMENT = {
+	'SUBJECTS_PATH': SUBJECTS_PATH,
+	'STATE_DOCUMENT_PARAM': f"{PARAMETER_PREFIX}state"
+}
+SCHEDULE_EXPRESSION_PATTERN = re.compile(r'^at\((.+)\)$')
+TOKEN_PATTERN = re.compile(r'token=([A-Za-z0-9_.-]+)')
+
+# The handler invoked by each kind of event, and whether it is invoked through API Gateway
+EVENT_HANDLERS = {
+	'check_in': 'lifecheck-verification',
+	'click': 'lifecheck-verification-email',
+	'fallback': 'lifecheck-notification',
+	'timer': 'lifecheck-notification'
+}
+API_EVENTS = {'check_in', 'click'}
+
+class NullSink:
+
+	def emit(self, record):
+		pass
+
+class VirtualClock:
+
+	def __init__(self, start):
+		self.start = start
+		self.current = start
+
+	def set(self, current):
+		self.current = current
+
+	# Function to return the seconds elapsed on the virtual clock, used in place of time.monotonic by the caches
+	def monotonic(self):
+		return (self.current - self.start).total_seconds()
+
+	# Function to return a stand-in for the datetime module in which datetime.now() returns the virtual time
+	def datetime_module(self):
+		clock = self
+
+		class VirtualDatetime(datetime.datetime):
+
+			@classmethod
+			def now(cls, tz=None):
+				return clock.current if tz is None else clock.current.astimezone(tz)
+
+		module = types.ModuleType('datetime')
+		module.__dict__.update(datetime.__dict__)
+		module.datetime = VirtualDatetime
+		return module
+
+# Function to generate the check-ins of a subject: a reboot most days around a preferred time, occasionally a
+# second one later in the day, and no check-ins during absences
+def generate_check_ins(rng, start, end, absences_per_month):
+	preferred_hour = rng.uniform(6, 10)
+	absent_until = start
+	check_ins = []
+	day = start.replace(hour=0, minute=0, second=0, microsecond=0)
+	while day < end:
+		if day >= absent_until and rng.random() < absences_per_month / DAYS_PER_MONTH:
+			absent_until = day + datetime.timedelta(days=rng.randint(1, 4))
+		weekend = day.weekday() >= 5
+		if day >= absent_until and rng.random() < (0.7 if weekend else 0.95):
+			check_in = day + datetime.timedelta(hours=rng.gauss(preferred_hour + (1.5 if weekend else 0), 0.75))
+			check_ins.append(check_in)
+			if rng.random() < 0.2:
+				check_ins.append(check_in + datetime.timedelta(hours=rng.uniform(0.1, 10)))
+		day += datetime.timedelta(days=1)
+	return sorted(check_in for check_in in check_ins if start <= check_in < end)
+
+# Function to load the check-ins of each subject from a trace of JSON lines
+def load_trace(path):
+	subjects = collections.defaultdict(list)
+	with open(path) as trace:
+		for line in trace:
+			if line.strip():
+				record = json.loads(line)
+				subjects[record['subject']].append(datetime.datetime.fromisoformat(record['time']))
+	return {subject_id: sorted(check_ins) for subject_id, check_ins in subjects.items()}
+
+class Deployment:
+
+	def __init__(self, cloud, clock, container_idle):
+		self.cloud = cloud
+		self.clock = clock
+		self.container_idle = container_idle
+		# handler -> (module, time of the last invocation)
+		self.containers = {}
+		self.datetime_module = clock.datetime_module()
+		self.context = types.SimpleNamespace(invoked_function_arn=ENVIRONMENT['NOTIFICATION_FUNCTION_ARN'])
+
+	# Function to return the warm container of a handler, or a new one if it has been idle for too long, and
+	# whether it is a cold start
+	def container(self, handler):
+		module, last_used = self.containers.get(handler, (None, None))
+		cold = module is None or self.clock.current - last_used > self.container_idle
+		if cold:
+			module = load_handler(handler, id(self))
+			module.datetime = self.datetime_module
+			# The caches kept in the warm container expire on the virtual clock
+			for value in vars(module).values():
+				if hasattr(value, 'clock') and hasattr(value, 'entries'):
+					value.clock = self.clock.monotonic
+		self.containers[handler] = (module, self.clock.current)
+		return module, cold
+
+	def invoke(self, handler, event):
+		module, cold = self.container(handler)
+		return module.lambda_handler(event, self.context), cold
+
+	# Function to return the time and event of a notification timer, or None if it is not armed
+	def timer(self, name='lifecheck'):
+		group = ENVIRONMENT['NOTIFICATION_SCHEDULE_GROUP']
+		request = self.cloud.scheduler.schedules.get((group, name))
+		if not request:
+			return None
+		match = SCHEDULE_EXPRESSION_PATTERN.match(request['ScheduleExpression'])
+		return datetime.datetime.fromisoformat(match.group(1)), json.loads(request['Target']['Input'])
+
+def new_stats():
+	return {
+		'invocations': collections.Counter(),
+		'cold_starts': collections.Counter(),
+		'calls': collections.Counter(),
+		'api_requests': 0,
+		'timer_invocations': 0,
+		'lambda_gb_seconds': 0.0,
+		'emails': collections.Counter(),
+		'clicks': collections.Counter(),
+		'escalation_delays': collections.defaultdict(list),
+		'errors': collections.Counter()
+	}
+
+# Function to return the event passed to the handler of a simulated event
+def handler_event(kind, payload):
+	if kind == 'check_in':
+		return {}
+	elif kind == 'click':
+		return {'queryStringParameters': {'token': payload}}
+	return {'source': 'aws.events', 'detail-type': 'Scheduled Event'}
+
+# Function to invoke the handler of an event and count the invocation, its remote calls and its duration
+def invoke(deployment, stats, kind, event, options):
+	handler = EVENT_HANDLERS[kind]
+	mark = deployment.cloud.log.mark()
+	try:
+		response, cold = deployment.invoke(handler, event)
+	except Exception as e:
+		response, cold = {'statusCode': None, 'body': f"{type(e).__name__}: {e}"}, False
+	calls = deployment.cloud.log.counts(mark)
+
+	stats['invocations'][handler] += 1
+	stats['cold_starts'][handler] += cold
+	stats['calls'].update(calls)
+	stats['api_requests'] += kind in API_EVENTS
+	stats['timer_invocations'] += kind == 'timer'
+	# The duration is estimated from the number of remote calls, as the stand-ins respond immediately
+	duration_ms = options['base_duration_ms'] + sum(calls.values()) * options['call_latency_ms'] + (options['cold_start_ms'] if cold else 0)
+	stats['lambda_gb_seconds'] += duration_ms / 1000 * LAMBDA_MEMORY_GB
+	# Clicks on expired links are counted with the clicks below
+	if response.get('statusCode') != 200 and not (kind == 'click' and response.get('statusCode') == 401):
+		stats['errors'][f"{handler} {response.get('statusCode')}: {response.get('body', '')[:60]}"] += 1
+	if kind == 'click':
+		stats['clicks']['accepted' if response.get('statusCode') == 200 else 'rejected'] += 1
+	return response
+
+# Function to count an email sent for a tier, and the delay between the tier becoming due and its first notification
+# notified: the (subject ID, last verification, tier index) of the tiers that have already been notified
+def record_email(stats, notified, subject_id, index, last_verification, at):
+	from lifecheck import escalation
+	tier = escalation.TIERS[index]
+	stats['emails'][tier['label']] += 1
+	if last_verification and (subject_id, last_verification, index) not in notified:
+		notified.add((subject_id, last_verification, index))
+		due_at = datetime.datetime.fromisoformat(last_verification) + datetime.timedelta(hours=tier['threshold_hours'])
+		stats['escalation_delays'][tier['label']].append((at - due_at).total_seconds() / 60)
+
+# Function to simulate the deployment of one subject and return its statistics
+def simulate_subject(subject_id, check_ins, start, end, options):
+	from lifecheck import escalation, tokens
+
+	rng = random.Random(f"{options['seed']}:{subject_id}")
+	if check_ins is None:
+		check_ins = generate_check_ins(rng, start, end, options['absences_per_month'])
+
+	clock = VirtualClock(start)
+	cloud = FakeCloud()
+	cloud.ses.verify(SENDER, *(value for field, value in CONTACTS.items() if field.endswith('_email')))
+	cloud.ssm.seed({
+		f"{PARAMETER_PREFIX}{field}": value
+		for field, value in {
+			**CONTACTS,
+			'google_account_email': SENDER,
+			'token_keys': json.dumps(tokens.rotated_keyring()),
+			'last_verification': start.isoformat(),
+			'next_action_at': escalation.next_action_at({'last_verification': start.isoformat()}, start)
+		}.items()
+	})
+	tier_of_recipient = {CONTACTS.get(f"{tier['contact']}_email"): index for index, tier in enumerate(escalation.TIERS)}
+
+	stats = new_stats()
+
+	events = []
+	sequence = 0
+
+	def schedule_event(at, kind, payload=None):
+		nonlocal sequence
+		sequence += 1
+		heapq.heappush(events, (at, sequence, kind, payload))
+
+	for check_in in check_ins:
+		schedule_event(check_in, 'check_in')
+	fallback = start + datetime.timedelta(minutes=rng.uniform(0, FALLBACK_INTERVAL.total_seconds() / 60))
+	while fallback < end:
+		schedule_event(fallback, 'fallback')
+		fallback += FALLBACK_INTERVAL
+
+	deployment = Deployment(cloud, clock, datetime.timedelta(minutes=options['container_idle_minutes']))
+	armed = None
+	notified = set()
+	sent_count = 0
+
+	with cloud.patch():
+		while events:
+			at, _, kind, payload = heapq.heappop(events)
+			if at >= end:
+				break
+			# A timer that has been moved since this event was queued does not fire
+			if kind == 'timer' and payload != armed:
+				continue
+
+			clock.set(at)
+			event = armed[1] if kind == 'timer' else handler_event(kind, payload)
+			last_verification = cloud.ssm.values().get(f"{PARAMETER_PREFIX}last_verification")
+			invoke(deployment, stats, kind, event, options)
+
+			for recipient, subject, body in cloud.ses.sent[sent_count:]:
+				record_email(stats, notified, subject_id, tier_of_recipient.get(recipient), last_verification, at)
+				# Some subjects check in by clicking the link in the reminder email
+				token = TOKEN_PATTERN.search(body)
+				if token and rng.random() < options['click_probability']:
+					stats['clicks']['sent'] += 1
+					schedule_event(at + datetime.timedelta(minutes=rng.expovariate(1 / options['click_delay_minutes'])), 'click', token.group(1))
+			sent_count = len(cloud.ses.sent)
+
+			timer = deployment.timer()
+			if timer is not None and timer != armed:
+				armed = timer
+				schedule_event(timer[0], 'timer', timer)
+	return stats
+
+# Function to return the email address of a contact of a subject in a multi-subject deployment, so that the emails
+# of each subject can be told apart
+def subject_email(email, subject_id):
+	local, _, domain = email.partition('@')
+	return f"{local}+{subject_id}@{domain}"
+
+# Function to simulate one multi-subject deployment monitoring every subject and return its statistics
+def simulate_subjects(subjects, start, end, options):
+	from lifecheck import escalation, schedule, tokens
+
+	rng = random.Random(f"{options['seed']}:multi-subject")
+	clock = VirtualClock(start)
+	cloud = FakeCloud()
+	keyring = tokens.rotated_keyring()
+	cloud.ssm.seed({
+		f"{PARAMETER_PREFIX}google_account_email": SENDER,
+		f"{PARAMETER_PREFIX}token_keys": json.dumps(keyring)
+	})
+	cloud.ses.verify(SENDER)
+
+	events = []
+	sequence = 0
+
+	def schedule_event(at, kind, payload=None):
+		nonlocal sequence
+		sequence += 1
+		heapq.heappush(events, (at, sequence, kind, payload))
+
+	# The check-ins of each subject are generated as for a single-person deployment, and each subject checks in with
+	# its own check-in token
+	check_in_tokens = {}
+	recipients = {}
+	states = {}
+	for subject_id, check_ins in subjects:
+		if check_ins is None:
+			check_ins = generate_check_ins(random.Random(f"{options['seed']}:{subject_id}"), start, end, options['absences_per_month'])
+		for check_in in check_ins:
+			schedule_event(check_in, 'check_in', subject_id)
+		check_in_tokens[subject_id] = tokens.mint(keyring, subject_id, end + datetime.timedelta(days=1), purpose=tokens.CHECK_IN_PURPOSE)
+
+		contacts = {field: subject_email(value, subject_id) if field.endswith('_email') else value for field, value in CONTACTS.items()}
+		cloud.ses.verify(*(value for field, value in contacts.items() if field.endswith('_email')))
+		recipients.update({contacts.get(f"{tier['contact']}_email"): (subject_id, index) for index, tier in enumerate(escalation.TIERS)})
+		states[subject_id] = {
+			**contacts,
+			'last_verification': start.isoformat(),
+			'next_action_at': escalation.next_action_at({'last_verification': start.isoformat()}, start)
+		}
+		cloud.ssm.seed({f"{SUBJECTS_PATH}/{subject_id}/state": json.dumps(states[subject_id])})
+
+	fallback = start + datetime.timedelta(minutes=rng.uniform(0, FALLBACK_INTERVAL.total_seconds() / 60))
+	while fallback < end:
+		schedule_event(fallback, 'fallback')
+		fallback += FALLBACK_INTERVAL
+
+	stats = new_stats()
+	deployment = Deployment(cloud, clock, datetime.timedelta(minutes=options['container_idle_minutes']))
+	# subject ID -> the time and event of its timer
+	armed = {}
+	notified = set()
+	sent_count = 0
+	armed_count = 0
+
+	# Function to queue the timers armed since the last check (rather than checking the timer of every subject)
+	def queue_timers():
+		nonlocal armed_count
+		for group, name in dict.fromkeys(cloud.scheduler.armed[armed_count:]):
+			timer = deployment.timer(name)
+			if timer is not None and timer != armed.get(name):
+				armed[name] = timer
+				schedule_event(timer[0], 'timer', (name, timer))
+		armed_count = len(cloud.scheduler.armed)
+
+	# The timer of each subject is armed as it would have been when the subject's state was last written, so that
+	# the first deadlines are met by the timers rather than by the fallback schedule. These calls are part of the
+	# setup and are not counted.
+	scheduler = schedule.EventBridgeScheduler(
+		cloud.scheduler,
+		ENVIRONMENT['NOTIFICATION_SCHEDULE_GROUP'],
+		ENVIRONMENT['NOTIFICATION_FUNCTION_ARN'],
+		ENVIRONMENT['NOTIFICATION_SCHEDULE_ROLE_ARN']
+	)
+	for subject_id, state in states.items():
+		schedule.arm_next_run(scheduler, state, start, subject_id)
+	queue_timers()
+
+	with cloud.patch():
+		while events:
+			at, _, kind, payload = heapq.heappop(events)
+			if at >= end:
+				break
+			# A timer that has been moved since this event was queued does not fire
+			if kind == 'timer' and armed.get(payload[0]) != payload[1]:
+				continue
+
+			clock.set(at)
+			if kind == 'check_in':
+				event = {'queryStringParameters': {'token': check_in_tokens[payload]}}
+			elif kind == 'timer':
+				event = payload[1][1]
+			else:
+				event = handler_event(kind, payload)
+			invoke(deployment, stats, kind, event, options)
+
+			# The poller does not change last_verification when it notifies, so it is read after the invocation
+			for recipient, subject, body in cloud.ses.sent[sent_count:]:
+				subject_id, index = recipients[recipient]
+				state = json.loads(cloud.ssm.values()[f"{SUBJECTS_PATH}/{subject_id}/state"])
+				record_email(stats, notified, subject_id, index, state.get('last_verification'), at)
+				token = TOKEN_PATTERN.search(body)
+				if token and rng.random() < options['click_probability']:
+					stats['clicks']['sent'] += 1
+					schedule_event(at + datetime.timedelta(minutes=rng.expovariate(1 / options['click_delay_minutes'])), 'click', token.group(1))
+			sent_count = len(cloud.ses.sent)
+			queue_timers()
+	return stats
+
+# Function to simulate a chunk of subjects in a worker process and merge their statistics
+def simulate_chunk(subjects, start, end, options):
+	totals = None
+	for subject_id, check_ins in subjects:
+		stats = simulate_subject(subject_id, check_ins, start, end, options)
+		totals = stats if totals is None else merge_stats(totals, stats)
+	return totals
+
+def merge_stats(totals, stats):
+	for key, value in stats.items():
+		if isinstance(value, collections.defaultdict):
+			for label, values in value.items():
+				totals[key][label].extend(values)
+		else:
+			totals[key] += value
+	return totals
+
+# environment: the environment variables that select the mode of the simulated deployment
+def initialise_worker(environment=None):
+	environment = {**ENVIRONMENT, **(environment or {})}
+	os.environ.update(environment)
+	for name in UNSET_ENVIRONMENT:
+		if name not in environment:
+			os.environ.pop(name, None)
+	logging.disable(logging.CRITICAL)
+	from lifecheck import metrics
+	metrics.set_sink(NullSink())
+
+def percentile(values, p):
+	ordered = sorted(values)
+	return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered) + 0.5) - 1))]
+
+# Function to estimate the monthly cost of the simulated period
+def estimate_costs(stats, days):
+	scale = DAYS_PER_MONTH / days
+	costs = {
+		'lambda_requests': sum(stats['invocations'].values()) * PRICES['lambda_request'],
+		'lambda_duration': stats['lambda_gb_seconds'] * PRICES['lambda_gb_second'],
+		'api_gateway': stats['api_requests'] * PRICES['api_gateway_request'],
+		'ses': sum(stats['emails'].values()) * PRICES['ses_email'],
+		'sms': stats['calls'].get('sns.Publish', 0) * PRICES['sns_sms'],
+		'scheduler': stats['timer_invocations'] * PRICES['scheduler_invocation']
+	}
+	costs = {name: cost * scale for name, cost in costs.items()}
+	costs['total'] = sum(costs.values())
+	# Only charged if higher throughput is enabled for Parameter Store
+	costs['ssm_higher_throughput'] = sum(count for call, count in stats['calls'].items() if call.startswith('ssm.')) * PRICES['ssm_higher_throughput_call'] * scale
+	return costs
+
+def report(stats, subjects, days, costs, multi_subject=False):
+	scale = DAYS_PER_MONTH / days
+	print(f"Simulated {subjects} subjects for {days} days (per month figures are scaled to {DAYS_PER_MONTH} days)")
+	if multi_subject:
+		print("Every subject is monitored by one multi-subject deployment, so each poller run covers all of them")
+	else:
+		print("Each subject is its own single-person deployment, so the poller runs and reads are per subject (see --multi-subject)")
+	print()
+	print(f"{'handler':<32}{'invocations':>12}{'cold starts':>12}{'per month':>12}")
+	for handler, count in sorted(stats['invocations'].items()):
+		print(f"{handler:<32}{count:>12}{stats['cold_starts'][handler]:>12}{count * scale:>12.0f}")
+	print()
+	print(f"{'remote call':<44}{'count':>12}{'per month':>12}")
+	for call, count in sorted(stats['calls'].items()):
+		print(f"{call:<44}{count:>12}{count * scale:>12.0f}")
+	print()
+	print(f"{'tier':<12}{'emails':>10}{'first':>8}{'delay p50 min':>15}{'p95 min':>10}{'max min':>10}")
+	for label, delays in sorted(stats['escalation_delays'].items()):
+		print(f"{label:<12}{stats['emails'][label]:>10}{len(delays):>8}{percentile(delays, 50):>15.1f}{percentile(delays, 95):>10.1f}{max(delays):>10.1f}")
+	print(f"Verification link clicks: {stats['clicks']['sent']} ({stats['clicks']['accepted']} accepted, {stats['clicks']['rejected']} rejected)")
+	for error, count in stats['errors'].most_common():
+		print(f"Unexpected response x{count}: {error}")
+	print()
+	print("Estimated monthly cost (USD, before the free tier):")
+	for name, cost in costs.items():
+		print(f"  {name:<24}{cost:>12.4f}")
+
+def main():
+	parser = argparse.ArgumentParser(description="Replay check-in histories through the Lambda handlers on a virtual clock")
+	parser.add_argument('--subjects', type=int, default=100, help="number of subjects to generate check-ins for")
+	parser.add_argument('--days', type=float, default=30, help="length of the simulated period")
+	parser.add_argument('--start', type=datetime.datetime.fromisoformat, default=datetime.datetime(2025, 1, 1), help="start of the simulated period")
+	parser.add_argument('--trace', help="JSON lines file of recorded check-ins to replay instead of generating them")
+	parser.add_argument('--multi-subject', action='store_true', help="monitor every subject with one multi-subject deployment rather than one deployment each")
+	parser.add_argument('--absences-per-month', type=float, default=1.0, help="average number of absences (1 to 4 days without check-ins) per subject per month")
+	parser.add_argument('--click-probability', type=float, default=0.5, help="probability that a reminder email's verification link is clicked")
+	parser.add_argument('--click-delay-minutes', type=float, default=45, help="average delay before a verification link is clicked")
+	parser.add_argument('--container-idle-minutes', type=float, default=15, help="idle time after which a Lambda container is replaced")
+	parser.add_argument('--call-latency-ms', type=float, default=25, help="assumed latency of each remote call when estimating the Lambda duration")
+	parser.add_argument('--base-duration-ms', type=float, default=20, help="assumed duration of an invocation excluding remote calls")
+	parser.add_argument('--cold-start-ms', type=float, default=400, help="assumed additional duration of a cold start")
+	parser.add_argument('--workers', type=int, default=os.cpu_count(), help="number of worker processes")
+	parser.add_argument('--seed', type=int, default=0, help="seed for the generated check-ins and clicks")
+	parser.add_argument('--json', action='store_true', help="print the results as JSON")
+	args = parser.parse_args()
+
+	start = args.start
+	end = start + datetime.timedelta(days=args.days)
+	if args.trace:
+		subjects = list(load_trace(args.trace).items())
+		start = min(check_ins[0] for subject_id, check_ins in subjects).replace(hour=0, minute=0, second=0, microsecond=0)
+		end = start + datetime.timedelta(days=args.days)
+	else:
+		subjects = [(f"subject-{index}", None) for index in range(args.subjects)]
+
+	options = {
+		'seed': args.seed,
+		'absences_per_month': args.absences_per_month,
+		'click_probability': args.click_probability,
+		'click_delay_minutes': args.click_delay_minutes,
+		'container_idle_minutes': args.container_idle_minutes,
+		'call_latency_ms': args.call_latency_ms,
+		'base_duration_ms': args.base_duration_ms,
+		'cold_start_ms': args.cold_start_ms
+	}
+
+	if args.multi_subject:
+		# The subjects share one deployment, so they are simulated together in a single worker process
+		with ProcessPoolExecutor(max_workers=1, initializer=initialise_worker, initargs=(MULTI_SUBJECT_ENVIRONMENT,)) as executor:
+			stats = executor.submit(simulate_subjects, subjects, start, end, options).result()
+	else:
+		# Subjects are split into a few chunks per worker, so that the statistics are merged in the workers
+		chunk_count = max(1, min(len(subjects), args.workers * 4))
+		chunks = [subjects[index::chunk_count] for index in range(chunk_count)]
+		with ProcessPoolExecutor(max_workers=args.workers, initializer=initialise_worker) as executor:
+			results = list(executor.map(simulate_chunk, chunks, [start] * chunk_count, [end] * chunk_count, [options] * chunk_count))
+
+		stats = results[0]
+		for result in results[1:]:
+			stats = merge_stats(stats, result)
+	costs = estimate_costs(stats, args.days)
+
+	if args.json:
+		print(json.dumps({
+			'subjects': len(subjects),
+			'multi_subject': args.multi_subject,
+			'days': args.days,
+			'invocations': stats['invocations'],
+			'cold_starts': stats['cold_starts'],
+			'calls': stats['calls'],
+			'emails': stats['emails'],
+			'clicks': stats['clicks'],
+			'escalation_delay_minutes': {
+				label: {'count': len(delays), 'p50': percentile(delays, 50), 'p95': percentile(delays, 95), 'max': max(delays)}
+				for label, delays in stats['escalation_delays'].items()
+			},
+			'errors': stats['errors'],
+			'monthly_cost_usd': costs
+		}, indent=2))
+	else:
+		report(stats, len(subjects), args.days, costs, args.multi_subject)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
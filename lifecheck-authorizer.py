@@ -4,51 +4,136 @@ lifecheck-authorizer.py
 This script is a Lambda function that acts as an authorizer for the Settings API Gateway.
 This allows authentication via Google OAuth that matches the Google account email address
 originally configured as part of deployment of the SAM template.
+
+It provides two handlers:
+- login_handler: the Google OAuth redirect target, which exchanges the authorization code for an
+  ID token, validates it and issues a short-lived HMAC-signed session cookie.
+- lambda_handler: the API Gateway authorizer, which validates the session cookie locally.
 """
 
 import os
+import re
+import time
 import boto3
 import logging
 import json
 import base64
+import hashlib
+import hmac
+import http.cookies
+import threading
 import urllib.request
 import urllib.parse
-import google.auth
-from google.auth.transport.requests import Request
-from google.oauth2 import id_token
 
-ssm = boto3.client('ssm')
+from lifecheck import metrics
+from lifecheck.parameters import ParameterCache
+
+ssm = metrics.instrument(boto3.client('ssm'))
+parameters = ParameterCache(ssm)
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# URLs to Google's public keys for OAuth2 validation and token endpoint
-GOOGLE_PUBLIC_KEYS_URL = "https://www.googleapis.com/oauth2/v3/certs"
+# URLs to Google's public keys (as PEM certificates keyed by key ID) for OAuth2 validation and token endpoint
+GOOGLE_PUBLIC_KEYS_URL = "https://www.googleapis.com/oauth2/v1/certs"
 GOOGLE_TOKEN_ENDPOINT = "https://oauth2.googleapis.com/token"
+GOOGLE_ISSUERS = ["accounts.google.com", "https://accounts.google.com"]
+
+# Google's public keys are cached for the lifetime of the warm container, honouring the max-age of the
+# Cache-Control response header. Keys are refreshed in the background shortly before they expire, and
+# synchronously if they have expired or a token is signed with an unknown key ID.
+DEFAULT_KEYS_MAX_AGE_SECONDS = 3600
+KEYS_REFRESH_MARGIN_SECONDS = 300
+KEYS_MIN_REFRESH_INTERVAL_SECONDS = 60
+google_public_keys = {"keys": {}, "fetched_at": None, "expires_at": 0.0, "refreshing": False}
+google_public_keys_lock = threading.Lock()
 
+# The signed session cookie issued after a successful Google login. Requests carrying a valid session
+# cookie are authorized locally without calling Google, and API Gateway caches the resulting policy
+# against the Cookie header so that repeat requests do not invoke the authorizer at all.
+SESSION_COOKIE_NAME = "lifecheck_session"
+SESSION_DURATION_SECONDS = 3600
+
+@metrics.per_invocation('lifecheck-authorizer')
+@parameters.per_invocation_stats
 def lambda_handler(event, context):
-	logger.info(f"Starting lambda authorisation - retrieving Google account/client details")
+	logger.info(f"Starting lambda authorisation - validating session cookie")
+
+	params = get_google_parameters()
+
+	# Validate the signed session cookie issued by the login handler
+	session = get_cookie(event.get('headers'), SESSION_COOKIE_NAME)
+	email = validate_session(session, params['google_client_secret'])
+
+	# Check if the session belongs to the email you expect
+	if not email or email != params['google_account_email']:
+		logger.error(f"Missing or invalid session cookie")
+		raise Exception("Unauthorized")
+
+	# Create and return an IAM policy to allow the request
+	return generate_policy(email, 'Allow', event['methodArn'])
+
+# Handler for the Google OAuth redirect: exchanges the authorization code and issues the session cookie
+@metrics.per_invocation('lifecheck-login')
+@parameters.per_invocation_stats
+def login_handler(event, context):
+	logger.info(f"Starting login - retrieving Google account/client details")
+
+	params = get_google_parameters()
+
+	# Determine the redirect URI
+	base_url = f"https://{event['requestContext']['apiId']}.execute-api.{os.environ.get('REGION')}.amazonaws.com/Prod"
+	redirect_uri = f"{base_url}/login"
+	logger.info(f"redirect_uri='{redirect_uri}'")
+
+	logger.info(f"Extracting Google authorization code")
+
+	try:
+		# Extract the Google Authorization Code from query parameters
+		code = (event.get('queryStringParameters') or {}).get('code')
+		if not code:
+			raise Exception("Missing Google authorization code")
+
+		# Exchange the authorization code for an ID token
+		token = exchange_code_for_token(code, params['google_client_id'], params['google_client_secret'], redirect_uri)
+
+		# Validate the ID token using Google's public keys
+		user_data = validate_token(token, params['google_client_id'])
+
+		# Check if the user's email is the one you expect
+		if user_data.get('email') != params['google_account_email']:
+			raise Exception("Unauthorized user")
+	except Exception as e:
+		logger.error(f"Login failed: {str(e)}")
+		return {
+			"statusCode": 401,
+			"body": "Unauthorized"
+		}
 
+	# Issue the session cookie and redirect to the settings application
+	session = create_session(user_data['email'], params['google_client_secret'])
+	return {
+		"statusCode": 302,
+		"headers": {
+			"Location": f"{base_url}/settings",
+			"Set-Cookie": f"{SESSION_COOKIE_NAME}={session}; Max-Age={SESSION_DURATION_SECONDS}; Path=/Prod; Secure; HttpOnly; SameSite=Lax"
+		},
+		"body": ""
+	}
+
+# Function to retrieve the Google account/client details from Parameter Store (cached in the warm container)
+def get_google_parameters():
 	# Retrieve the environment variables containing google account/client parameter names
 	google_account_email_param = os.environ.get('GOOGLE_ACCOUNT_EMAIL_PARAM')
 	google_client_id_param = os.environ.get('GOOGLE_CLIENT_ID_PARAM')
 	google_client_secret_param = os.environ.get('GOOGLE_CLIENT_SECRET_PARAM')
 
-	# Determine the redirect URI
-	redirect_uri = f"https://{event['requestContext']['apiId']}.execute-api.{os.environ.get('REGION')}.amazonaws.com/Prod/settings"
-	logger.info(f"redirect_uri='{redirect_uri}'")
-
 	# Retrieve parameter values from Parameter Store
 	try:
-		response = ssm.get_parameters(
-			Names=[
-				google_account_email_param, 
-				google_client_id_param, 
-				google_client_secret_param
-			],
-			WithDecryption=False
-		)
-
-		params = {param['Name']: param['Value'] for param in response['Parameters'] if param is not None}
+		params = parameters.get_many([
+			google_account_email_param,
+			google_client_id_param,
+			google_client_secret_param
+		])
 		google_account_email = params.get(google_account_email_param)
 		google_client_id = params.get(google_client_id_param)
 		google_client_secret = params.get(google_client_secret_param)
@@ -60,25 +145,55 @@ def lambda_handler(event, context):
 		logger.error(f"Error retrieving parameters from Parameter Store: {str(e)}")
 		raise Exception(f"Error retrieving parameters from Parameter Store")
 
-	logger.info(f"Extracting Google authorization code")
+	return {
+		'google_account_email': google_account_email,
+		'google_client_id': google_client_id,
+		'google_client_secret': google_client_secret
+	}
 
-	# Extract the Google Authorization Code from query parameters
-	code = event['queryStringParameters'].get('code')
-	if not code:
-		raise Exception("Missing Google authorization code")
-	
-	# Exchange the authorization code for an ID token
-	token = exchange_code_for_token(code, google_client_id, google_client_secret, redirect_uri)
-	
-	# Validate the ID token using Google's public keys
-	user_data = validate_token(token, google_client_id)
-	
-	# Check if the user's email is the one you expect
-	if user_data.get('email') != google_account_email:
-		raise Exception("Unauthorized user")
+# Function to extract a cookie value from the request headers
+def get_cookie(headers, name):
+	for header, value in (headers or {}).items():
+		if header.lower() == 'cookie':
+			cookies = http.cookies.SimpleCookie()
+			try:
+				cookies.load(value)
+			except http.cookies.CookieError:
+				return None
+			if name in cookies:
+				return cookies[name].value
+	return None
 
-	# Create and return an IAM policy to allow the request
-	return generate_policy(user_data['email'], 'Allow', event['methodArn'])
+# Function to derive the session signing key from the Google client secret (so that rotating the
+# client secret also invalidates all sessions)
+def session_key(client_secret):
+	return hmac.new(client_secret.encode("utf-8"), b"lifecheck-session", hashlib.sha256).digest()
+
+# Function to create a session value of the form <base64 email>.<expiry>.<signature>
+def create_session(email, client_secret):
+	expiry = int(time.time()) + SESSION_DURATION_SECONDS
+	payload = f"{base64.urlsafe_b64encode(email.encode('utf-8')).decode('ascii')}.{expiry}"
+	signature = hmac.new(session_key(client_secret), payload.encode("ascii"), hashlib.sha256).hexdigest()
+	return f"{payload}.{signature}"
+
+# Function to validate a session value, returning the email address if the session is valid
+def validate_session(session, client_secret):
+	if not session:
+		return None
+	try:
+		encoded_email, expiry, signature = session.split('.')
+		payload = f"{encoded_email}.{expiry}"
+		expected_signature = hmac.new(session_key(client_secret), payload.encode("ascii"), hashlib.sha256).hexdigest()
+		if not hmac.compare_digest(signature, expected_signature):
+			logger.error(f"Session signature is invalid")
+			return None
+		if int(expiry) < time.time():
+			logger.error(f"Session has expired")
+			return None
+		return base64.urlsafe_b64decode(encoded_email).decode('utf-8')
+	except (ValueError, UnicodeError):
+		logger.error(f"Session is malformed")
+		return None
 
 # Function to exchange the authorization code (provided by Google OAuth) for an ID token
 def exchange_code_for_token(code, client_id, client_secret, redirect_uri):
@@ -96,36 +211,89 @@ def exchange_code_for_token(code, client_id, client_secret, redirect_uri):
 	# Send the request to Google to exchange the code for a token
 	data = urllib.parse.urlencode(data).encode("utf-8")
 	request = urllib.request.Request(GOOGLE_TOKEN_ENDPOINT, data)
-	response = urllib.request.urlopen(request)
-	response_data = json.load(response)
+	with metrics.dependency('google.token'):
+		response = urllib.request.urlopen(request)
+		response_data = json.load(response)
 	return response_data['id_token']
 
+# Function to download Google's public keys and store them in the module-level cache
+def fetch_google_public_keys():
+	logger.info(f"Retrieving Google public keys from '{GOOGLE_PUBLIC_KEYS_URL}'")
+	with metrics.dependency('google.certs'):
+		response = urllib.request.urlopen(GOOGLE_PUBLIC_KEYS_URL)
+		keys = json.load(response)
+
+	max_age = DEFAULT_KEYS_MAX_AGE_SECONDS
+	match = re.search(r"max-age=(\d+)", response.headers.get("Cache-Control", ""))
+	if match:
+		max_age = int(match.group(1))
+
+	with google_public_keys_lock:
+		google_public_keys["keys"] = keys
+		google_public_keys["fetched_at"] = time.monotonic()
+		google_public_keys["expires_at"] = google_public_keys["fetched_at"] + max_age
+	logger.info(f"Cached {len(keys)} Google public keys for {max_age} seconds")
+	return keys
+
+def refresh_google_public_keys_in_background():
+	try:
+		fetch_google_public_keys()
+	except Exception as e:
+		logger.error(f"Error refreshing Google public keys: {str(e)}")
+	finally:
+		with google_public_keys_lock:
+			google_public_keys["refreshing"] = False
+
+# Function to retrieve a Google public key by key ID, only downloading the keys when necessary
+def get_google_public_key(key_id):
+	now = time.monotonic()
+	with google_public_keys_lock:
+		keys = google_public_keys["keys"]
+		expires_at = google_public_keys["expires_at"]
+		# Unknown key IDs only trigger a download if the keys were not just fetched, so that tokens with
+		# invalid key IDs cannot force a download on every request
+		fetched_at = google_public_keys["fetched_at"]
+		recently_fetched = fetched_at is not None and now - fetched_at < KEYS_MIN_REFRESH_INTERVAL_SECONDS
+		# The cached keys have expired or Google has rotated its keys
+		fetch_now = now >= expires_at or (key_id not in keys and not recently_fetched)
+		# The flag is checked and set under the lock, so that only one background refresh is started
+		refresh_ahead = not fetch_now and expires_at - now < KEYS_REFRESH_MARGIN_SECONDS and not google_public_keys["refreshing"]
+		if refresh_ahead:
+			google_public_keys["refreshing"] = True
+
+	if fetch_now:
+		keys = fetch_google_public_keys()
+	elif refresh_ahead:
+		# The cached keys are still valid but will expire soon so refresh them without blocking the request
+		threading.Thread(target=refresh_google_public_keys_in_background, daemon=True).start()
+
+	return keys.get(key_id)
+
 # Function to validate the ID token using Google's public keys
 def validate_token(token, client_id):
 	logger.info(f"Validating token '{token}'")
 
-	# Retrieve Google's public keys
-	response = urllib.request.urlopen(GOOGLE_PUBLIC_KEYS_URL)
-	keys = json.load(response)
-	
-	# Decode and validate the ID token
-	header = json.loads(base64.b64decode(token.split('.')[0] + '=='))
+	# Decode the ID token header to determine which key it was signed with
+	header_segment = token.split('.')[0]
+	header = json.loads(base64.urlsafe_b64decode(header_segment + '=' * (-len(header_segment) % 4)))
 	key_id = header['kid']
 
-	# Find the corresponding public key from the keys
-	public_key = None
-	for key in keys['keys']:
-		if key['kid'] == key_id:
-			public_key = key
-			break
-
+	# Find the corresponding public key from the cached keys
+	public_key = get_google_public_key(key_id)
 	if not public_key:
 		raise Exception("Public key not found")
 
+	# google-auth is only needed when logging in, so it is imported here rather than at module load to keep it
+	# out of the cold start of the authorizer (it is provided to the login function by the GoogleAuthLayer)
+	from google.auth import jwt
+
 	# Use the public key to validate the ID token
 	try:
-		# Verify the token with the public key
-		credentials = id_token.verify_oauth2_token(token, Request(), audience=client_id)
+		# Verify the token signature, expiry and audience locally with the public key
+		with metrics.phase('validate_token'):
+			credentials = jwt.decode(token, certs=public_key, audience=client_id)
+		if credentials.get('iss') not in GOOGLE_ISSUERS:
+			raise ValueError(f"Wrong issuer '{credentials.get('iss')}'")
 		# The token is valid so return the user data
 		return credentials
 	except Exception as e:
@@ -133,17 +301,16 @@ def validate_token(token, client_id):
 
 # Function to generate an IAM policy for the API Gateway request
 def generate_policy(principal_id, effect, resource):
-	# Derive the other method path (if resource is GET, create POST and vice versa)
-	if "/GET" in resource:
-		resource_post = resource.replace("/GET", "/POST")
-		resource_get = resource
-	elif "/POST" in resource:
-		resource_get = resource.replace("/POST", "/GET")
-		resource_post = resource
-	else:
-		raise ValueError("Resource path must include either '/GET' or '/POST'")
-
-	logger.info(f"Generating IAM policy effect '{effect}' for principal '{principal_id}' and resources '{resource_get}' and '{resource_post}'")
+	# API Gateway caches the policy against the session cookie rather than the method being requested,
+	# so the policy must cover every method and path of the stage
+	# (resource is of the form arn:aws:execute-api:<region>:<account>:<api id>/<stage>/<method>/<path>)
+	api_arn, separator, method_path = resource.partition('/')
+	stage = method_path.split('/')[0]
+	if not separator or not stage:
+		raise ValueError("Resource must be an API Gateway method ARN")
+	resource_stage = f"{api_arn}/{stage}/*"
+
+	logger.info(f"Generating IAM policy effect '{effect}' for principal '{principal_id}' and resource '{resource_stage}'")
 
 	policy = {
 		"principalId": principal_id,
@@ -154,8 +321,7 @@ def generate_policy(principal_id, effect, resource):
 					"Action": "execute-api:Invoke",
 					"Effect": effect,
 					"Resource": [
-							resource_get,
-							resource_post
+							resource_stage
 					]
 				}
 			]
@@ -1,121 +1,189 @@
 """
 lifecheck-notification.py
 
-This script is a Lambda function that periodically checks the last verification time 
-stored in AWS Systems Manager Parameter Store and sends notification emails if 
+This script is a Lambda function that periodically checks the last verification time
+stored in AWS Systems Manager Parameter Store and sends notification emails if
 certain time thresholds have been exceeded.
 
-It currently implements the following notification logic:
-- If more than 30 hours have elapsed since the last verification, an email is sent to the 
-  primary contact, including a verification link with a temporary token.
+It currently implements the following notification logic (the default escalation tiers, which
+can be changed with the ESCALATION_TIERS environment variable - see lifecheck/escalation.py):
+- If more than 30 hours have elapsed since the last verification, an email is sent to the
+  primary contact, including a verification link with a signed token (resent hourly).
+- If more than 40 hours have elapsed, an email is sent once to the secondary contact.
+- If more than 48 hours have elapsed, an email and a text message (SMS) are sent once to the
+  emergency contact.
+
+The email and text messages of every due tier are sent at the same time, and a tier counts as
+notified once any of its channels succeeds (see lifecheck/channels.py).
+
+Every tier that is overdue is notified in the same run, so if the poller runs late (e.g. after
+50 hours) the primary, secondary and emergency contacts are all notified at once.
+
+If the SUBJECTS_PATH environment variable is set, the poller runs in multi-subject mode: the
+parameters of every subject stored under that path are loaded in bulk, the thresholds are only
+evaluated for the subjects whose stored next_action_at has passed (or is not stored), and
+notifications are only sent for the subjects that are due.
+
+If the SES_TEMPLATE_PREFIX environment variable is set, the emails are sent using SES stored
+templates, with the emails of each tier sent in bulk (see lifecheck/templates.py).
+
+The time the next tier becomes due is stored as next_action_at whenever the verification or
+notification state changes (or a run finds it out of date), so most runs only read that value
+before deciding that nothing is due.
+
+After each run the poller arms a one-shot timer for the time the next tier becomes due (see
+lifecheck/schedule.py), so that notifications are sent as soon as a threshold is crossed. The
+fixed EventBridge schedule is kept as an infrequent fallback.
+
+If the OUTBOX_QUEUE_URL environment variable is set, emails that SES fails to send are queued in
+the outbox (see lifecheck/outbox.py) and retried within seconds by lifecheck-outbox.py, which
+records the notification once the email has been sent.
 """
 
 import os
 import boto3
 import datetime
-import secrets
 import logging
-
-ssm = boto3.client('ssm')
-ses = boto3.client('ses')
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from lifecheck import channels
+from lifecheck import escalation
+from lifecheck import metrics
+from lifecheck import outbox
+from lifecheck import schedule
+from lifecheck import subjects
+from lifecheck import tokens
+from lifecheck.identities import VerifiedIdentityIndex
+from lifecheck.parameters import ParameterCache
+from lifecheck.settings import fetch_settings
+from lifecheck.state import state_from_environment, subjects_from_environment
+from lifecheck.templates import template_store_from_environment
+
+ssm = metrics.instrument(boto3.client('ssm'))
+ses = metrics.instrument(boto3.client('ses'))
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-PRIMARY_CONTACT_THRESHOLD_HOURS = 30
-SECONDARY_CONTACT_THRESHOLD_HOURS = 40
-EMERGENCY_CONTACT_THRESHOLD_HOURS = 48
-SECONDS_PER_HOUR = 3600.0
-TOKEN_BYTES = 32
+MAX_NOTIFICATION_WORKERS = 8
+
+# The time kept back from the channel timeouts for recording the notifications and arming the timers, so that a
+# slow channel cannot use up the rest of the invocation
+RECORD_RESERVE_SECONDS = 10
+
+# Parameters that are updated by other functions are always read from Parameter Store, while the
+# contact details and sending address are cached in the warm container
+parameters = ParameterCache(ssm, ttls={os.environ.get(name): 0 for name in [
+	'STATE_DOCUMENT_PARAM',
+	'NEXT_ACTION_AT_PARAM',
+	'LAST_VERIFICATION_PARAM',
+	'PRIMARY_CONTACT_DATETIME_PARAM',
+	'SECONDARY_CONTACT_DATETIME_PARAM',
+	'EMERGENCY_CONTACT_DATETIME_PARAM',
+	'IDENTITIES_VERSION_PARAM'
+]})
+
+# The recipients that are known to be verified in SES are cached in the warm container
+verified_identities = VerifiedIdentityIndex(ses)
 
+# The SES templates used to send the emails of each tier in bulk (None if SES_TEMPLATE_PREFIX is not set)
+templates = template_store_from_environment(ses)
+
+# The outbox that emails are queued in if they cannot be sent (None if OUTBOX_QUEUE_URL is not set)
+notification_outbox = outbox.outbox_from_environment(lambda: metrics.instrument(boto3.client('sqs')))
+
+# The SNS client used to send text messages (created on first use)
+sns = None
+
+# The scheduler used to arm the notification timers (created on the first invocation, as the target is this
+# function's own ARN)
+scheduler = None
+
+# The state fields that are used by the poller
+NOTIFICATION_FIELDS = ['last_verification'] + escalation.tier_fields()
+
+@metrics.per_invocation('lifecheck-notification')
+@parameters.per_invocation_stats
 def lambda_handler(event, context):
 
 	# Retrieve the environment variables containing parameter names and the email verification URL
-	last_verification_param = os.environ.get('LAST_VERIFICATION_PARAM')
 	google_account_email_param = os.environ.get('GOOGLE_ACCOUNT_EMAIL_PARAM')
-	primary_contact_email_param = os.environ.get('PRIMARY_CONTACT_EMAIL_PARAM')
-	primary_contact_message_param = os.environ.get('PRIMARY_CONTACT_MESSAGE_PARAM')
-	primary_contact_datetime_param = os.environ.get('PRIMARY_CONTACT_DATETIME_PARAM')
-	secondary_contact_email_param = os.environ.get('SECONDARY_CONTACT_EMAIL_PARAM')
-	secondary_contact_message_param = os.environ.get('SECONDARY_CONTACT_MESSAGE_PARAM')
-	secondary_contact_datetime_param = os.environ.get('SECONDARY_CONTACT_DATETIME_PARAM')
-	emergency_contact_email_param = os.environ.get('EMERGENCY_CONTACT_EMAIL_PARAM')
-	emergency_contact_message_param = os.environ.get('EMERGENCY_CONTACT_MESSAGE_PARAM')
-	emergency_contact_datetime_param = os.environ.get('EMERGENCY_CONTACT_DATETIME_PARAM')
-	temp_token_param = os.environ.get('TEMP_TOKEN_PARAM')
-	temp_token_generation_time_param = os.environ.get('TEMP_TOKEN_GENERATION_TIME_PARAM')
 	email_verification_api_gateway_url = os.environ.get('EMAIL_VERIFICATION_API_GATEWAY_URL')
+	subjects_path = os.environ.get('SUBJECTS_PATH')
+
+	if subjects_path:
+		return notify_subjects(subjects_path, google_account_email_param, email_verification_api_gateway_url, event, get_scheduler(context), context)
+
+	# Retrieve the state and sending address from Parameter Store
+	state = state_from_environment(parameters)
+
+	# Each tier must be able to record when it was notified, otherwise it would be notified on every run
+	missing_fields = state.missing_fields(escalation.tier_datetime_fields())
+	if missing_fields:
+		logger.error(f"No parameters are configured for {missing_fields} - additional escalation tiers require STATE_DOCUMENT_PARAM or SUBJECTS_PATH")
+		return {
+			"statusCode": 500,
+			"body": "Error: Missing escalation tier parameters"
+		}
 
-	# Retrieve parameter values from Parameter Store
-	last_verification = None
 	try:
-		response = ssm.get_parameter(Name=last_verification_param, WithDecryption=False)
-		last_verification_str = response['Parameter']['Value']
+		# Most runs have nothing to do, which can be decided from the stored next action time alone
+		next_action_at = state.load(['next_action_at']).get('next_action_at')
+		if next_action_at:
+			next_action_time = datetime.datetime.fromisoformat(next_action_at)
+			current_time = datetime.datetime.now()
+			if current_time < next_action_time:
+				logger.info(f"No action needed until next_action_at='{next_action_at}'")
+				# The timer is only moved if it was armed for a different deadline (e.g. a check-in failed to re-arm
+				# it) or this is a run of the fixed schedule
+				if not schedule.is_armed_for(event, next_action_time, current_time):
+					schedule.arm_deadline(get_scheduler(context), next_action_time, current_time)
+				return {
+					"statusCode": 200,
+					"body": "No action needed at this time"
+				}
+
+		# The state and the sending address are read concurrently
+		with metrics.phase('load'):
+			settings = fetch_settings(
+				state=lambda: state.load(NOTIFICATION_FIELDS),
+				google_account_email=lambda: parameters.get(google_account_email_param)
+			)
+		values = settings.state
+
+		last_verification_str = values.get('last_verification')
 		if last_verification_str:
 			last_verification = datetime.datetime.fromisoformat(last_verification_str)
 			logger.info(f"Reading last_verification parameter value of '{last_verification}' from Parameter Store")
-	except ssm.exceptions.ParameterNotFound:
-		# Default last_verification to current datetime if it has never been set before
-		if not last_verification_str:
+		else:
+			# Default last_verification to current datetime if it has never been set before
 			last_verification = datetime.datetime.now()
 			logger.info(f"The last_verification parameter is not set - setting it now to '{last_verification}'")
 			# Store the default value in Parameter Store
-			ssm.put_parameter(Name=last_verification_param, Value=last_verification.isoformat(), Type='String', Overwrite=True)
+			values['last_verification'] = last_verification.isoformat()
+			next_action_at = escalation.next_action_at(values, last_verification)
+			state.save({'last_verification': values['last_verification'], 'next_action_at': next_action_at})
 
-	google_account_email = None
-	try:
-		response = ssm.get_parameter(Name=google_account_email_param, WithDecryption=False)
-		google_account_email = response['Parameter']['Value']
-		logger.info(f"Reading google_account_email parameter value of '{google_account_email}' from Parameter Store")
-	except ssm.exceptions.ParameterNotFound:
+		google_account_email = settings.google_account_email
 		if not google_account_email:
 			logger.error(f"The google_account_email parameter is not set")
 
-	try:
-		response = ssm.get_parameters(
-			Names=[
-				primary_contact_email_param,
-				primary_contact_message_param,
-				primary_contact_datetime_param,
-				secondary_contact_email_param,
-				secondary_contact_message_param,
-				secondary_contact_datetime_param,
-				emergency_contact_email_param,
-				emergency_contact_message_param,
-				emergency_contact_datetime_param
-			],
-			WithDecryption=False
-		)
-
-		params = {param['Name']: param['Value'] for param in response['Parameters'] if param is not None}
-
-		primary_contact_email = params.get(primary_contact_email_param)
-		primary_contact_message = params.get(primary_contact_message_param)
-		primary_contact_datetime_str = params.get(primary_contact_datetime_param)
-		secondary_contact_email = params.get(secondary_contact_email_param)
-		secondary_contact_message = params.get(secondary_contact_message_param)
-		secondary_contact_datetime_str = params.get(secondary_contact_datetime_param)
-		emergency_contact_email = params.get(emergency_contact_email_param)
-		emergency_contact_message = params.get(emergency_contact_message_param)
-		emergency_contact_datetime_str = params.get(emergency_contact_datetime_param)
-
-		if not google_account_email or not primary_contact_email or not primary_contact_message or not email_verification_api_gateway_url:
-			logger.error(f"Missing required parameters: google_account_email='{google_account_email}' primary_contact_email='{primary_contact_email}' primary_contact_message='{primary_contact_message}' email_verification_api_gateway_url='{email_verification_api_gateway_url}'")
+		# The contact of the first tier (usually yourself) must always be configured
+		first_contact = escalation.TIERS[0]['contact']
+		first_contact_email = values.get(f"{first_contact}_email")
+		first_contact_message = values.get(f"{first_contact}_message")
+
+		if not google_account_email or not first_contact_email or not first_contact_message or not email_verification_api_gateway_url:
+			logger.error(f"Missing required parameters: google_account_email='{google_account_email}' {first_contact}_email='{first_contact_email}' {first_contact}_message='{first_contact_message}' email_verification_api_gateway_url='{email_verification_api_gateway_url}'")
 			return {
 				"statusCode": 500,
 				"body": "Error: Missing required parameters"
 			}
 
-		primary_contact_datetime = None
-		if primary_contact_datetime_str:
-				primary_contact_datetime = datetime.datetime.fromisoformat(primary_contact_datetime_str)
-
-		secondary_contact_datetime = None
-		if secondary_contact_datetime_str:
-				secondary_contact_datetime = datetime.datetime.fromisoformat(secondary_contact_datetime_str)
-
-		emergency_contact_datetime = None
-		if emergency_contact_datetime_str:
-				emergency_contact_datetime = datetime.datetime.fromisoformat(emergency_contact_datetime_str)
+		# Check elapsed time and the time since each contact was notified
+		current_time = datetime.datetime.now()
+		elapsed_hours = (current_time - last_verification).total_seconds() / escalation.SECONDS_PER_HOUR
+		contact_ages_hours = [escalation.hours_since(current_time, values.get(field)) for field in escalation.tier_datetime_fields()]
 	except Exception as e:
 		logger.error(f"Error retrieving parameters from Parameter Store: {str(e)}")
 		return {
@@ -123,149 +191,431 @@ def lambda_handler(event, context):
 			"body": f"Error retrieving parameters from Parameter Store: {str(e)}"
 		}
 
-	# Check elapsed time and send emails if conditions are met
-	current_time = datetime.datetime.now()
-	elapsed_hours = (current_time - last_verification).total_seconds() / SECONDS_PER_HOUR
-
 	logger.info(f"Checking elapsed time: current_time='{current_time}' elapsed_hours='{elapsed_hours}'")
-	if elapsed_hours > PRIMARY_CONTACT_THRESHOLD_HOURS and elapsed_hours <= SECONDARY_CONTACT_THRESHOLD_HOURS:
-		logger.info(f"Checking last primary contact time: primary_contact_datetime='{primary_contact_datetime}'")
-		# Check if primary contact email has already been sent within the last hour
-		if not primary_contact_datetime or current_time - primary_contact_datetime > datetime.timedelta(hours=1):
-			logger.info(f"Attempting to send message to the primary contact...")
-			# Generate a temporary token and store it in Parameter Store
-			temp_token = secrets.token_urlsafe(TOKEN_BYTES)
-			temp_token_generation_time = current_time.isoformat()
-
-			ssm.put_parameter(Name=temp_token_param, Value=temp_token, Type='String', Overwrite=True)
-			ssm.put_parameter(Name=temp_token_generation_time_param, Value=temp_token_generation_time, Type='String', Overwrite=True)
-			logger.info(f"Temporary verification token has been generated")
-
-			# Construct the verification URL
-			verification_url = f"{email_verification_api_gateway_url}?token={temp_token}"
-
-			# Include the verification URL in the email message
-			email_body_with_url = f"{primary_contact_message}\n\nVerification URL: {verification_url}"
-
-			# Send the primary contact email
+	logger.info(f"Checking last contact times: " + " ".join(f"{field}='{values.get(field)}'" for field in escalation.tier_datetime_fields()))
+	due = escalation.due_tiers(elapsed_hours, contact_ages_hours)
+
+	if due:
+		response = notify_tiers(due, state, values, google_account_email, email_verification_api_gateway_url, current_time, context=context)
+	else:
+		logger.info(f"No action needed at this time")
+		response = {
+			"statusCode": 200,
+			"body": "No action needed at this time"
+		}
+		# Store the next action time if it was missing or out of date, so that the next run can return early
+		try:
+			new_next_action_at = escalation.next_action_at(values, current_time)
+			if new_next_action_at != next_action_at:
+				state.save({'next_action_at': new_next_action_at})
+		except Exception as e:
+			logger.error(f"Error saving next_action_at: {str(e)}")
+
+	# Arm the timer for the next time a notification will be due
+	schedule.arm_next_run(get_scheduler(context), values, current_time)
+	return response
+
+# Function to return the scheduler used to arm the notification timers (None if timers are not enabled)
+def get_scheduler(context):
+	global scheduler
+	if scheduler is None and os.environ.get('NOTIFICATION_SCHEDULE_GROUP'):
+		scheduler = schedule.scheduler_from_environment(metrics.instrument(boto3.client('scheduler')), getattr(context, 'invoked_function_arn', None))
+	return scheduler
+
+# Function to return the longest time in seconds to wait for the channels given the time left in the invocation,
+# or None if it is not known
+def send_budget(context):
+	get_remaining_time = getattr(context, 'get_remaining_time_in_millis', None)
+	if get_remaining_time is None:
+		return None
+	return max(0, get_remaining_time() / 1000 - RECORD_RESERVE_SECONDS)
+
+# Function to send the notifications of the due tiers and record the time each contact was notified
+# due: the indexes of the due tiers in escalation.TIERS
+# state: the state store of the person being monitored
+# values: the contact email addresses and messages (updated with the changes once the emails have been sent)
+def notify_tiers(due, state, values, google_account_email, email_verification_api_gateway_url, current_time, subject_id=None, context=None):
+	check_identities_version()
+	messages = prepare_messages(due, values, email_verification_api_gateway_url, current_time, subject_id)
+	with metrics.phase('send'):
+		send_messages(messages, google_account_email, send_budget(context))
+	with metrics.phase('record'):
+		return record_messages(messages, state, values, current_time)
+
+# Function to build the notification emails of the due tiers of a subject. Each message records the state changes
+# to save once it has been sent.
+def prepare_messages(due, values, email_verification_api_gateway_url, current_time, subject_id=None):
+	messages = []
+	verification_url = None
+	token_error = None
+
+	for index in due:
+		tier = escalation.TIERS[index]
+		contact = tier['contact']
+
+		if tier['verification_link'] and verification_url is None and token_error is None:
+			# The token is signed and carries the subject and expiry (see lifecheck/tokens.py), so nothing needs
+			# to be stored for it
 			try:
-				# First confirm that the destination email address is verified in SES
-				verified_identities = ses.list_verified_email_addresses()['VerifiedEmailAddresses']
-				if primary_contact_email not in verified_identities:
-					logger.error(f"Error sending email: Destination email address {primary_contact_email} is not verified in SES")
-					return {
-						"statusCode": 500,
-						"body": f"Error: Destination email address {primary_contact_email} is not verified in SES"
-					}
-
-				ses.send_email(
-					Source=google_account_email,
-					Destination={'ToAddresses': [primary_contact_email]},
-					Message={
-						'Subject': {'Data': 'Lifecheck Verification Timeout'},
-						'Body': {'Text': {'Data': email_body_with_url}}
-					}
-				)
-
-				# Update the time the primary contact was last contacted
-				ssm.put_parameter(Name=primary_contact_datetime_param, Value=current_time.isoformat(), Type='String', Overwrite=True)
-
-				logger.info(f"Primary contact email sent successfully to '{primary_contact_email}'")
-				return {
-					"statusCode": 200,
-					"body": "Primary contact email sent successfully"
-				}
-
+				keyring = tokens.load_keyring(parameters, os.environ.get('TOKEN_KEYS_PARAM'), create=True)
+				token = tokens.mint(keyring, subject_id, current_time + datetime.timedelta(hours=tokens.TOKEN_VALID_HOURS))
+				verification_url = f"{email_verification_api_gateway_url}?token={token}"
+				logger.info(f"Verification token has been generated")
 			except Exception as e:
-				logger.error(f"Error sending email: {str(e)}")
-				return {
-					"statusCode": 500,
-					"body": f"Error sending email: {str(e)}"
-				}
-	elif elapsed_hours > SECONDARY_CONTACT_THRESHOLD_HOURS and elapsed_hours <= EMERGENCY_CONTACT_THRESHOLD_HOURS:
-		logger.info(f"Checking last secondary contact time: secondary_contact_datetime='{secondary_contact_datetime}'")
-		# Check if secondary contact email has already been sent
-		if not secondary_contact_datetime:
-			logger.info(f"Attempting to send message to the secondary contact...")
+				token_error = f"Error generating the verification token: {str(e)}"
+
+		messages.append({
+			"subject_id": subject_id,
+			"key": outbox.idempotency_key(subject_id, contact, values.get('last_verification'), values.get(f"{contact}_datetime")),
+			"tier": tier,
+			"email": values.get(f"{contact}_email"),
+			"phone": values.get(f"{contact}_phone"),
+			"message": values.get(f"{contact}_message"),
+			"verification_url": verification_url if tier['verification_link'] else None,
+			"changes": {f"{contact}_datetime": current_time.isoformat()},
+			"error": token_error if tier['verification_link'] else None,
+			"last_verification": values.get('last_verification'),
+			"previous_notification": values.get(f"{contact}_datetime")
+		})
+	return messages
+
+# Function to send the notifications of the due tiers over each tier's channels, setting the error of each message
+# that could not be delivered by any channel. Every email and text message is sent concurrently (see
+# lifecheck/channels.py). The emails of each tier are sent in bulk if SES templates are enabled, otherwise each
+# email is sent separately.
+# budget: if provided, the longest time in seconds to wait for any channel (see channels.dispatch())
+def send_messages(messages, google_account_email, budget=None):
+	emails = []
+	texts = []
+	for message in messages:
+		label = message['tier']['label']
+		message['channel_errors'] = {}
+		if message['error']:
+			continue
+		elif not message['message']:
+			message['error'] = f"The {label.lower()} contact message is not set"
+			continue
+
+		if 'email' in message['tier']['channels']:
+			if not message['email']:
+				message['channel_errors']['email'] = f"The {label.lower()} contact email address is not set"
+			# First confirm that the destination email address is verified in SES
+			elif not verified_identities.is_verified(message['email']):
+				message['channel_errors']['email'] = f"Destination email address {message['email']} is not verified in SES"
+			else:
+				emails.append(message)
+		if 'sms' in message['tier']['channels']:
+			if not message['phone']:
+				message['channel_errors']['sms'] = f"The {label.lower()} contact phone number is not set"
+			else:
+				texts.append(message)
+		logger.info(f"Attempting to send message to the {label.lower()} contact...")
+
+	deliveries = []
+	if templates is not None:
+		tiers = {}
+		for message in emails:
+			tiers.setdefault(message['tier']['contact'], []).append(message)
+		deliveries += [('email', tier_messages, functools.partial(send_templated_messages, tier_messages, google_account_email)) for tier_messages in tiers.values()]
+	else:
+		deliveries += [('email', [message], functools.partial(send_message, message, google_account_email)) for message in emails]
+	deliveries += [('sms', [message], functools.partial(send_text, message)) for message in texts]
+
+	for (channel, recipients, send), (errors, outcome) in zip(deliveries, channels.dispatch(deliveries, budget=budget)):
+		for message, error in zip(recipients, errors):
+			message['channel_errors'][channel] = error
+			# Errors from SES (e.g. throttling) may be transient, so the email can be retried. An email that timed out
+			# may still be sent by SES, so it is not queued, which could deliver it twice.
+			if error and outcome == channels.FAILED and channel == 'email':
+				message['retry'] = True
+
+	# A tier is delivered once any of its channels succeeds
+	for message in messages:
+		if message['error']:
+			continue
+		message['channels'] = [channel for channel, error in message['channel_errors'].items() if error is None]
+		failures = {channel: error for channel, error in message['channel_errors'].items() if error is not None}
+		if not message['channels']:
+			message['error'] = next(iter(failures.values())) if len(failures) == 1 else "; ".join(f"{channel}: {error}" for channel, error in failures.items())
+		elif failures:
+			logger.warning(f"The {message['tier']['label'].lower()} contact was notified by {' and '.join(message['channels'])}, but not by " + " or ".join(f"{channel} ({error})" for channel, error in failures.items()))
+
+	queue_failed_messages(messages, google_account_email)
+
+	for message in messages:
+		label = message['tier']['label']
+		if message.get('queued'):
+			logger.warning(f"Email to the {label.lower()} contact queued for retry: {message['error']}")
+		elif message['error']:
+			logger.error(f"Error sending email to the {label.lower()} contact: {message['error']}")
+		else:
+			logger.info(f"{label} contact notified successfully by {' and '.join(message['channels'])} ('{message['email'] if 'email' in message['channels'] else message['phone']}')")
+
+# Function to drop the cached SES verification status if an email identity has been created since it was looked up
+# (see lifecheck/identities.py)
+def check_identities_version():
+	identities_version_param = os.environ.get('IDENTITIES_VERSION_PARAM')
+	if not identities_version_param:
+		return
+	try:
+		verified_identities.check_version(parameters.get(identities_version_param))
+	except Exception as e:
+		logger.error(f"Error retrieving the SES identities version: {str(e)}")
+
+# Function to return the text of a notification email
+def email_body(message):
+	if message['verification_url']:
+		# Include the verification URL in the email message
+		return f"{message['message']}\n\nVerification URL: {message['verification_url']}"
+	return message['message']
+
+def send_message(message, google_account_email):
+	ses.send_email(
+		Source=google_account_email,
+		Destination={'ToAddresses': [message['email']]},
+		Message={
+			'Subject': {'Data': message['tier']['subject']},
+			'Body': {'Text': {'Data': email_body(message)}}
+		}
+	)
+	return [None]
+
+# Function to send the emails of a single tier with one bulk templated send per 50 recipients, returning the error
+# of each message
+def send_templated_messages(messages, google_account_email):
+	return templates.send_bulk(
+		google_account_email,
+		messages[0]['tier'],
+		[(message['email'], message['message'], message['verification_url']) for message in messages]
+	)
+
+# Function to send the text message of a notification
+def send_text(message):
+	channels.send_sms(get_sns(), message['phone'], channels.sms_text(message['tier']['subject'], message['message'], message['verification_url']))
+	return [None]
+
+# Function to return the SNS client used to send text messages (created on first use, as most runs send none)
+def get_sns():
+	global sns
+	if sns is None:
+		sns = metrics.instrument(boto3.client('sns', config=channels.sns_config()))
+	return sns
+
+# Function to queue the emails that failed to send in the outbox, marking the messages that were queued
+def queue_failed_messages(messages, google_account_email):
+	failed = [message for message in messages if message['error'] and message.get('retry')]
+	if notification_outbox is None or not failed:
+		return
+	entries = [
+		{
+			"key": message['key'],
+			"subject_id": message['subject_id'],
+			"contact": message['tier']['contact'],
+			"source": google_account_email,
+			"email": message['email'],
+			"subject": message['tier']['subject'],
+			"body": email_body(message),
+			"changes": message['changes'],
+			"last_verification": message['last_verification'],
+			"previous_notification": message['previous_notification']
+		}
+		for message in failed
+	]
+	try:
+		rejected = set(notification_outbox.put(entries))
+	except Exception as e:
+		logger.error(f"Error queueing the failed emails in the outbox: {str(e)}")
+		return
+	for message in failed:
+		if message['key'] not in rejected:
+			message['queued'] = True
+
+# Function to join tier labels for a response, e.g. "Primary, Secondary and Emergency"
+def join_labels(labels):
+	return labels[0] if len(labels) == 1 else f"{', '.join(labels[:-1])} and {labels[-1]}"
+
+# Function to save the state changes of the messages that were sent (in one write) and return the response.
+# Messages queued in the outbox are recorded by the outbox worker once they have been sent.
+def record_messages(messages, state, values, current_time):
+	changes = {}
+	errors = []
+	sent = []
+	queued = []
+	for message in messages:
+		if message.get('queued'):
+			queued.append(message['tier']['label'])
+		elif message['error']:
+			errors.append(f"{message['tier']['label']}: {message['error']}")
+		else:
+			changes.update(message['changes'])
+			sent.append(message['tier']['label'])
+
+	if changes:
+		# Update the time the contacts were notified and the next action time
+		changes['next_action_at'] = escalation.next_action_at({**values, **changes}, current_time)
+		try:
+			state.save(changes)
+			values.update(changes)
+		except Exception as e:
+			logger.error(f"Error saving the notification state: {str(e)}")
+			errors.append(f"Error saving the notification state: {str(e)}")
+
+	if errors:
+		return {
+			"statusCode": 500,
+			"body": f"Error sending email: {'; '.join(errors)}"
+		}
 
-			# Send the secondary contact email
-			try:
-				# First confirm that the destination email address is verified in SES
-				verified_identities = ses.list_verified_email_addresses()['VerifiedEmailAddresses']
-				if secondary_contact_email not in verified_identities:
-					logger.error(f"Error sending email: Destination email address {secondary_contact_email} is not verified in SES")
-					return {
-						"statusCode": 500,
-						"body": f"Error: Destination email address {secondary_contact_email} is not verified in SES"
-					}
-
-				ses.send_email(
-					Source=google_account_email,
-					Destination={'ToAddresses': [secondary_contact_email]},
-					Message={
-						'Subject': {'Data': 'Warning: Lifecheck Verification Timeout'},
-						'Body': {'Text': {'Data': secondary_contact_message}}
-					}
-				)
-
-				# Update the time the secondary contact was last contacted
-				ssm.put_parameter(Name=secondary_contact_datetime_param, Value=current_time.isoformat(), Type='String', Overwrite=True)
-
-				logger.info(f"Secondary contact email sent successfully to '{secondary_contact_email}'")
-				return {
-					"statusCode": 200,
-					"body": "Secondary contact email sent successfully"
-				}
+	results = []
+	if sent:
+		results.append(f"{join_labels(sent)} contact notification{'s' if len(sent) > 1 else ''} sent successfully")
+	if queued:
+		results.append(f"{join_labels(queued)} contact email{'s' if len(queued) > 1 else ''} queued for retry")
+	return {
+		"statusCode": 200,
+		"body": "; ".join(results)
+	}
 
-			except Exception as e:
-				logger.error(f"Error sending email: {str(e)}")
-				return {
-					"statusCode": 500,
-					"body": f"Error sending email: {str(e)}"
-				}
-	elif elapsed_hours > EMERGENCY_CONTACT_THRESHOLD_HOURS:
-		logger.info(f"Checking last emergency contact time: emergency_contact_datetime='{emergency_contact_datetime}'")
-		# Check if emergency contact notifications have already been sent
-		if not emergency_contact_datetime:
-			logger.info(f"Attempting to send message to the emergency contact...")
+# Function to evaluate and notify every subject stored under the subjects path
+def notify_subjects(subjects_path, google_account_email_param, email_verification_api_gateway_url, event, scheduler, context=None):
+	# The sending address and the subjects are read concurrently
+	try:
+		with metrics.phase('load'):
+			settings = fetch_settings(
+				google_account_email=lambda: parameters.get(google_account_email_param),
+				subjects=lambda: subjects_from_environment(ssm, subjects_path)
+			)
+	except Exception as e:
+		logger.error(f"Error retrieving parameters from Parameter Store: {str(e)}")
+		return {
+			"statusCode": 500,
+			"body": f"Error retrieving parameters from Parameter Store: {str(e)}"
+		}
 
-			# Send the emergency contact email
-			try:
-				# First confirm that the destination email address is verified in SES
-				verified_identities = ses.list_verified_email_addresses()['VerifiedEmailAddresses']
-				if emergency_contact_email not in verified_identities:
-					logger.error(f"Error sending email: Destination email address {emergency_contact_email} is not verified in SES")
-					return {
-						"statusCode": 500,
-						"body": f"Error: Destination email address {emergency_contact_email} is not verified in SES"
-					}
-
-				ses.send_email(
-					Source=google_account_email,
-					Destination={'ToAddresses': [emergency_contact_email]},
-					Message={
-						'Subject': {'Data': 'Emergency: Lifecheck Verification Timeout'},
-						'Body': {'Text': {'Data': emergency_contact_message}}
-					}
-				)
-
-				# Update the time the emergency contact was last contacted
-				ssm.put_parameter(Name=emergency_contact_datetime_param, Value=current_time.isoformat(), Type='String', Overwrite=True)
-
-				logger.info(f"Emergency contact email sent successfully to '{emergency_contact_email}'")
-				return {
-					"statusCode": 200,
-					"body": "Emergency contact email sent successfully"
-				}
+	google_account_email = settings.google_account_email
+	all_subjects = settings.subjects
+	if not google_account_email or not email_verification_api_gateway_url:
+		logger.error(f"Missing required parameters: google_account_email='{google_account_email}' email_verification_api_gateway_url='{email_verification_api_gateway_url}'")
+		return {
+			"statusCode": 500,
+			"body": "Error: Missing required parameters"
+		}
 
+	current_time = datetime.datetime.now()
+
+	# Only the timers of the subject a timer was armed for and of the subjects whose next action time is due or
+	# changes are re-armed, rather than every subject on each run of the fixed schedule. A subject whose timer was
+	# lost becomes due once its next action time passes, so the fixed schedule still evaluates it and re-arms it.
+	rearm = {event.get('subject')} & set(all_subjects) if schedule.is_deadline_event(event) else set()
+
+	# Default last_verification to the current datetime for subjects that have never verified
+	for subject_id, state in all_subjects.items():
+		if not state.get('last_verification'):
+			rearm.add(subject_id)
+			state['last_verification'] = current_time.isoformat()
+			state['next_action_at'] = escalation.next_action_at(state, current_time)
+			logger.info(f"The last_verification parameter is not set for subject '{subject_id}' - setting it now to '{current_time}'")
+			try:
+				state_from_environment(parameters, subject_id).save({'last_verification': state['last_verification'], 'next_action_at': state['next_action_at']})
 			except Exception as e:
-				logger.error(f"Error sending email: {str(e)}")
-				return {
-					"statusCode": 500,
-					"body": f"Error sending email: {str(e)}"
-				}		
-	logger.info(f"No action needed at this time")
+				logger.error(f"Error saving last_verification for subject '{subject_id}': {str(e)}")
+
+	# Only the subjects whose next action time has passed can have a tier due, so the thresholds are only evaluated
+	# for them
+	datetime_fields = escalation.tier_datetime_fields()
+	with metrics.phase('evaluate'):
+		candidates = subjects.due_subject_ids(all_subjects, current_time)
+		due = []
+		for subject_id in candidates:
+			state = all_subjects[subject_id]
+			tiers = escalation.due_tiers(
+				escalation.hours_since(current_time, state.get('last_verification')),
+				[escalation.hours_since(current_time, state.get(field)) for field in datetime_fields]
+			)
+			if tiers:
+				due.append((subject_id, tiers))
+	logger.info(f"Evaluated {len(candidates)} of {len(all_subjects)} subjects at current_time='{current_time}' - {sum(len(tiers) for subject_id, tiers in due)} notifications due for {len(due)} subjects")
+	rearm.update(candidates)
+
+	# The candidates with nothing due have a missing or out of date next action time, which is refreshed so that
+	# they are not evaluated again on every run
+	due_ids = {subject_id for subject_id, tiers in due}
+	refresh_subjects([subject_id for subject_id in candidates if subject_id not in due_ids], all_subjects, current_time)
+
+	if not due:
+		logger.info(f"No action needed at this time")
+		arm_subjects(scheduler, all_subjects, rearm, current_time)
+		return {
+			"statusCode": 200,
+			"body": "No action needed at this time"
+		}
+
+	# Look up the verification status of every due recipient in one batch before sending (after dropping the cached
+	# status if an identity has been created, so that the batch is not dropped as soon as it has been looked up)
+	check_identities_version()
+	try:
+		verified_identities.prefetch([
+			all_subjects[subject_id].get(f"{escalation.TIERS[index]['contact']}_email")
+			for subject_id, tiers in due
+			for index in tiers
+		])
+	except Exception as e:
+		logger.error(f"Error retrieving SES verification status: {str(e)}")
+
+	# Send the emails of every due subject together, so that the emails of each tier can be sent in bulk
+	subject_messages = [
+		prepare_messages(tiers, all_subjects[subject_id], email_verification_api_gateway_url, current_time, subject_id)
+		for subject_id, tiers in due
+	]
+	with metrics.phase('send'):
+		send_messages([message for messages in subject_messages for message in messages], google_account_email, send_budget(context))
+
+	def record_subject(subject_id, messages):
+		state = state_from_environment(parameters, subject_id)
+		return record_messages(messages, state, all_subjects[subject_id], current_time)
+
+	# Save the state of each subject concurrently as each subject is independent
+	with metrics.phase('record'), ThreadPoolExecutor(max_workers=min(MAX_NOTIFICATION_WORKERS, len(due))) as executor:
+		responses = list(executor.map(record_subject, [subject_id for subject_id, tiers in due], subject_messages))
+	arm_subjects(scheduler, all_subjects, rearm, current_time)
+
+	failed = [subject_id for (subject_id, tiers), response in zip(due, responses) if response['statusCode'] != 200]
+	if failed:
+		logger.error(f"Notifications failed for subjects: {failed}")
+		return {
+			"statusCode": 500,
+			"body": f"Notifications sent for {len(due) - len(failed)} of {len(due)} due subjects"
+		}
+
 	return {
 		"statusCode": 200,
-		"body": "No action needed at this time"
+		"body": f"Notifications sent for {len(due)} due subjects"
 	}
+
+# Function to save the recalculated next action time of the given subjects concurrently where it has changed
+def refresh_subjects(subject_ids, all_subjects, current_time):
+	changed = []
+	for subject_id in subject_ids:
+		state = all_subjects[subject_id]
+		new_next_action_at = escalation.next_action_at(state, current_time)
+		if new_next_action_at != state.get('next_action_at'):
+			state['next_action_at'] = new_next_action_at
+			changed.append(subject_id)
+	if not changed:
+		return
+
+	def save_subject(subject_id):
+		try:
+			state_from_environment(parameters, subject_id).save({'next_action_at': all_subjects[subject_id]['next_action_at']})
+		except Exception as e:
+			logger.error(f"Error saving next_action_at for subject '{subject_id}': {str(e)}")
+
+	with ThreadPoolExecutor(max_workers=min(MAX_NOTIFICATION_WORKERS, len(changed))) as executor:
+		list(executor.map(save_subject, changed))
+
+# Function to arm the timers of the given subjects concurrently
+def arm_subjects(scheduler, all_subjects, subject_ids, current_time):
+	if scheduler is None or not subject_ids:
+		return
+	with ThreadPoolExecutor(max_workers=min(MAX_NOTIFICATION_WORKERS, len(subject_ids))) as executor:
+		list(executor.map(lambda subject_id: schedule.arm_next_run(scheduler, all_subjects[subject_id], current_time, subject_id), subject_ids))
@@ -0,0 +1,92 @@
+"""
+lifecheck-outbox.py
+
+This script is a Lambda function that sends the notification emails queued in the outbox by
+lifecheck-notification.py when SES failed to send them (see lifecheck/outbox.py).
+
+It is invoked by the outbox SQS queue with a batch of entries. For each entry it reads the state
+of the subject and drops the entry if the person has checked in since the email was queued, or if
+the tier has been notified since. Otherwise it sends the email and records the time the contact
+was notified and the next action time, as the poller would have done. Entries that fail are
+reported to Lambda as batch item failures and retried after an exponential backoff with jitter,
+together with the later entries of the same subject in the batch, which are not sent until then.
+"""
+
+import json
+import boto3
+import datetime
+import logging
+
+from lifecheck import escalation
+from lifecheck import metrics
+from lifecheck import outbox
+from lifecheck.parameters import ParameterCache
+from lifecheck.state import state_from_environment
+
+ssm = metrics.instrument(boto3.client('ssm'))
+ses = metrics.instrument(boto3.client('ses'))
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# The state is updated by other functions, so it is always read from Parameter Store
+parameters = ParameterCache(ssm, default_ttl=0)
+
+# The outbox queue that invokes this function, used to schedule the retries of the entries that fail
+notification_outbox = outbox.outbox_from_environment(lambda: metrics.instrument(boto3.client('sqs')))
+
+# The state fields used to decide whether an entry is still needed and to calculate the next action time (only
+# emails are queued in the outbox, so the phone numbers are not read)
+OUTBOX_FIELDS = ['last_verification'] + [field for field in escalation.tier_fields() if not field.endswith('_phone')]
+
+# Function to send an entry unless the notification is no longer needed, and record it as the poller would
+def deliver(entry):
+	state = state_from_environment(parameters, entry['subject_id'])
+	with metrics.phase('load'):
+		values = state.load(OUTBOX_FIELDS)
+
+	if values.get('last_verification') != entry['last_verification']:
+		logger.info(f"Dropping outbox entry {entry['key'][:12]} for the {entry['contact']} - a verification has been recorded since it was queued")
+		return
+	if values.get(f"{entry['contact']}_datetime") != entry['previous_notification']:
+		logger.info(f"Dropping outbox entry {entry['key'][:12]} for the {entry['contact']} - the contact has been notified since it was queued")
+		return
+
+	with metrics.phase('send'):
+		ses.send_email(
+			Source=entry['source'],
+			Destination={'ToAddresses': [entry['email']]},
+			Message={
+				'Subject': {'Data': entry['subject']},
+				'Body': {'Text': {'Data': entry['body']}}
+			}
+		)
+	logger.info(f"Outbox entry {entry['key'][:12]} sent to '{entry['email']}'")
+
+	# The email has been sent, so a failure to record it is logged rather than retried (which would send it again)
+	changes = dict(entry['changes'])
+	changes['next_action_at'] = escalation.next_action_at({**values, **changes}, datetime.datetime.now())
+	try:
+		with metrics.phase('record'):
+			state.save(changes)
+	except Exception as e:
+		logger.error(f"Error saving the notification state of outbox entry {entry['key'][:12]}: {str(e)}")
+
+@metrics.per_invocation('lifecheck-outbox')
+@parameters.per_invocation_stats
+def lambda_handler(event, context):
+	received = [
+		(record['receiptHandle'], json.loads(record['body']), int(record['attributes']['ApproximateReceiveCount']))
+		for record in event.get('Records', [])
+	]
+
+	failed = set(outbox.process(notification_outbox, received, deliver))
+	logger.info(f"Delivered {len(received) - len(failed)} of {len(received)} outbox entries")
+
+	# Only the entries that failed (and the later entries of their subjects) are returned to the queue
+	return {
+		"batchItemFailures": [
+			{"itemIdentifier": record['messageId']}
+			for record in event.get('Records', [])
+			if record['receiptHandle'] in failed
+		]
+	}
@@ -3,63 +3,152 @@ lifecheck-settings-update.py
 
 This script is a Lambda function updates the values provided in the HTML form
 that was rendered in the lifecheck-settings-view.py script.
+
+It also handles PATCH /settings/api, which is used by the page shell: the request body is a JSON
+object of only the settings being changed, e.g. {"primary_contact_message": "Please check in"},
+and only those settings are read and saved. The response is a JSON object listing the settings
+that were changed, or a JSON error with status 400 if the request is not valid.
 """
 
 import os
+import json
+import time
 import boto3
+import base64
 import logging
+import datetime
 import urllib.parse
 
-ssm = boto3.client('ssm')
-ses = boto3.client('sesv2', region_name=os.environ.get('REGION'))
+from lifecheck import metrics
+from lifecheck.parameters import ParameterCache
+from lifecheck.state import executor, state_from_environment
+
+ssm = metrics.instrument(boto3.client('ssm'))
+ses = metrics.instrument(boto3.client('sesv2', region_name=os.environ.get('REGION')))
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def save_and_verify_email(key_param, new_value):
-	try:
-		response = ssm.get_parameter(
-			Name=key_param,
-			WithDecryption=False
-		)
-		current_key_value = response['Parameter']['Value']
-	except ssm.exceptions.ParameterNotFound:
-		current_key_value = None
-
+# The current values are always read from Parameter Store, as the settings may have been changed by another
+# container of this function since they were last read here (a cached value that is unchanged in the request
+# would otherwise hide the change, and the requested value would not be saved)
+parameters = ParameterCache(ssm, default_ttl=0)
+
+SETTINGS_FIELDS = [
+	'primary_contact_email',
+	'primary_contact_message',
+	'secondary_contact_email',
+	'secondary_contact_message',
+	'emergency_contact_email',
+	'emergency_contact_phone',
+	'emergency_contact_message'
+]
+
+# Email address fields that must be verified in SES when they are changed
+EMAIL_FIELDS = [
+	'primary_contact_email',
+	'secondary_contact_email',
+	'emergency_contact_email'
+]
+
+# Function to record a field in the changes if its value differs from the current value, so that all changes are saved together
+def record_change(changes, current_values, field, new_value):
 	# Check whether the key value has changed
-	if current_key_value != new_value:
-		# Save the new value
-		ssm.put_parameter(
-			Name=key_param,
-			Value=new_value,
-			Type='String',
-			Overwrite=True
-		)
-		# Verify the new email address via SES
-		response = ses.create_email_identity(
-			EmailIdentity=new_value
-		)
-
-def save_parameter(key_param, new_value):
+	if current_values.get(field) != new_value:
+		changes[field] = new_value
+
+# Function to return the response headers, including the time taken to handle the request so that the
+# latency of a submit can be seen in the browser developer tools
+def response_headers(start_time, content_type="text/html"):
+	duration_ms = (time.perf_counter() - start_time) * 1000
+	logger.info(f"Settings update handled in {duration_ms:.1f} ms")
+	return {
+		"Content-Type": content_type,
+		"Server-Timing": f"update;dur={duration_ms:.1f}"
+	}
+
+# Function to save the requested values that differ from the current values, verifying any new email
+# addresses in SES, and return the changes that were saved
+def update_settings(requested):
+	# Retrieve the current values of the requested settings in a single read so that only changed values are saved
+	state = state_from_environment(parameters)
+	with metrics.phase('load'):
+		current_values = state.load([field for field in SETTINGS_FIELDS if field in requested])
+	changes = {}
+	for field, new_value in requested.items():
+		record_change(changes, current_values, field, new_value)
+
+	# Save the changed values
+	if changes:
+		logger.info(f"Saving changed settings: {list(changes)}")
+		with metrics.phase('save'):
+			state.save(changes)
+
+	# Verify any new email addresses via SES (concurrently, on the executor used for the parameter writes)
+	futures = [executor.submit(ses.create_email_identity, EmailIdentity=changes[field]) for field in EMAIL_FIELDS if field in changes]
+	for future in futures:
+		future.result()
+
+	# Signal the poller to drop its cached SES verification status (see lifecheck/identities.py)
+	identities_version_param = os.environ.get('IDENTITIES_VERSION_PARAM')
+	if futures and identities_version_param:
+		parameters.put(identities_version_param, datetime.datetime.now().isoformat())
+	return changes
+
+# Function to parse the JSON body of a PATCH request into the requested values, raising a ValueError if
+# it is not a JSON object of non-empty strings for known settings
+def parse_patch(event):
+	body = event.get("body") or ""
+	if event.get("isBase64Encoded"):
+		body = base64.b64decode(body).decode('utf-8')
+	try:
+		requested = json.loads(body)
+	except json.JSONDecodeError as e:
+		raise ValueError(f"The request body is not valid JSON: {str(e)}")
+	if not isinstance(requested, dict):
+		raise ValueError("The request body must be a JSON object")
+	unknown = sorted(set(requested) - set(SETTINGS_FIELDS))
+	if unknown:
+		raise ValueError(f"Unknown settings: {', '.join(unknown)}")
+	for field, value in requested.items():
+		if not isinstance(value, str) or not value.strip():
+			raise ValueError(f"The value of {field} must be a non-empty string")
+	return requested
+
+# Function to handle a partial JSON update from the page shell
+def patch_settings(event, start_time):
 	try:
-		response = ssm.get_parameter(
-			Name=key_param,
-			WithDecryption=False
-		)
-		current_key_value = response['Parameter']['Value']
-	except ssm.exceptions.ParameterNotFound:
-		current_key_value = None
+		logger.info(f"Attempting to update settings from JSON")
+		requested = parse_patch(event)
+		changes = update_settings(requested)
+		return {
+			"statusCode": 200,
+			"headers": response_headers(start_time, "application/json"),
+			"body": json.dumps({"updated": list(changes)})
+		}
 
-	# Check whether the key value has changed
-	if current_key_value != new_value:
-		# Save the new value
-		ssm.put_parameter(
-			Name=key_param,
-			Value=new_value,
-			Type='String',
-			Overwrite=True
-		)
+	except ValueError as e:
+		logger.error(f"Invalid settings update: {str(e)}")
+		return {
+			"statusCode": 400,
+			"headers": response_headers(start_time, "application/json"),
+			"body": json.dumps({"error": str(e)})
+		}
 
+	except Exception as e:
+		logger.error(f"Error updating settings: {str(e)}")
+		return {
+			"statusCode": 500,
+			"headers": response_headers(start_time, "application/json"),
+			"body": json.dumps({"error": str(e)})
+		}
+
+@metrics.per_invocation('lifecheck-settings-update')
+@parameters.per_invocation_stats
 def lambda_handler(event, context):
+	start_time = time.perf_counter()
+
+	if event.get("httpMethod") == "PATCH":
+		return patch_settings(event, start_time)
 
 	html_header = f"""
 		<!DOCTYPE html>
@@ -84,15 +173,6 @@ def lambda_handler(event, context):
 	try:
 		logger.info(f"Attempting to update settings")
 
-		# Retrieve the environment variables containing parameter names
-		primary_contact_email_param = os.environ.get('PRIMARY_CONTACT_EMAIL_PARAM')
-		primary_contact_message_param = os.environ.get('PRIMARY_CONTACT_MESSAGE_PARAM')
-		secondary_contact_email_param = os.environ.get('SECONDARY_CONTACT_EMAIL_PARAM')
-		secondary_contact_message_param = os.environ.get('SECONDARY_CONTACT_MESSAGE_PARAM')
-		emergency_contact_email_param = os.environ.get('EMERGENCY_CONTACT_EMAIL_PARAM')
-		emergency_contact_phone_param = os.environ.get('EMERGENCY_CONTACT_PHONE_PARAM')
-		emergency_contact_message_param = os.environ.get('EMERGENCY_CONTACT_MESSAGE_PARAM')
-
 		# Get the raw request body
 		body = event.get("body", "")
 		
@@ -101,46 +181,19 @@ def lambda_handler(event, context):
 		# Parse the URL-encoded form data
 		form_data = urllib.parse.parse_qs(body)
 		
-		# Extract form fields and update the values in Parameter Store
-		primary_contact_email = form_data.get("primary_contact_email", [None])[0]
-		if primary_contact_email:
-			logger.info(f"Retrieved value from form: primary_contact_email='{primary_contact_email}'")
-			save_and_verify_email(primary_contact_email_param, primary_contact_email)
-
-		primary_contact_message = form_data.get("primary_contact_message", [None])[0]
-		if primary_contact_message:
-			logger.info(f"Retrieved value from form: primary_contact_message='{primary_contact_message}'")
-			save_parameter(primary_contact_message_param, primary_contact_message)
-
-		secondary_contact_email = form_data.get("secondary_contact_email", [None])[0]
-		if secondary_contact_email:
-			logger.info(f"Retrieved value from form: secondary_contact_email='{secondary_contact_email}'")
-			save_and_verify_email(secondary_contact_email_param, secondary_contact_email)
-
-		secondary_contact_message = form_data.get("secondary_contact_message", [None])[0]
-		if secondary_contact_message:
-			logger.info(f"Retrieved value from form: secondary_contact_message='{secondary_contact_message}'")
-			save_parameter(secondary_contact_message_param, secondary_contact_message)
-
-		emergency_contact_email = form_data.get("emergency_contact_email", [None])[0]
-		if emergency_contact_email:
-			logger.info(f"Retrieved value from form: emergency_contact_email='{emergency_contact_email}'")
-			save_and_verify_email(emergency_contact_email_param, emergency_contact_email)
-
-		emergency_contact_phone = form_data.get("emergency_contact_phone", [None])[0]
-		if emergency_contact_phone:
-			logger.info(f"Retrieved value from form: emergency_contact_phone='{emergency_contact_phone}'")
-			save_parameter(emergency_contact_phone_param, emergency_contact_phone)
-
-		emergency_contact_message = form_data.get("emergency_contact_message", [None])[0]
-		if emergency_contact_message:
-			logger.info(f"Retrieved value from form: emergency_contact_message='{emergency_contact_message}'")
-			save_parameter(emergency_contact_message_param, emergency_contact_message)
+		# Extract form fields and save the values that have changed
+		requested = {}
+		for field in SETTINGS_FIELDS:
+			new_value = form_data.get(field, [None])[0]
+			if new_value:
+				logger.info(f"Retrieved value from form: {field}='{new_value}'")
+				requested[field] = new_value
+		update_settings(requested)
 
 		# Return the successful HTML content and status code
 		return {
 			"statusCode": 200,
-			"headers": { "Content-Type": "text/html" },
+			"headers": response_headers(start_time),
 			"body": f"""
 				{html_header}
 				<section class="hero is-success mt-2">
@@ -162,7 +215,7 @@ def lambda_handler(event, context):
 		# Return the failed HTML content and status code
 		return {
 			"statusCode": 500,
-			"headers": { "Content-Type": "text/html" },
+			"headers": response_headers(start_time),
 			"body": f"""
 				{html_header}
 				<section class="hero is-danger mt-2">
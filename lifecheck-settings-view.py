@@ -2,125 +2,369 @@
 lifecheck-settings-view.py
 
 This script is a Lambda function that will provide a HTML form for the settings application.
+
+If a verification history is kept (see lifecheck/history.py), the page also shows the number of
+check-ins on each of the last CHECK_IN_DAYS days. Only the history records covering those days are
+read, so the cost of the page does not grow with the length of the history.
+
+The same values are also returned as a compact JSON document by GET /settings/api. When the
+SETTINGS_SHELL_MODE environment variable is "true", GET /settings returns a static page shell
+instead, which loads the values from the JSON API and saves only the changed values with PATCH
+/settings/api (see lifecheck-settings-update.py). The shell depends only on this file, so it is
+rendered and compressed (with brotli if the module is available, otherwise gzip) once per
+container, and browsers cache it for SHELL_MAX_AGE_SECONDS and then revalidate it without any
+values being read.
 """
 
-import html
 import os
+import gzip
+import html
+import json
 import boto3
+import base64
+import hashlib
 import datetime
 import logging
 
-ssm = boto3.client('ssm')
+from lifecheck import metrics
+from lifecheck.history import history_from_environment
+from lifecheck.parameters import ParameterCache
+from lifecheck.settings import fetch_settings
+from lifecheck.state import state_from_environment
+
+try:
+	import brotli
+except ImportError:
+	# brotli is not part of the Lambda runtime, so it is only used if it is provided by a layer
+	brotli = None
+
+ssm = metrics.instrument(boto3.client('ssm'))
+# The settings page always shows the current values, so the cache is only used to coalesce reads
+parameters = ParameterCache(ssm, default_ttl=0)
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def lambda_handler(event, context):
+# The page markup is part of the ETag so that browsers do not keep a page rendered by an earlier deployment
+with open(__file__, 'rb') as source:
+	PAGE_SOURCE_HASH = hashlib.sha256(source.read()).hexdigest()
 
-	logger.info(f"Attempting to render the settings application")
+# The most recently rendered page is kept in the warm container until the parameter versions change
+rendered_page = {
+	"etag": None,
+	"body": None
+}
 
-	try:
-		# Retrieve the environment variables containing parameter names
-		last_verification_param = os.environ.get('LAST_VERIFICATION_PARAM')
-		primary_contact_email_param = os.environ.get('PRIMARY_CONTACT_EMAIL_PARAM')
-		primary_contact_message_param = os.environ.get('PRIMARY_CONTACT_MESSAGE_PARAM')
-		primary_contact_datetime_param = os.environ.get('PRIMARY_CONTACT_DATETIME_PARAM')
-		secondary_contact_email_param = os.environ.get('SECONDARY_CONTACT_EMAIL_PARAM')
-		secondary_contact_message_param = os.environ.get('SECONDARY_CONTACT_MESSAGE_PARAM')
-		secondary_contact_datetime_param = os.environ.get('SECONDARY_CONTACT_DATETIME_PARAM')
-		emergency_contact_email_param = os.environ.get('EMERGENCY_CONTACT_EMAIL_PARAM')
-		emergency_contact_phone_param = os.environ.get('EMERGENCY_CONTACT_PHONE_PARAM')
-		emergency_contact_message_param = os.environ.get('EMERGENCY_CONTACT_MESSAGE_PARAM')
-		emergency_contact_datetime_param = os.environ.get('EMERGENCY_CONTACT_DATETIME_PARAM')
+SETTINGS_VIEW_FIELDS = [
+	'last_verification',
+	'primary_contact_email',
+	'primary_contact_message',
+	'primary_contact_datetime',
+	'secondary_contact_email',
+	'secondary_contact_message',
+	'secondary_contact_datetime',
+	'emergency_contact_email',
+	'emergency_contact_phone',
+	'emergency_contact_message',
+	'emergency_contact_datetime'
+]
 
-		# Retrieve parameter values from Parameter Store
-		logger.info(f"Attempting to retrieve parameters from the Parameter Store")
+# The number of days of check-ins shown on the page
+CHECK_IN_DAYS = 14
+SECONDS_PER_DAY = 86400
+
+# The API Gateway resource of the JSON API
+API_RESOURCE = '/settings/api'
+
+# Whether GET /settings returns the static page shell rather than the rendered page
+SHELL_MODE = os.environ.get('SETTINGS_SHELL_MODE') == 'true'
+SHELL_MAX_AGE_SECONDS = 86400
+# The shell is the same for every encoding, so a weak ETag is used
+SHELL_ETAG = f'W/"{PAGE_SOURCE_HASH[:32]}"'
+
+# The page shell, compressed with each content encoding requested so far
+shell_page = {}
+
+# The script of the page shell, which fills in the values from the JSON API and saves the changed values
+SHELL_SCRIPT = """
+			<script>
+				const form = document.querySelector('form');
+				const fields = Array.from(form.elements).filter(element => element.name).map(element => element.name);
+				let current = {};
+
+				function showStatus(kind, message, link) {
+					const status = document.getElementById('status');
+					status.className = `notification ${kind}`;
+					status.textContent = message;
+					if (link) {
+						const anchor = document.createElement('a');
+						anchor.href = link;
+						anchor.textContent = link;
+						status.append(' ', anchor);
+					}
+				}
+
+				function showCheckIns(checkIns) {
+					const body = document.getElementById('check_ins');
+					body.replaceChildren();
+					if (!checkIns) {
+						return;
+					}
+					const row = body.insertRow();
+					const heading = document.createElement('th');
+					heading.textContent = `Check-ins per day (last ${checkIns.length} days):`;
+					const days = document.createElement('tr');
+					for (const [day, count] of checkIns) {
+						const date = new Date(`${day}T00:00:00Z`);
+						const cell = days.insertCell();
+						cell.className = 'has-text-centered';
+						const tag = document.createElement('span');
+						tag.className = `tag ${count ? 'is-success' : 'is-light'}`;
+						tag.title = date.toLocaleDateString('en-GB', { weekday: 'long', day: '2-digit', month: 'long', timeZone: 'UTC' });
+						tag.textContent = count;
+						const label = document.createElement('span');
+						label.className = 'is-size-7';
+						label.textContent = date.toLocaleDateString('en-GB', { day: '2-digit', month: 'short', timeZone: 'UTC' });
+						cell.append(tag, document.createElement('br'), label);
+					}
+					const table = document.createElement('table');
+					table.className = 'table is-narrow';
+					table.append(days);
+					row.append(heading);
+					row.insertCell().append(table);
+				}
+
+				function show(settings) {
+					current = settings;
+					for (const span of document.querySelectorAll('[data-datetime]')) {
+						span.textContent = settings[span.id] ? settings[span.id].replace('T', ' ') : 'None';
+					}
+					for (const name of fields) {
+						form.elements[name].value = settings[name] || '';
+					}
+					showCheckIns(settings.check_ins);
+				}
+
+				async function load() {
+					const response = await fetch('settings/api', { credentials: 'same-origin', headers: { 'Accept': 'application/json' } });
+					if (!response.ok) {
+						throw new Error(`HTTP ${response.status}`);
+					}
+					show(await response.json());
+				}
+
+				form.addEventListener('submit', async event => {
+					event.preventDefault();
+					const changes = {};
+					for (const name of fields) {
+						const value = form.elements[name].value;
+						if (value && value !== (current[name] || '')) {
+							changes[name] = value;
+						}
+					}
+					if (!Object.keys(changes).length) {
+						showStatus('is-info', 'There are no changes to save.');
+						return;
+					}
+					try {
+						const response = await fetch('settings/api', {
+							method: 'PATCH',
+							credentials: 'same-origin',
+							headers: { 'Content-Type': 'application/json' },
+							body: JSON.stringify(changes)
+						});
+						const result = await response.json();
+						if (!response.ok) {
+							throw new Error(result.error || `HTTP ${response.status}`);
+						}
+						Object.assign(current, changes);
+						if ('emergency_contact_phone' in changes) {
+							showStatus('is-success', 'The update to the settings has been successful. Note that any changes to the emergency contact phone number require verification as explained in the following link:', 'https://docs.aws.amazon.com/sns/latest/dg/sns-sms-sandbox-verifying-phone-numbers.html');
+						} else {
+							showStatus('is-success', 'The update to the settings has been successful.');
+						}
+					} catch (error) {
+						showStatus('is-danger', `The update to the settings has failed: ${error.message}`);
+					}
+				});
+
+				load().catch(error => showStatus('is-danger', `The settings could not be loaded: ${error.message}`));
+			</script>
+"""
+
+# Function to compute an ETag from the Parameter Store versions of the values shown on the page
+def settings_etag(versions):
+	digest = hashlib.sha256(f"{PAGE_SOURCE_HASH}:{json.dumps(versions, sort_keys=True)}".encode()).hexdigest()
+	return f'"{digest[:32]}"'
 
-		# Retrieve the last verification separately to the following get_parameters call (which has a limit of 10 parameters)
-		last_verification = None
-		try:
-			response = ssm.get_parameter(Name=last_verification_param, WithDecryption=False)
-			last_verification_str = response['Parameter']['Value']
-			if last_verification_str:
-				last_verification = datetime.datetime.fromisoformat(last_verification_str)
-		except ssm.exceptions.ParameterNotFound:
-			logger.error(f"Parameter last_verification not found")
-
-		response = ssm.get_parameters(
-			Names=[
-				primary_contact_email_param,
-				primary_contact_message_param,
-				primary_contact_datetime_param,
-				secondary_contact_email_param,
-				secondary_contact_message_param,
-				secondary_contact_datetime_param,
-				emergency_contact_email_param,
-				emergency_contact_phone_param,
-				emergency_contact_message_param,
-				emergency_contact_datetime_param
-			],
-			WithDecryption=False
+# Function to determine whether the If-None-Match request header matches the ETag
+def etag_matches(event, etag):
+	headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+	if_none_match = headers.get('if-none-match')
+	if not if_none_match:
+		return False
+	candidates = [candidate.strip() for candidate in if_none_match.split(',')]
+	return '*' in candidates or etag in candidates or f"W/{etag}" in candidates
+
+# Function to return the content encodings accepted by the Accept-Encoding request header
+def accepted_encodings(event):
+	headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+	encodings = set()
+	for candidate in (headers.get('accept-encoding') or '').split(','):
+		name, _, options = candidate.partition(';')
+		quality = options.strip()
+		if quality.startswith('q='):
+			try:
+				if float(quality[2:]) <= 0:
+					continue
+			except ValueError:
+				continue
+		if name.strip():
+			encodings.add(name.strip().lower())
+	return encodings
+
+# Function to choose the best content encoding that the browser accepts
+def choose_encoding(event):
+	encodings = accepted_encodings(event)
+	if brotli is not None and 'br' in encodings:
+		return 'br'
+	if 'gzip' in encodings:
+		return 'gzip'
+	return 'identity'
+
+# Function to compress a body with a content encoding
+def compress(body, encoding):
+	data = body.encode('utf-8')
+	if encoding == 'br':
+		return brotli.compress(data)
+	if encoding == 'gzip':
+		# The modification time is fixed so that the compressed shell is the same in every container
+		return gzip.compress(data, mtime=0)
+	return data
+
+# Function to return the static page shell, which does not read any values
+def shell_response(event):
+	headers = {
+		"ETag": SHELL_ETAG,
+		"Cache-Control": f"private, max-age={SHELL_MAX_AGE_SECONDS}",
+		"Vary": "Accept-Encoding"
+	}
+
+	# The browser already has the current shell
+	if etag_matches(event, SHELL_ETAG):
+		logger.info(f"The settings page shell is unchanged (ETag {SHELL_ETAG})")
+		return {
+			"statusCode": 304,
+			"headers": headers,
+			"body": ""
+		}
+
+	encoding = choose_encoding(event)
+	if encoding not in shell_page:
+		with metrics.phase('render'):
+			shell_page[encoding] = compress(render_settings_page({}, shell=True), encoding)
+		logger.info(f"Rendered the settings page shell ({encoding}, {len(shell_page[encoding])} bytes)")
+
+	if encoding == 'identity':
+		return {
+			"statusCode": 200,
+			"headers": { **headers, "Content-Type": "text/html; charset=utf-8" },
+			"body": shell_page[encoding].decode('utf-8')
+		}
+	return {
+		"statusCode": 200,
+		"headers": { **headers, "Content-Type": "text/html; charset=utf-8", "Content-Encoding": encoding },
+		"body": base64.b64encode(shell_page[encoding]).decode('ascii'),
+		"isBase64Encoded": True
+	}
+
+# Function to read the values shown on the page and the recent check-ins, returning them with their ETag
+def load_settings_view():
+	state = state_from_environment(parameters)
+	history = history_from_environment(parameters)
+
+	# The check-ins of the last few days (from the start of the first day) are read with the state
+	today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+	first_day = today - datetime.timedelta(days=CHECK_IN_DAYS - 1)
+	with metrics.phase('load'):
+		settings = fetch_settings(
+			state=lambda: state.load(SETTINGS_VIEW_FIELDS),
+			check_ins=lambda: history.summary(first_day, today + datetime.timedelta(days=1), SECONDS_PER_DAY) if history else None
 		)
+		# The check-ins shown change with the day as well as with the history
+		etag = settings_etag({
+			**state.versions(SETTINGS_VIEW_FIELDS),
+			"check_ins": [(day.isoformat(), count) for day, count in settings.check_ins] if settings.check_ins else None
+		})
+	return settings.state, settings.check_ins, etag
 
-		logger.info(f"Parsing parameter values")
+# Function to convert the values shown on the page and the recent check-ins to the JSON API document (values
+# that are not set are left out to keep the document small)
+def settings_document(params, check_ins):
+	document = {field: params[field] for field in SETTINGS_VIEW_FIELDS if params.get(field) is not None}
+	if check_ins:
+		document["check_ins"] = [[day.date().isoformat(), count] for day, count in check_ins]
+	return document
+
+# Function to return the values shown on the page as JSON for GET /settings/api
+def api_response(event):
+	try:
+		logger.info(f"Attempting to retrieve parameters from the Parameter Store")
+		params, check_ins, etag = load_settings_view()
+	except Exception as e:
+		logger.error(f"Error retrieving parameters from Parameter Store: {str(e)}")
+		return {
+			"statusCode": 500,
+			"headers": { "Content-Type": "application/json" },
+			"body": json.dumps({"error": f"Error retrieving parameters from Parameter Store: {str(e)}"})
+		}
 
-		params = {param['Name']: param['Value'] for param in response['Parameters'] if param is not None}
+	# The browser already has the current values
+	if etag_matches(event, etag):
+		logger.info(f"The settings are unchanged (ETag {etag})")
+		return {
+			"statusCode": 304,
+			"headers": { "ETag": etag, "Cache-Control": "private, no-cache" },
+			"body": ""
+		}
 
-		primary_contact_email = params.get(primary_contact_email_param)
-		if primary_contact_email:
-			primary_contact_email = html.escape(primary_contact_email)
-		else:
-			primary_contact_email = ""
-		
-		primary_contact_message = params.get(primary_contact_message_param)
-		if primary_contact_message:
-			primary_contact_message = html.escape(primary_contact_message)
-		else:
-			primary_contact_message = ""
+	return {
+		"statusCode": 200,
+		"headers": { "Content-Type": "application/json", "ETag": etag, "Cache-Control": "private, no-cache" },
+		"body": json.dumps(settings_document(params, check_ins), separators=(',', ':'))
+	}
 
-		primary_contact_datetime = None
-		primary_contact_datetime_str = params.get(primary_contact_datetime_param)
-		if primary_contact_datetime_str:
-			primary_contact_datetime = datetime.datetime.fromisoformat(primary_contact_datetime_str)
+@metrics.per_invocation('lifecheck-settings-view')
+@parameters.per_invocation_stats
+def lambda_handler(event, context):
 
-		secondary_contact_email = params.get(secondary_contact_email_param)
-		if secondary_contact_email:
-			secondary_contact_email = html.escape(secondary_contact_email)
-		else:
-			secondary_contact_email = ""
+	if event.get('resource') == API_RESOURCE:
+		return api_response(event)
+	if SHELL_MODE:
+		return shell_response(event)
 
-		secondary_contact_message = params.get(secondary_contact_message_param)
-		if secondary_contact_message:
-			secondary_contact_message = html.escape(secondary_contact_message)
-		else:
-			secondary_contact_message = ""
+	logger.info(f"Attempting to render the settings application")
 
-		secondary_contact_datetime = None
-		secondary_contact_datetime_str = params.get(secondary_contact_datetime_param)
-		if secondary_contact_datetime_str:
-			secondary_contact_datetime = datetime.datetime.fromisoformat(secondary_contact_datetime_str)
+	try:
+		# Retrieve parameter values from Parameter Store
+		logger.info(f"Attempting to retrieve parameters from the Parameter Store")
 
-		emergency_contact_email = params.get(emergency_contact_email_param)
-		if emergency_contact_email:
-			emergency_contact_email = html.escape(emergency_contact_email)
-		else:
-			emergency_contact_email = ""
+		params, check_ins, etag = load_settings_view()
 
-		emergency_contact_phone = params.get(emergency_contact_phone_param)
-		if emergency_contact_phone:
-			emergency_contact_phone = html.escape(emergency_contact_phone)
-		else:
-			emergency_contact_phone = ""
+		# The browser already has the current page
+		if etag_matches(event, etag):
+			logger.info(f"The settings page is unchanged (ETag {etag})")
+			return {
+				"statusCode": 304,
+				"headers": { "ETag": etag, "Cache-Control": "private, no-cache" },
+				"body": ""
+			}
 
-		emergency_contact_message = params.get(emergency_contact_message_param)
-		if emergency_contact_message:
-			emergency_contact_message = html.escape(emergency_contact_message)
+		if rendered_page["etag"] != etag:
+			with metrics.phase('render'):
+				rendered_page["body"] = render_settings_page(params, check_ins)
+			rendered_page["etag"] = etag
 		else:
-			emergency_contact_message = ""
-
-		emergency_contact_datetime = None
-		emergency_contact_datetime_str = params.get(emergency_contact_datetime_param)
-		if emergency_contact_datetime_str:
-			emergency_contact_datetime = datetime.datetime.fromisoformat(emergency_contact_datetime_str)
+			logger.info(f"Using the settings page rendered previously (ETag {etag})")
 
 	except Exception as e:
 		logger.error(f"Error retrieving parameters from Parameter Store: {str(e)}")
@@ -129,6 +373,97 @@ def lambda_handler(event, context):
 			"body": f"Error retrieving parameters from Parameter Store: {str(e)}"
 		}
 
+	# Return the HTML content and a successful status code
+	return {
+		"statusCode": 200,
+		"headers": { "Content-Type": "text/html", "ETag": etag, "Cache-Control": "private, no-cache" },
+		"body": rendered_page["body"]
+	}
+
+# Function to render the number of check-ins on each recent day as a table row of tags
+def render_check_ins(check_ins):
+	if not check_ins:
+		return ""
+	days = "".join(
+		f"""<td class="has-text-centered"><span class="tag {'is-success' if count else 'is-light'}" title="{day.strftime('%A %d %B')}">{count}</span><br/><span class="is-size-7">{day.strftime('%d %b')}</span></td>"""
+		for day, count in check_ins
+	)
+	return f"""
+									<tr>
+										<th>Check-ins per day (last {len(check_ins)} days):</th>
+										<td><table class="table is-narrow"><tr>{days}</tr></table></td>
+									</tr>
+	"""
+
+# Function to render the settings page from the parameter values and the recent check-ins (None if no
+# verification history is kept), or the page shell without any values that loads them from the JSON API
+def render_settings_page(params, check_ins=None, shell=False):
+	logger.info(f"Parsing parameter values")
+
+	last_verification = None
+	last_verification_str = params.get('last_verification')
+	if last_verification_str:
+		last_verification = datetime.datetime.fromisoformat(last_verification_str)
+	elif not shell:
+		logger.error(f"Parameter last_verification not found")
+
+	primary_contact_email = params.get('primary_contact_email')
+	if primary_contact_email:
+		primary_contact_email = html.escape(primary_contact_email)
+	else:
+		primary_contact_email = ""
+	
+	primary_contact_message = params.get('primary_contact_message')
+	if primary_contact_message:
+		primary_contact_message = html.escape(primary_contact_message)
+	else:
+		primary_contact_message = ""
+
+	primary_contact_datetime = None
+	primary_contact_datetime_str = params.get('primary_contact_datetime')
+	if primary_contact_datetime_str:
+		primary_contact_datetime = datetime.datetime.fromisoformat(primary_contact_datetime_str)
+
+	secondary_contact_email = params.get('secondary_contact_email')
+	if secondary_contact_email:
+		secondary_contact_email = html.escape(secondary_contact_email)
+	else:
+		secondary_contact_email = ""
+
+	secondary_contact_message = params.get('secondary_contact_message')
+	if secondary_contact_message:
+		secondary_contact_message = html.escape(secondary_contact_message)
+	else:
+		secondary_contact_message = ""
+
+	secondary_contact_datetime = None
+	secondary_contact_datetime_str = params.get('secondary_contact_datetime')
+	if secondary_contact_datetime_str:
+		secondary_contact_datetime = datetime.datetime.fromisoformat(secondary_contact_datetime_str)
+
+	emergency_contact_email = params.get('emergency_contact_email')
+	if emergency_contact_email:
+		emergency_contact_email = html.escape(emergency_contact_email)
+	else:
+		emergency_contact_email = ""
+
+	emergency_contact_phone = params.get('emergency_contact_phone')
+	if emergency_contact_phone:
+		emergency_contact_phone = html.escape(emergency_contact_phone)
+	else:
+		emergency_contact_phone = ""
+
+	emergency_contact_message = params.get('emergency_contact_message')
+	if emergency_contact_message:
+		emergency_contact_message = html.escape(emergency_contact_message)
+	else:
+		emergency_contact_message = ""
+
+	emergency_contact_datetime = None
+	emergency_contact_datetime_str = params.get('emergency_contact_datetime')
+	if emergency_contact_datetime_str:
+		emergency_contact_datetime = datetime.datetime.fromisoformat(emergency_contact_datetime_str)
+
 	logger.info(f"Retrieved values from parameter store: last_verification='{last_verification}' primary_contact_datetime='{primary_contact_datetime}' primary_contact_email='{primary_contact_email}' primary_contact_message='{primary_contact_message}'")
 
 	# Define the HTML content to return as a response
@@ -155,20 +490,21 @@ def lambda_handler(event, context):
 								<table class="table">
 									<tr>
 										<th>Last Verification:</th>
-										<td><span class="has-text-info">{last_verification}</span></td>
+										<td><span class="has-text-info" id="last_verification" data-datetime>{last_verification}</span></td>
 									</tr>
 									<tr>
 										<th>Last Primary Contact Notification:</th>
-										<td><span class="has-text-info">{primary_contact_datetime}</span></td>
+										<td><span class="has-text-info" id="primary_contact_datetime" data-datetime>{primary_contact_datetime}</span></td>
 									</tr>
 									<tr>
 										<th>Last Secondary Contact Notification:</th>
-										<td><span class="has-text-info">{secondary_contact_datetime}</span></td>
+										<td><span class="has-text-info" id="secondary_contact_datetime" data-datetime>{secondary_contact_datetime}</span></td>
 									</tr>
 									<tr>
 										<th>Last Emergency Contact Notification:</th>
-										<td><span class="has-text-info">{emergency_contact_datetime}</span></td>
+										<td><span class="has-text-info" id="emergency_contact_datetime" data-datetime>{emergency_contact_datetime}</span></td>
 									</tr>
+									{'<tbody id="check_ins"></tbody>' if shell else render_check_ins(check_ins)}
 								</table>
 								<span class="help">Times are shown in Greenwich Mean Time (GMT)</span>
 							</div>
@@ -246,6 +582,8 @@ def lambda_handler(event, context):
 
 						<hr/>
 
+						<div id="status"></div>
+
 						<div class="field is-grouped mt-4">
   						<div class="control"><button type="submit" class="button is-link">Update</button></div>
 						</div>
@@ -253,13 +591,9 @@ def lambda_handler(event, context):
 					</form>
 				</div>
 			</section>
+			{SHELL_SCRIPT if shell else ""}
 		</body>
 	</html>
 	"""
 
-	# Return the HTML content and a successful status code
-	return {
-		"statusCode": 200,
-		"headers": { "Content-Type": "text/html" },
-		"body": html_content
-	}
+	return html_content
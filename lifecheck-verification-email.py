@@ -5,13 +5,15 @@ This script is a Lambda function that handles email verification requests.
 
 It performs the following tasks:
 
-1. Retrieves a temporary token from the query string parameter of the request.
-2. Fetches the stored token and its generation time from AWS Systems Manager Parameter Store.
-3. Verifies if the provided token matches the stored token and if it's still valid (not expired).
-4. If the token is valid and not expired:
+1. Retrieves the signed token from the query string parameter of the request.
+2. Validates the token's signature and expiry using the signing keys (see lifecheck/tokens.py), which
+   requires no state to be read as the token identifies the subject it verifies.
+3. If the token is valid and not expired:
     - Updates the `last_verification` parameter in Parameter Store with the current datetime.
     - Clears other relevant datetime parameters (e.g., notification timestamps).
-5. Returns an appropriate success or error response based on the verification outcome.
+    - Re-arms the notification timer for the first threshold after the verification, and appends the
+      check-in to the verification history (see lifecheck/history.py).
+4. Returns an appropriate success or error response based on the verification outcome.
 
 This function is typically triggered by an API Gateway endpoint that is accessed via a verification link 
 sent in an email. 
@@ -22,91 +24,75 @@ import boto3
 import datetime
 import logging
 
-ssm = boto3.client('ssm')
+from lifecheck import metrics
+from lifecheck import schedule
+from lifecheck import tokens
+from lifecheck.history import history_from_environment, record_check_in
+from lifecheck.parameters import ParameterCache
+from lifecheck.state import executor, state_from_environment
+
+ssm = metrics.instrument(boto3.client('ssm'))
+# The parameters used here are updated by other functions so they are always read from Parameter Store, except for
+# the token signing keys (which are re-read if a token was signed by a key that is not cached yet)
+parameters = ParameterCache(ssm, default_ttl=0, ttls={os.environ.get('TOKEN_KEYS_PARAM'): 3600})
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-TOKEN_VALID_DURATION = 2
+# The notification timer is re-armed after each verification (None if timers are not enabled)
+scheduler = None
+if os.environ.get('NOTIFICATION_SCHEDULE_GROUP'):
+	scheduler = schedule.scheduler_from_environment(metrics.instrument(boto3.client('scheduler')))
 
+@metrics.per_invocation('lifecheck-verification-email')
+@parameters.per_invocation_stats
 def lambda_handler(event, context):
 
-	# Retrieve the environment variables containing parameter names
-	last_verification_param = os.environ.get('LAST_VERIFICATION_PARAM')
-	primary_contact_datetime_param = os.environ.get('PRIMARY_CONTACT_DATETIME_PARAM')
-	secondary_contact_datetime_param = os.environ.get('SECONDARY_CONTACT_DATETIME_PARAM')
-	emergency_contact_datetime_param = os.environ.get('EMERGENCY_CONTACT_DATETIME_PARAM')
-	temp_token_param = os.environ.get('TEMP_TOKEN_PARAM')
-	temp_token_generation_time_param = os.environ.get('TEMP_TOKEN_GENERATION_TIME_PARAM')
-
 	# Retrieve the token from the URL query string parameter
-	provided_token = event['queryStringParameters']['token']
+	provided_token = (event.get('queryStringParameters') or {}).get('token') or ''
 
-	# Retrieve the stored token and its generation time from Parameter Store
+	# Validate the token, which identifies the subject it verifies (None when monitoring a single person)
+	current_time = datetime.datetime.now()
 	try:
-		response = ssm.get_parameters(
-			Names=[temp_token_param, temp_token_generation_time_param],
-			WithDecryption=False
-		)
-
-		stored_token = None
-		stored_token_generation_time_str = None
-
-		for param in response['Parameters']:
-			if param['Name'] == temp_token_param:
-				stored_token = param['Value']
-			elif param['Name'] == temp_token_generation_time_param:
-				stored_token_generation_time_str = param['Value']
-
-		if not stored_token or not stored_token_generation_time_str:
-			logger.error(f"Missing required parameters: stored_token='{stored_token}' stored_token_generation_time_str='{stored_token_generation_time_str}'")
-			return {
-				"statusCode": 500,
-				"body": "Error retrieving stored token or generation time"
-			}
-
-		stored_token_generation_time = datetime.datetime.fromisoformat(stored_token_generation_time_str)
-
-	except Exception as e:
-		logger.error(f"Error retrieving token from Parameter Store: {str(e)}")
+		with metrics.phase('validate'):
+			keyring = tokens.load_keyring(parameters, os.environ.get('TOKEN_KEYS_PARAM'), key_id=tokens.key_id(provided_token))
+			subject_id = tokens.validate(keyring, provided_token, current_time)
+	except tokens.ExpiredTokenError:
+		logger.error(f"The provided token has expired")
 		return {
-			"statusCode": 500,
-			"body": f"Error retrieving token from Parameter Store: {str(e)}"
+			"statusCode": 401,
+			"body": "Token has expired"
 		}
-
-	# Verify the token and its validity 
-	current_time = datetime.datetime.now()
-	token_valid_duration = datetime.timedelta(hours=TOKEN_VALID_DURATION)
-
-	logger.info(f"Checking tokens and elapsed time: provided_token='{provided_token}' stored_token='{stored_token}' current_time='{current_time}' stored_token_generation_time='{stored_token_generation_time}'")
-	if provided_token != stored_token:
-		logger.error(f"The provided token is invalid")
+	except tokens.InvalidTokenError as e:
+		logger.error(f"The provided token is invalid: {str(e)}")
 		return {
 			"statusCode": 401,
 			"body": "Invalid token"
 		}
-	elif current_time - stored_token_generation_time > token_valid_duration:
-		logger.error(f"The provided token has expired")
+	except Exception as e:
+		logger.error(f"Error retrieving the token signing keys from Parameter Store: {str(e)}")
 		return {
-			"statusCode": 401,
-			"body": "Token has expired"
+			"statusCode": 500,
+			"body": f"Error retrieving the token signing keys from Parameter Store: {str(e)}"
 		}
 
 	# If the token is valid then update last_verification and clear the other notification parameters
-	ssm.put_parameter(Name=last_verification_param, Value=current_time.isoformat(), Type='String', Overwrite=True)
-
-	parameters_to_clear = [
-		primary_contact_datetime_param,
-		secondary_contact_datetime_param,
-		emergency_contact_datetime_param,
-		temp_token_param,
-		temp_token_generation_time_param
-	]
-
 	try:
-		for param in parameters_to_clear:
-			ssm.delete_parameter(Name=param)
+		state = state_from_environment(parameters, subject_id)
+		with metrics.phase('reset'):
+			recorded = state.reset_verification(current_time)
 	except Exception as e:
-		logger.error(f"Error deleting parameter from Parameter Store: {str(e)}")
+		logger.error(f"Error updating parameters in Parameter Store: {str(e)}")
+		return {
+			"statusCode": 500,
+			"body": f"Error updating parameters in Parameter Store: {str(e)}"
+		}
+
+	# Move the notification timer to the first threshold after this verification and append it to the history
+	# (unless a later verification has already been recorded)
+	if recorded:
+		appended = executor.submit(record_check_in, history_from_environment(parameters, subject_id), current_time)
+		schedule.arm_next_run(scheduler, {'last_verification': current_time.isoformat()}, current_time, subject_id)
+		appended.result()
 
 	logger.info(f"Verification has been successful")
 
@@ -7,11 +7,21 @@ It performs the following tasks:
 
 1. Updates the `last_verification` parameter in Parameter Store with the current datetime.
 2. Clears other relevant datetime parameters (e.g., notification timestamps).
-3. Returns a success response.
+3. Re-arms the notification timer for the first threshold after the verification, and appends the
+   check-in to the verification history (see lifecheck/history.py).
+4. Returns a success response.
+
+Check-ins within VERIFICATION_DEBOUNCE_SECONDS (default 5 minutes) of the last verification return
+immediately without writing, so that several devices checking in together only write the state
+once. A check-in never moves last_verification backwards.
 
 This function is typically triggered by an API Gateway endpoint that receives verification
 requests from external clients or services, which is secured using an API key that was generated
 during the deployment process.
+
+In multi-subject mode the API key is shared by every subject, so each request must also carry a
+check-in token issued for its subject in the `token` query string parameter (see
+lifecheck/tokens.py). The subject is taken from the token rather than from the request.
 """
 
 import os
@@ -19,41 +29,87 @@ import boto3
 import datetime
 import logging
 
-ssm = boto3.client('ssm')
+from lifecheck import metrics
+from lifecheck import schedule
+from lifecheck import tokens
+from lifecheck.history import history_from_environment, record_check_in
+from lifecheck.parameters import ParameterCache
+from lifecheck.state import executor, state_from_environment
+
+ssm = metrics.instrument(boto3.client('ssm'))
+# The parameters used here are updated by other functions so they are always read from Parameter Store, except for
+# the token signing keys (which are re-read if a token was signed by a key that is not cached yet)
+parameters = ParameterCache(ssm, default_ttl=0, ttls={os.environ.get('TOKEN_KEYS_PARAM'): 3600})
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+DEFAULT_VERIFICATION_DEBOUNCE_SECONDS = 300
+verification_debounce_seconds = int(os.environ.get('VERIFICATION_DEBOUNCE_SECONDS', DEFAULT_VERIFICATION_DEBOUNCE_SECONDS))
+
+# The notification timer is re-armed after each verification (None if timers are not enabled)
+scheduler = None
+if os.environ.get('NOTIFICATION_SCHEDULE_GROUP'):
+	scheduler = schedule.scheduler_from_environment(metrics.instrument(boto3.client('scheduler')))
+
+@metrics.per_invocation('lifecheck-verification')
+@parameters.per_invocation_stats
 def lambda_handler(event, context):
 
 	logger.info(f"Attempting to perform verification...")
+	current_datetime = datetime.datetime.now()
 
-	# Retrieve the environment variables containing parameter names
-	last_verification_param = os.environ.get('LAST_VERIFICATION_PARAM')
-	primary_contact_datetime_param = os.environ.get('PRIMARY_CONTACT_DATETIME_PARAM')
-	secondary_contact_datetime_param = os.environ.get('SECONDARY_CONTACT_DATETIME_PARAM')
-	emergency_contact_datetime_param = os.environ.get('EMERGENCY_CONTACT_DATETIME_PARAM')
-	temp_token_param = os.environ.get('TEMP_TOKEN_PARAM')
-	temp_token_generation_time_param = os.environ.get('TEMP_TOKEN_GENERATION_TIME_PARAM')
-    
-	# Update last_verification and clear the other notification parameters
-	current_datetime = datetime.datetime.now().isoformat()
-	logger.info(f"Setting last_verification='{current_datetime}'")
-	ssm.put_parameter(Name=last_verification_param, Value=current_datetime, Type='String', Overwrite=True)
-
-	logger.info(f"Clearing previous notification datetimes...")
-	parameters_to_clear = [
-		primary_contact_datetime_param,
-		secondary_contact_datetime_param,
-		emergency_contact_datetime_param,
-		temp_token_param,
-		temp_token_generation_time_param
-	]
+	# In multi-subject mode the state of the subject that the check-in token was issued for is used
+	subject_id = None
+	if os.environ.get('SUBJECTS_PATH'):
+		provided_token = (event.get('queryStringParameters') or {}).get('token') or ''
+		try:
+			with metrics.phase('validate'):
+				keyring = tokens.load_keyring(parameters, os.environ.get('TOKEN_KEYS_PARAM'), key_id=tokens.key_id(provided_token))
+				subject_id = tokens.validate(keyring, provided_token, current_datetime, purpose=tokens.CHECK_IN_PURPOSE)
+		except tokens.InvalidTokenError as e:
+			logger.error(f"The provided check-in token is invalid: {str(e)}")
+			return {
+				"statusCode": 401,
+				"body": "Invalid check-in token"
+			}
+		except Exception as e:
+			logger.error(f"Error retrieving the token signing keys from Parameter Store: {str(e)}")
+			return {
+				"statusCode": 500,
+				"body": f"Error retrieving the token signing keys from Parameter Store: {str(e)}"
+			}
+		if not subject_id:
+			logger.error(f"The provided check-in token does not identify a subject")
+			return {
+				"statusCode": 401,
+				"body": "Invalid check-in token"
+			}
+	state = state_from_environment(parameters, subject_id)
 
+	# Update last_verification and clear the other notification parameters
+	logger.info(f"Setting last_verification='{current_datetime.isoformat()}' and clearing previous notification datetimes...")
 	try:
-		for param in parameters_to_clear:
-			ssm.delete_parameter(Name=param)
+		with metrics.phase('reset'):
+			recorded = state.reset_verification(current_datetime, verification_debounce_seconds)
 	except Exception as e:
-		logger.error(f"Error deleting parameter from Parameter Store: {str(e)}")
+		logger.error(f"Error updating parameters in Parameter Store: {str(e)}")
+		return {
+			"statusCode": 500,
+			"body": f"Error updating parameters in Parameter Store: {str(e)}"
+		}
+
+	if not recorded:
+		logger.info(f"A verification was already recorded within the last {verification_debounce_seconds} seconds - nothing to update")
+		return {
+			"statusCode": 200,
+			"body": "Verification successful (already recorded)"
+		}
+
+	# Append the check-in to the history while the notification timer is moved to the first threshold after
+	# this verification
+	appended = executor.submit(record_check_in, history_from_environment(parameters, subject_id), current_datetime)
+	schedule.arm_next_run(scheduler, {'last_verification': current_datetime.isoformat()}, current_datetime, subject_id)
+	appended.result()
 
 	logger.info(f"Verification has been successful")
 	return {
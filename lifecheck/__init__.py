@@ -0,0 +1,8 @@
+"""
+lifecheck
+
+Shared modules used by the Lifecheck Lambda functions. The handlers themselves remain in the
+lifecheck-*.py scripts at the root of the repository. Each function is built by the Makefile, which
+packages its handler script together with the modules of this directory (lifecheck/*.py) rather
+than the whole repository.
+"""
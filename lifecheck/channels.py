@@ -0,0 +1,141 @@
+"""
+lifecheck/channels.py
+
+Dispatching the notifications of the escalation tiers over their channels: email through SES and
+text messages (SMS) through SNS.
+
+Every delivery (an email, the bulk templated emails of a tier, or a text message) is started at
+once on a shared executor, so the channels of a tier, and the tiers themselves, are sent at the
+same time. Each delivery is waited for for at most the timeout of its channel
+(CHANNEL_TIMEOUT_SECONDS), measured from the moment the delivery started, so a slow channel never
+delays another. When there are more deliveries than workers (e.g. in multi-subject mode), the
+deliveries still waiting for a worker have not started, so their timeouts have not started
+either. The poller also passes a budget (the time left in its invocation, less the time needed to
+record the results), after which it stops waiting for any delivery, so that the outcomes are
+recorded even if the function timeout is set lower.
+
+The outcome of a delivery that times out after it started is unknown rather than failed: the
+request may still complete in the background, for as long as the client's own timeouts allow (see
+sns_config()), so the poller does not queue a timed-out email for retry, which could send it
+twice. A delivery that had not started when the wait ended is cancelled, so it is never sent, and
+its outcome is failed, so it is retried like any other failure.
+
+The poller counts a tier as delivered once any of its channels succeeds, so a contact with a
+phone number is still notified if SES fails, and the other way round.
+"""
+
+import re
+import time
+import logging
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger()
+
+# The longest time to wait for a delivery of each channel
+CHANNEL_TIMEOUT_SECONDS = {
+	'email': 10,
+	'sms': 5
+}
+DISPATCH_WORKERS = 16
+# How often a delivery that is waiting for a worker is checked for having started
+START_POLL_SECONDS = 0.05
+# SNS accepts text messages of up to 1600 characters (sent as several SMS parts if needed)
+SMS_MAX_LENGTH = 1600
+# SNS only delivers text messages to phone numbers in E.164 format, e.g. +61412345678
+PHONE_NUMBER_PATTERN = re.compile(r'^\+[1-9][0-9]{6,14}$')
+# The outcomes of a delivery: the request completed (some recipients may still have been rejected), the request
+# raised, or the request timed out and may still complete
+COMPLETED = 'completed'
+FAILED = 'failed'
+UNKNOWN = 'unknown'
+
+# Deliveries are not submitted from a with block, which would wait for the deliveries that timed out
+executor = ThreadPoolExecutor(max_workers=DISPATCH_WORKERS)
+
+# Function to return the botocore configuration of the SNS client, so that a text message that has timed out
+# does not keep a worker busy for long
+def sns_config():
+	from botocore.config import Config
+	timeout = CHANNEL_TIMEOUT_SECONDS['sms']
+	return Config(connect_timeout=timeout, read_timeout=timeout, retries={'max_attempts': 2})
+
+# Function to return the text message of a notification
+def sms_text(subject, message, verification_url=None):
+	text = f"{subject}: {message}"
+	if verification_url:
+		text = f"{text} {verification_url}"
+	return text[:SMS_MAX_LENGTH]
+
+# Function to send a text message with SNS, raising a ValueError if the phone number is not valid
+def send_sms(sns, phone_number, text):
+	if not PHONE_NUMBER_PATTERN.match(phone_number):
+		raise ValueError(f"Phone number {phone_number} is not in international format (e.g. +61412345678)")
+	sns.publish(
+		PhoneNumber=phone_number,
+		Message=text,
+		MessageAttributes={
+			# Transactional messages are delivered with the highest reliability
+			'AWS.SNS.SMS.SMSType': {'DataType': 'String', 'StringValue': 'Transactional'}
+		}
+	)
+
+# Function to wait for the result of a delivery, raising concurrent.futures.TimeoutError once it has run for longer
+# than timeout seconds or the deadline has passed (whether or not it has started)
+# started_at: a function returning the time the delivery started, or None if it has not started yet
+def wait_for(future, started_at, timeout, deadline=None):
+	while True:
+		start = started_at()
+		limits = ([start + timeout] if start is not None else []) + ([deadline] if deadline is not None else [])
+		until = min(limits) if limits else None
+		remaining = None if until is None else until - time.monotonic()
+		if remaining is not None and remaining <= 0:
+			raise concurrent.futures.TimeoutError()
+		# A delivery that has not started is checked again shortly, so that its timeout starts when it does
+		wait = START_POLL_SECONDS if start is None else remaining
+		if start is None and remaining is not None:
+			wait = min(wait, remaining)
+		try:
+			return future.result(timeout=wait)
+		except concurrent.futures.TimeoutError:
+			continue
+
+# Function to send deliveries concurrently, returning the errors of each delivery as a (errors, outcome) tuple,
+# where errors has the error of each recipient (None if it was sent) and outcome is COMPLETED, FAILED or UNKNOWN
+# deliveries: a list of (channel, recipients, send) tuples, where send() sends to the recipients and returns the
+#   error of each recipient
+# budget: if provided, the longest time in seconds to wait for all of the deliveries
+def dispatch(deliveries, timeouts=CHANNEL_TIMEOUT_SECONDS, budget=None):
+	deadline = None if budget is None else time.monotonic() + budget
+	starts = {}
+
+	def run(index, send):
+		starts[index] = time.monotonic()
+		return send()
+
+	futures = [executor.submit(run, index, send) for index, (channel, recipients, send) in enumerate(deliveries)]
+	results = []
+	for index, ((channel, recipients, send), future) in enumerate(zip(deliveries, futures)):
+		try:
+			results.append((wait_for(future, lambda: starts.get(index), timeouts[channel], deadline), COMPLETED))
+		except concurrent.futures.TimeoutError:
+			# A delivery that has not started is cancelled so that it is never sent
+			if future.cancel():
+				logger.error(f"The {channel} delivery to {len(recipients)} recipients was not started before the time ran out")
+				results.append((["Not sent as the time ran out before it started"] * len(recipients), FAILED))
+			elif future.done():
+				results.append(completed_result(future, recipients))
+			else:
+				timeout = min(timeouts[channel], deadline - starts[index]) if deadline is not None else timeouts[channel]
+				logger.error(f"Timed out waiting for the {channel} delivery to {len(recipients)} recipients after {timeout:g} seconds")
+				results.append(([f"Timed out after {timeout:g} seconds"] * len(recipients), UNKNOWN))
+		except Exception as e:
+			results.append(([str(e)] * len(recipients), FAILED))
+	return results
+
+# Function to return the result of a delivery that completed just as the wait for it ended
+def completed_result(future, recipients):
+	try:
+		return future.result(), COMPLETED
+	except Exception as e:
+		return [str(e)] * len(recipients), FAILED
@@ -0,0 +1,168 @@
+"""
+lifecheck/escalation.py
+
+The notification tiers and the time thresholds at which each tier is escalated to, shared by the
+notification poller (to decide which tiers are due) and the functions that schedule the poller (to
+work out when the next tier will become due).
+
+The tiers are defined by a table, which is loaded once per warm container from the
+ESCALATION_TIERS environment variable (a JSON list) or defaults to the primary, secondary and
+emergency contacts at 30, 40 and 48 hours. Each tier has:
+- contact: the prefix of the tier's state fields (<contact>_email, <contact>_message,
+  <contact>_datetime and, for tiers notified by SMS, <contact>_phone)
+- threshold_hours: the hours since the last verification after which the tier is notified
+- resend_hours: if set, the tier is notified again after this many hours until the next tier's
+  threshold is reached
+- subject and label: the email subject and the name used in the logs
+- verification_link: whether the email includes a link to verify via email
+- channels: how the contact is notified - "email", "sms" or both (see lifecheck/channels.py); the
+  emergency contact is notified by both by default, and the other tiers by email
+
+Every tier whose threshold has passed and that has not been notified is due, so a run that happens
+after several thresholds have passed (e.g. because the poller was unavailable) notifies all of
+them at once.
+
+The time the next tier becomes due is also stored in the state as next_action_at whenever the
+verification or notification state changes, so that the poller can decide that nothing is due
+from that single value.
+"""
+
+import os
+import re
+import json
+import datetime
+
+SECONDS_PER_HOUR = 3600.0
+NEVER = float('inf')
+
+DEFAULT_TIERS = [
+	{
+		"contact": "primary_contact",
+		"threshold_hours": 30,
+		"resend_hours": 1,
+		"subject": "Lifecheck Verification Timeout",
+		"label": "Primary",
+		"verification_link": True
+	},
+	{
+		"contact": "secondary_contact",
+		"threshold_hours": 40,
+		"subject": "Warning: Lifecheck Verification Timeout",
+		"label": "Secondary"
+	},
+	{
+		"contact": "emergency_contact",
+		"threshold_hours": 48,
+		"subject": "Emergency: Lifecheck Verification Timeout",
+		"label": "Emergency",
+		"channels": ["email", "sms"]
+	}
+]
+
+CHANNELS = ['email', 'sms']
+
+CONTACT_PATTERN = re.compile(r'^[a-z][a-z0-9_]*$')
+
+# The next action time stored when every tier has been notified (until the next verification)
+NO_ACTION = datetime.datetime.max
+
+# Function to load and validate the tier table, sorted by threshold
+def load_tiers(value=None):
+	tiers = json.loads(value) if value else DEFAULT_TIERS
+	if not isinstance(tiers, list) or not tiers:
+		raise ValueError("The escalation tiers must be a non-empty list")
+
+	loaded = []
+	for tier in tiers:
+		contact = tier.get('contact', '')
+		if not CONTACT_PATTERN.match(contact):
+			raise ValueError(f"Invalid escalation tier contact '{contact}'")
+		loaded.append({
+			"contact": contact,
+			"threshold_hours": float(tier['threshold_hours']),
+			"resend_hours": float(tier['resend_hours']) if tier.get('resend_hours') else None,
+			"subject": tier.get('subject', 'Lifecheck Verification Timeout'),
+			"label": tier.get('label', contact.removesuffix('_contact').replace('_', ' ').capitalize()),
+			"verification_link": bool(tier.get('verification_link', False)),
+			"channels": [channel for channel in CHANNELS if channel in tier.get('channels', ['email'])]
+		})
+		unknown = set(tier.get('channels', [])) - set(CHANNELS)
+		if unknown or not loaded[-1]['channels']:
+			raise ValueError(f"The channels of escalation tier '{contact}' must be one or more of {CHANNELS}")
+
+	if len({tier['contact'] for tier in loaded}) != len(loaded):
+		raise ValueError("Each escalation tier must have a different contact")
+	return sorted(loaded, key=lambda tier: tier['threshold_hours'])
+
+TIERS = load_tiers(os.environ.get('ESCALATION_TIERS'))
+
+# Function to return the state fields used by the tiers
+def tier_fields(tiers=TIERS):
+	fields = []
+	for tier in tiers:
+		fields += [f"{tier['contact']}_{suffix}" for suffix in ('email', 'message', 'datetime')]
+		if 'sms' in tier['channels']:
+			fields.append(f"{tier['contact']}_phone")
+	return fields
+
+# Function to return the state fields recording when each tier was notified
+def tier_datetime_fields(tiers=TIERS):
+	return [f"{tier['contact']}_datetime" for tier in tiers]
+
+def hours_since(current_time, value):
+	if not value:
+		return NEVER
+	return (current_time - datetime.datetime.fromisoformat(value)).total_seconds() / SECONDS_PER_HOUR
+
+# Function to determine which tiers are due given the elapsed time since the last verification and the hours
+# since each tier was notified (NEVER if it has not been notified since the last verification), returning the
+# indexes of the due tiers
+def due_tiers(elapsed_hours, contact_ages_hours, tiers=TIERS):
+	due = []
+	for index, tier in enumerate(tiers):
+		if elapsed_hours <= tier['threshold_hours']:
+			break
+		age = contact_ages_hours[index]
+		if age == NEVER:
+			due.append(index)
+		elif tier['resend_hours'] and age > tier['resend_hours']:
+			# Reminders are only resent until the next tier takes over
+			if index + 1 == len(tiers) or elapsed_hours <= tiers[index + 1]['threshold_hours']:
+				due.append(index)
+	return due
+
+# Function to determine the time at which the next tier becomes due (which may be in the past if a tier is already
+# due), or None if every tier has been notified
+# contact_datetimes: the time each tier was notified (None if it has not been notified since the last verification)
+def next_deadline(last_verification, contact_datetimes, current_time, tiers=TIERS):
+	deadlines = []
+	for index, tier in enumerate(tiers):
+		threshold_at = last_verification + datetime.timedelta(hours=tier['threshold_hours'])
+		notified_at = contact_datetimes[index]
+		if notified_at is None:
+			deadlines.append(threshold_at)
+		elif tier['resend_hours']:
+			resend_at = max(threshold_at, notified_at + datetime.timedelta(hours=tier['resend_hours']))
+			# A reminder is only due if it falls before the next tier takes over (and that has not already happened)
+			if index + 1 < len(tiers):
+				window_end = last_verification + datetime.timedelta(hours=tiers[index + 1]['threshold_hours'])
+				if resend_at < window_end and current_time < window_end:
+					deadlines.append(resend_at)
+			else:
+				deadlines.append(resend_at)
+
+	return min(deadlines) if deadlines else None
+
+# Function to determine the next deadline from the state of a subject (a dict of field to ISO datetime string)
+def deadline_from_values(values, current_time, tiers=TIERS):
+	last_verification_str = values.get('last_verification')
+	last_verification = datetime.datetime.fromisoformat(last_verification_str) if last_verification_str else current_time
+	contact_datetimes = [
+		datetime.datetime.fromisoformat(values[field]) if values.get(field) else None
+		for field in tier_datetime_fields(tiers)
+	]
+	return next_deadline(last_verification, contact_datetimes, current_time, tiers)
+
+# Function to return the next_action_at value to store for the state of a subject
+def next_action_at(values, current_time, tiers=TIERS):
+	return (deadline_from_values(values, current_time, tiers) or NO_ACTION).isoformat()
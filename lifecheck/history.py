@@ -0,0 +1,325 @@
+"""
+lifecheck/history.py
+
+An append-only log of every recorded check-in, so that the pattern of check-ins can be shown rather
+than only the last one.
+
+Check-in times are stored as epoch seconds in chunks of up to CHUNK_SIZE entries. Each chunk is an
+array of unsigned 32-bit integers holding the first time followed by the delta from each time to the
+next, stored as little-endian bytes in base64 (about 1.4 KB for a full chunk, within the 4 KB limit
+of a standard parameter). The log has a head record that holds the open chunk being appended to
+and an index of the sealed chunks (the first and last time and the number of entries of each):
+
+	{"count": <total entries>, "sealed": [[<first>, <last>, <count>], ...], "indexes": [[...], ...], "open": "<base64 chunk>"}
+
+The index in the head is capped at INDEX_SIZE entries: once it is full, its entries are written to
+an index record and replaced by a single entry in the next level of indexes (which is rolled into
+an index record of the level above once it is full in turn). The head therefore holds at most
+INDEX_SIZE entries per level, and the number of levels grows with the logarithm of the number of
+check-ins, so it stays well within the 4 KB limit (four levels hold over 16 million check-ins).
+
+Appending a check-in reads and writes only the head record (and writes one sealed chunk, plus an
+index record for each level that is rolled, when the open chunk is full). The head is replaced with
+a compare-and-swap against the value that was read, so concurrent check-ins (e.g. from a device and
+a verification link) never lose each other's entries: an append that loses the race reads the head
+again and retries. The key of a sealed chunk or index record includes its last time, so the records
+written by appends that lost the race are never referenced and cannot overwrite the records of the
+append that won. Readers use the indexes to read only the records that overlap the requested time
+range, one at a time, so a range or a downsampled summary of recent check-ins costs the same no
+matter how long the history is. Sealed chunks and index records never change, so they can be
+cached indefinitely.
+
+The records are kept by a store with get(key), put(key, value), replace(key, expected, value) (the
+compare-and-swap) and exclusive() (held around each append). A history is only kept if the
+HISTORY_PATH environment variable is set, as each append adds remote calls to every check-in. The
+records are then kept in parameters under HISTORY_PATH, or as items/rows of the DynamoDB and
+SQLite backends when they are configured (see lifecheck/state_dynamodb.py and
+lifecheck/state_sqlite.py). The DynamoDB and SQLite stores replace the head with a conditional
+write. Parameter Store has no conditional write, so its store serializes the appends of a subject
+with a lock parameter instead. Appends are made after the verification has been recorded, so the
+debounce and monotonic check-in rules apply to the history as well; times that are not later than
+the last entry are ignored.
+"""
+
+import os
+import sys
+import json
+import time
+import array
+import base64
+import logging
+import datetime
+import contextlib
+
+from lifecheck import subjects
+from lifecheck.state import SINGLE_SUBJECT_ID
+
+logger = logging.getLogger()
+
+CHUNK_SIZE = 256
+# The number of entries of each level of the index in the head, and of each index record
+INDEX_SIZE = 16
+# The array type code of an unsigned 32-bit integer on this platform
+TYPECODE = 'I' if array.array('I').itemsize == 4 else 'L'
+HEAD_KEY = 'head'
+# Sealed chunks are never changed, so they are cached for as long as the warm container lives
+SEALED_CHUNK_TTL_SECONDS = 86400
+# The number of times an append is retried after losing the race to replace the head
+APPEND_ATTEMPTS = 5
+# The lock that serializes the appends of a subject in Parameter Store, and the age after which a lock is treated as
+# left behind by a function that failed
+LOCK_KEY = 'lock'
+LOCK_TIMEOUT_SECONDS = 30
+LOCK_ATTEMPTS = 20
+LOCK_RETRY_SECONDS = 0.1
+
+class HistoryConflictError(Exception):
+	pass
+
+def to_epoch(value):
+	# The handlers use naive datetimes in UTC
+	return int(value.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+def from_epoch(value):
+	return datetime.datetime.fromtimestamp(value, datetime.timezone.utc).replace(tzinfo=None)
+
+# The last time is part of the key, so that appends that seal different chunks at the same index concurrently do not
+# overwrite each other's chunk
+def chunk_key(index, last):
+	return f"chunks/{index:08d}-{last}"
+
+def index_key(level, number, last):
+	return f"indexes/{level}/{number:08d}-{last}"
+
+# Function to return the key of a sealed chunk (level 0) or an index record (level 1 and above)
+def record_key(level, number, last):
+	return chunk_key(number, last) if level == 0 else index_key(level, number, last)
+
+# Function to summarize a list of index entries as a single entry
+def summarize(entries):
+	return [entries[0][0], entries[-1][1], sum(count for first, last, count in entries)]
+
+# Function to encode a list of ascending epoch times as a delta-encoded array
+def encode_chunk(times):
+	values = array.array(TYPECODE, [times[0]] + [current - previous for previous, current in zip(times, times[1:])] if times else [])
+	if sys.byteorder != 'little':
+		values.byteswap()
+	return base64.b64encode(values.tobytes()).decode('ascii')
+
+# Function to decode a chunk into the list of epoch times
+def decode_chunk(value):
+	values = array.array(TYPECODE)
+	values.frombytes(base64.b64decode(value or ''))
+	if sys.byteorder != 'little':
+		values.byteswap()
+	times = []
+	current = 0
+	for delta in values:
+		current += delta
+		times.append(current)
+	return times
+
+class VerificationHistory:
+
+	def __init__(self, store):
+		self.store = store
+
+	# Function to return the stored value of the head (None if there is none yet) and the head it holds
+	def _read_head(self):
+		value = self.store.get(HEAD_KEY)
+		if not value:
+			return value, {"count": 0, "sealed": [], "indexes": [], "open": ""}
+		head = json.loads(value)
+		head.setdefault('indexes', [])
+		return value, head
+
+	# Function to return the entries of each level of the index in the head (the sealed chunks first), and the
+	# number of the first record referenced by each level. Every sealed chunk holds CHUNK_SIZE entries and every
+	# index record INDEX_SIZE entries, so the numbers follow from the counts.
+	def _levels(self, head, open_count):
+		levels = [head['sealed']] + head['indexes']
+		firsts = []
+		total = (head['count'] - open_count) // CHUNK_SIZE
+		for entries in levels:
+			rolled = total - len(entries)
+			firsts.append(rolled)
+			total = rolled // INDEX_SIZE
+		return levels, firsts
+
+	# Function to append a check-in time, returning False if it is not later than the last entry
+	def append(self, value):
+		epoch = to_epoch(value)
+		for attempt in range(APPEND_ATTEMPTS):
+			with self.store.exclusive():
+				stored, head = self._read_head()
+				open_times = decode_chunk(head['open'])
+				levels, firsts = self._levels(head, len(open_times))
+				last = open_times[-1] if open_times else next((entries[-1][1] for entries in levels if entries), None)
+				if last is not None and epoch <= last:
+					return False
+
+				open_times.append(epoch)
+				if len(open_times) >= CHUNK_SIZE:
+					# The sealed chunk is written before the head that refers to it
+					self.store.put(chunk_key(firsts[0] + len(levels[0]), open_times[-1]), encode_chunk(open_times), sealed=True)
+					levels[0].append([open_times[0], open_times[-1], len(open_times)])
+					open_times = []
+					# The oldest INDEX_SIZE entries of each full level of the index are written to an index record and
+					# summarized in the level above (a head written before the index was capped may hold more)
+					level = 0
+					while level < len(levels):
+						if len(levels[level]) < INDEX_SIZE:
+							level += 1
+							continue
+						if level + 1 == len(levels):
+							levels.append([])
+							firsts.append(0)
+						entries = levels[level][:INDEX_SIZE]
+						summary = summarize(entries)
+						self.store.put(index_key(level + 1, firsts[level + 1] + len(levels[level + 1]), summary[1]), json.dumps(entries, separators=(',', ':')), sealed=True)
+						levels[level + 1].append(summary)
+						levels[level] = levels[level][INDEX_SIZE:]
+						firsts[level] += INDEX_SIZE
+					head['sealed'] = levels[0]
+					head['indexes'] = levels[1:]
+				head['open'] = encode_chunk(open_times)
+				head['count'] += 1
+				if self.store.replace(HEAD_KEY, stored, json.dumps(head, separators=(',', ':'))):
+					return True
+			logger.info(f"The verification history was appended to concurrently - retrying (attempt {attempt + 1} of {APPEND_ATTEMPTS})")
+		raise HistoryConflictError(f"The check-in could not be appended to the verification history after {APPEND_ATTEMPTS} attempts")
+
+	# Function to yield the epoch times of the chunks below a record that overlap a time range, reading each
+	# index record and chunk as it is needed
+	def _walk(self, level, number, first, last, start, end, reverse):
+		if (start is not None and last < start) or (end is not None and first >= end):
+			return
+		value = self.store.get(record_key(level, number, last), sealed=True)
+		if level == 0:
+			yield decode_chunk(value)
+			return
+		records = [(level - 1, number * INDEX_SIZE + index, first, last) for index, (first, last, count) in enumerate(json.loads(value))]
+		for record in (reversed(records) if reverse else records):
+			yield from self._walk(*record, start, end, reverse)
+
+	# Function to yield the epoch times of the chunks that overlap a time range, one chunk at a time (newest
+	# chunk first if reverse is True)
+	def _chunks(self, head, start, end, reverse=False):
+		open_times = decode_chunk(head['open'])
+		levels, firsts = self._levels(head, len(open_times))
+		# The highest level holds the oldest check-ins
+		records = [
+			(level, firsts[level] + index, first, last)
+			for level in reversed(range(len(levels)))
+			for index, (first, last, count) in enumerate(levels[level])
+		]
+		if reverse:
+			records.reverse()
+			if open_times:
+				yield open_times
+		for record in records:
+			yield from self._walk(*record, start, end, reverse)
+		if not reverse and open_times:
+			yield open_times
+
+	# Function to yield the check-in times (as datetimes) from start (inclusive) to end (exclusive), oldest first
+	# or newest first if reverse is True, reading only the chunks that overlap the range as they are needed
+	def read(self, start=None, end=None, reverse=False):
+		start = to_epoch(start) if start is not None else None
+		end = to_epoch(end) if end is not None else None
+		for times in self._chunks(self._read_head()[1], start, end, reverse):
+			for time in (reversed(times) if reverse else times):
+				if (start is None or time >= start) and (end is None or time < end):
+					yield from_epoch(time)
+
+	# Function to return the most recent check-in times, newest first
+	def recent(self, limit):
+		times = []
+		for value in self.read(reverse=True):
+			times.append(value)
+			if len(times) >= limit:
+				break
+		return times
+
+	# Function to count the check-ins in each bucket of bucket_seconds from start to end, returning a list of
+	# (bucket start, count) tuples (including empty buckets)
+	def summary(self, start, end, bucket_seconds):
+		start_epoch = to_epoch(start)
+		counts = [0] * max(0, -(-(to_epoch(end) - start_epoch) // bucket_seconds))
+		for value in self.read(start, end):
+			counts[(to_epoch(value) - start_epoch) // bucket_seconds] += 1
+		return [(start + datetime.timedelta(seconds=index * bucket_seconds), count) for index, count in enumerate(counts)]
+
+	def count(self):
+		return self._read_head()[1]['count']
+
+class ParameterHistoryStore:
+
+	def __init__(self, parameters, path):
+		self.parameters = parameters
+		self.path = path.rstrip('/')
+
+	def get(self, key, sealed=False):
+		# The head is updated by other functions so it is always read from Parameter Store
+		return self.parameters.get(f"{self.path}/{key}", ttl=SEALED_CHUNK_TTL_SECONDS if sealed else 0)
+
+	def put(self, key, value, sealed=False):
+		self.parameters.put(f"{self.path}/{key}", value)
+
+	# Function to replace a record, which cannot have changed since it was read as the appends hold the lock
+	def replace(self, key, expected, value):
+		self.put(key, value)
+		return True
+
+	# Function to hold the lock of the history while appending. The lock is a parameter created with Overwrite=False,
+	# which fails if another append holds it, and deleted afterwards.
+	@contextlib.contextmanager
+	def exclusive(self):
+		name = f"{self.path}/{LOCK_KEY}"
+		for attempt in range(LOCK_ATTEMPTS):
+			try:
+				self.parameters.put(name, str(int(time.time())), overwrite=False)
+				break
+			except self.parameters.ssm.exceptions.ParameterAlreadyExists:
+				locked_at = self.parameters.get(name, ttl=0)
+				if locked_at and time.time() - int(locked_at) > LOCK_TIMEOUT_SECONDS:
+					logger.warning(f"Removing the verification history lock '{name}' left since {locked_at}")
+					self.parameters.delete_many([name])
+				else:
+					time.sleep(LOCK_RETRY_SECONDS)
+		else:
+			raise HistoryConflictError(f"Timed out waiting for the verification history lock '{name}'")
+		try:
+			yield
+		finally:
+			self.parameters.delete_many([name])
+
+# Function to create the history configured by the environment variables (for the subject identified in the
+# request when running in multi-subject mode), or None if no history is kept
+def history_from_environment(parameters, subject_id=None):
+	subjects_path = os.environ.get('SUBJECTS_PATH')
+	table = os.environ.get('STATE_TABLE')
+	database_path = os.environ.get('STATE_DATABASE')
+	history_path = os.environ.get('HISTORY_PATH')
+	if not history_path:
+		return None
+
+	key = subjects.check_subject_id(subject_id) if subjects_path and subject_id else SINGLE_SUBJECT_ID
+	if table:
+		from lifecheck import state_dynamodb
+		return VerificationHistory(state_dynamodb.DynamoHistoryStore(table, key))
+	if database_path:
+		from lifecheck import state_sqlite
+		return VerificationHistory(state_sqlite.SqliteHistoryStore(state_sqlite.database(database_path), key))
+	# The history of each subject is kept outside the subjects path, so that it is not loaded with the state
+	return VerificationHistory(ParameterHistoryStore(parameters, f"{history_path}/{key}" if subjects_path and subject_id else history_path))
+
+# Function to append a check-in to the history (if one is kept), logging rather than raising any error as the
+# check-in has already been recorded
+def record_check_in(history, current_time):
+	if history is None:
+		return
+	try:
+		history.append(current_time)
+	except Exception as e:
+		logger.error(f"Error appending the check-in to the verification history: {str(e)}")
@@ -0,0 +1,81 @@
+"""
+lifecheck/identities.py
+
+An index of the email addresses that are verified in SES, used to confirm that a recipient is verified
+before an email is sent.
+
+Rather than listing every verified identity, only the recipients that are about to be contacted are
+looked up with GetIdentityVerificationAttributes (in batches of up to 100). Verified addresses are
+cached in the warm Lambda container for an hour. Addresses that are not verified yet are only
+remembered for a minute (long enough to cover a single run of the poller), so that a recipient who
+verifies their address is picked up on the next run. A contact address that is changed in the
+settings application is a new key in the index and is always looked up.
+
+The settings application also bumps an identities version parameter (IDENTITIES_VERSION_PARAM)
+whenever it creates an email identity in SES, and the poller passes the current version to
+check_version() before it sends, so the whole index is dropped as soon as any identity is created
+rather than when its entries expire.
+"""
+
+import time
+import logging
+
+logger = logging.getLogger()
+
+# GetIdentityVerificationAttributes accepts at most 100 identities per call
+GET_VERIFICATION_ATTRIBUTES_MAX_IDENTITIES = 100
+VERIFIED_TTL_SECONDS = 3600
+NOT_VERIFIED_TTL_SECONDS = 60
+
+class VerifiedIdentityIndex:
+
+	def __init__(self, ses, ttl=VERIFIED_TTL_SECONDS, not_verified_ttl=NOT_VERIFIED_TTL_SECONDS, clock=time.monotonic):
+		self.ses = ses
+		self.ttl = ttl
+		self.not_verified_ttl = not_verified_ttl
+		self.clock = clock
+		# identity -> (verified, expires_at)
+		self.entries = {}
+		# The identities version the entries were looked up at (see check_version())
+		self.version = None
+
+	def _fresh_entry(self, identity):
+		entry = self.entries.get(identity)
+		if entry is not None and self.clock() < entry[1]:
+			return entry
+		return None
+
+	# Function to look up the verification status of the identities that are not already known to be verified
+	def prefetch(self, identities):
+		pending = [identity for identity in dict.fromkeys(identities) if identity and self._fresh_entry(identity) is None]
+		for start in range(0, len(pending), GET_VERIFICATION_ATTRIBUTES_MAX_IDENTITIES):
+			batch = pending[start:start + GET_VERIFICATION_ATTRIBUTES_MAX_IDENTITIES]
+			response = self.ses.get_identity_verification_attributes(Identities=batch)
+			attributes = response['VerificationAttributes']
+			now = self.clock()
+			for identity in batch:
+				if attributes.get(identity, {}).get('VerificationStatus') == 'Success':
+					self.entries[identity] = (True, now + self.ttl)
+				else:
+					self.entries[identity] = (False, now + self.not_verified_ttl)
+			logger.info(f"Looked up SES verification status of {len(batch)} identities")
+
+	def is_verified(self, identity):
+		self.prefetch([identity])
+		entry = self._fresh_entry(identity)
+		return entry is not None and entry[0]
+
+	def invalidate(self, identities=None):
+		if identities is None:
+			self.entries.clear()
+		else:
+			for identity in identities:
+				self.entries.pop(identity, None)
+
+	# Function to drop every entry if the identities version has changed since the entries were looked up
+	def check_version(self, version):
+		if version != self.version:
+			if self.entries:
+				logger.info(f"The SES identities have changed (version '{version}') - dropping the cached verification status")
+			self.invalidate()
+			self.version = version
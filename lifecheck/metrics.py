@@ -0,0 +1,196 @@
+"""
+lifecheck/metrics.py
+
+Latency and call metrics for the Lambda functions, emitted in CloudWatch Embedded Metric Format
+(EMF) so that CloudWatch extracts them from the logs without any PutMetricData calls.
+
+Four kinds of measurements are recorded:
+- Every call made by an instrumented boto3 client (see instrument()), timed from the botocore
+  before-parameter-build event to the after-call (or after-call-error) event, with the number of
+  retries and whether the call failed. The dependency is named <service>.<operation>, e.g.
+  ssm.GetParameters.
+- Other outbound calls (e.g. HTTP requests to Google), timed with the dependency() context manager.
+- Handler phases (e.g. loading the state or rendering a page), timed with phase().
+- Failures that need attention (e.g. a notification timer that could not be armed), counted with
+  failure(). These are also published without the function dimension, so that a single alarm
+  covers every function.
+
+The measurements are aggregated in the warm Lambda container and written at the end of each
+invocation by the per_invocation() handler decorator, as one EMF record per dependency or phase with
+the individual latencies as a list of values, so that CloudWatch can calculate percentiles (e.g.
+p99) per dependency. The invocation record also includes the handler duration and whether the
+invocation was a cold start.
+
+Records are written to stdout (where Lambda sends them to CloudWatch Logs) unless another sink is
+set with set_sink(), e.g. a ListSink that collects them when testing.
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import functools
+import contextlib
+
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'Lifecheck')
+# EMF accepts at most 100 values for a metric in one record
+MAX_VALUES_PER_RECORD = 100
+# Dimensions that are also published without the function name
+CROSS_FUNCTION_DIMENSIONS = {'Failure'}
+
+class StdoutSink:
+
+	def emit(self, record):
+		sys.stdout.write(json.dumps(record, separators=(',', ':')) + '\n')
+		sys.stdout.flush()
+
+class ListSink:
+
+	def __init__(self):
+		self.records = []
+
+	def emit(self, record):
+		self.records.append(record)
+
+class MetricsRecorder:
+
+	def __init__(self, sink=None, clock=time.perf_counter):
+		self.sink = sink or StdoutSink()
+		self.clock = clock
+		self.function_name = None
+		self.cold_start = True
+		self.lock = threading.Lock()
+		# (dimension name, dimension value) -> metric name -> (unit, values)
+		self.measurements = {}
+
+	def record(self, dimension, value, metric, amount, unit):
+		with self.lock:
+			metrics = self.measurements.setdefault((dimension, value), {})
+			metrics.setdefault(metric, (unit, []))[1].append(amount)
+
+	# Function to record a call to a dependency
+	def record_call(self, dependency, latency_ms, retries=0, error=False):
+		self.record('Dependency', dependency, 'Latency', latency_ms, 'Milliseconds')
+		self.record('Dependency', dependency, 'Calls', 1, 'Count')
+		self.record('Dependency', dependency, 'Retries', retries, 'Count')
+		self.record('Dependency', dependency, 'Errors', 1 if error else 0, 'Count')
+
+	@contextlib.contextmanager
+	def dependency(self, name):
+		start = self.clock()
+		error = False
+		try:
+			yield
+		except Exception:
+			error = True
+			raise
+		finally:
+			self.record_call(name, (self.clock() - start) * 1000, error=error)
+
+	# Function to count a failure that should be alarmed on
+	def failure(self, name):
+		self.record('Failure', name, 'Failures', 1, 'Count')
+
+	@contextlib.contextmanager
+	def phase(self, name):
+		start = self.clock()
+		try:
+			yield
+		finally:
+			self.record('Phase', name, 'Latency', (self.clock() - start) * 1000, 'Milliseconds')
+
+	# Function to time every call made by a boto3 client, returning the client
+	def instrument(self, client):
+		# The start is recorded before the parameters are built rather than on before-call, which handlers such as
+		# the botocore Stubber answer without calling any later handlers
+		client.meta.events.register('before-parameter-build', self._before_call)
+		client.meta.events.register('after-call', self._after_call)
+		client.meta.events.register('after-call-error', self._after_call_error)
+		return client
+
+	def _before_call(self, context, **kwargs):
+		context['metrics_start'] = self.clock()
+
+	def _after_call(self, model, parsed, context, **kwargs):
+		start = context.get('metrics_start')
+		if start is None:
+			return
+		metadata = parsed.get('ResponseMetadata', {}) if isinstance(parsed, dict) else {}
+		status = metadata.get('HTTPStatusCode', 200)
+		dependency = f"{model.service_model.service_name}.{model.name}"
+		self.record_call(dependency, (self.clock() - start) * 1000, metadata.get('RetryAttempts', 0), status >= 300)
+
+	def _after_call_error(self, context, **kwargs):
+		start = context.get('metrics_start')
+		if start is None:
+			return
+		# The operation is not passed with errors, so the event name is recovered from the handler arguments
+		dependency = kwargs.get('event_name', 'after-call-error.unknown.unknown').split('.', 1)[1]
+		self.record_call(dependency, (self.clock() - start) * 1000, error=True)
+
+	# Function to write the aggregated measurements as EMF records and reset them
+	def flush(self, duration_ms=None):
+		with self.lock:
+			measurements = self.measurements
+			self.measurements = {}
+
+		timestamp = int(time.time() * 1000)
+		function_name = self.function_name or 'unknown'
+		if duration_ms is not None:
+			measurements[('Function', function_name)] = {
+				'Duration': ('Milliseconds', [duration_ms]),
+				'ColdStart': ('Count', [1 if self.cold_start else 0])
+			}
+			self.cold_start = False
+
+		for (dimension, value), metrics in measurements.items():
+			if dimension == 'Function':
+				dimensions = [["Function"]]
+			elif dimension in CROSS_FUNCTION_DIMENSIONS:
+				dimensions = [["Function", dimension], [dimension]]
+			else:
+				dimensions = [["Function", dimension]]
+			for start in range(0, max(len(values) for unit, values in metrics.values()), MAX_VALUES_PER_RECORD):
+				record = {
+					"_aws": {
+						"Timestamp": timestamp,
+						"CloudWatchMetrics": [{
+							"Namespace": NAMESPACE,
+							"Dimensions": dimensions,
+							"Metrics": [{"Name": metric, "Unit": unit} for metric, (unit, values) in metrics.items()]
+						}]
+					},
+					"Function": function_name,
+					dimension: value
+				}
+				for metric, (unit, values) in metrics.items():
+					chunk = values[start:start + MAX_VALUES_PER_RECORD]
+					record[metric] = chunk if len(chunk) != 1 else chunk[0]
+				self.sink.emit(record)
+
+	# Decorator for a lambda_handler that times the invocation and writes the metrics at the end of it
+	def per_invocation(self, function_name):
+		def decorator(handler):
+			@functools.wraps(handler)
+			def wrapper(event, context):
+				self.function_name = function_name
+				start = self.clock()
+				try:
+					return handler(event, context)
+				finally:
+					self.flush((self.clock() - start) * 1000)
+			return wrapper
+		return decorator
+
+# The recorder shared by the modules of a Lambda function
+recorder = MetricsRecorder()
+
+def set_sink(sink):
+	recorder.sink = sink
+
+instrument = recorder.instrument
+dependency = recorder.dependency
+phase = recorder.phase
+failure = recorder.failure
+per_invocation = recorder.per_invocation
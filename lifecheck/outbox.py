@@ -0,0 +1,175 @@
+"""
+lifecheck/outbox.py
+
+A durable outbox for notification emails that could not be sent, so that they are retried within
+seconds by the outbox worker (lifecheck-outbox.py) rather than on the next run of the poller.
+
+When sending an email fails, the poller writes it to an SQS FIFO queue (named by the
+OUTBOX_QUEUE_URL environment variable) as an entry holding the complete email and the state
+changes to record once it has been sent. The worker receives the entries and sends them. If a
+send fails again, the entry is made visible again after an exponential backoff with jitter (see
+backoff_seconds()), until the queue's redrive policy moves it to a dead-letter queue.
+
+Each entry has an idempotency key derived from the subject, the tier, the last verification and
+the time the tier was last notified, so the same notification always has the same key:
+- The key is the FIFO deduplication ID, so an entry queued twice (e.g. by two runs of the poller)
+  is only delivered once.
+- Entries are grouped by subject, so the entries of a subject are never sent concurrently. Once
+  an entry of a group fails, the later entries of that group in the same batch are not sent but
+  returned to the queue with it, so that they are still sent in order.
+- Before sending, the worker reads the state of the subject and drops the entry if the person
+  has checked in since, or if the tier has been notified since (e.g. by the poller itself once
+  SES recovered). Recording the notification time after sending marks the key as used.
+
+The InMemoryOutbox can be used in place of SQS when testing, and process() applies the same
+retry rules to the entries of either.
+"""
+
+import os
+import json
+import math
+import time
+import random
+import hashlib
+import logging
+
+logger = logging.getLogger()
+
+# SendMessageBatch accepts at most 10 messages per call
+SEND_MESSAGE_BATCH_MAX_ENTRIES = 10
+# SQS FIFO queues drop a message with the same deduplication ID sent within 5 minutes
+DEDUPLICATION_SECONDS = 300
+# The first retry is after about a second, doubling up to the cap
+BACKOFF_BASE_SECONDS = 1
+BACKOFF_CAP_SECONDS = 300
+# The message group of the single person being monitored (subject IDs are used in multi-subject mode)
+SINGLE_SUBJECT_GROUP = "lifecheck"
+
+# Function to return the FIFO message group of an entry
+def message_group(entry):
+	return entry['subject_id'] or SINGLE_SUBJECT_GROUP
+
+# Function to derive the idempotency key of the notification of a tier
+def idempotency_key(subject_id, contact, last_verification, previous_notification):
+	value = json.dumps([subject_id, contact, last_verification, previous_notification])
+	return hashlib.sha256(value.encode()).hexdigest()
+
+# Function to return the delay before retrying an entry after the given number of attempts, doubling with each
+# attempt up to the cap, with half of the delay randomised so that retries after an outage are spread out
+def backoff_seconds(attempt, base=BACKOFF_BASE_SECONDS, cap=BACKOFF_CAP_SECONDS, uniform=random.uniform):
+	delay = min(cap, base * 2 ** max(0, attempt - 1))
+	return delay / 2 + uniform(0, delay / 2)
+
+class SqsOutbox:
+
+	def __init__(self, client, queue_url):
+		self.client = client
+		self.queue_url = queue_url
+
+	# Function to queue entries, returning the keys of the entries that could not be queued
+	def put(self, entries):
+		rejected = []
+		for start in range(0, len(entries), SEND_MESSAGE_BATCH_MAX_ENTRIES):
+			batch = entries[start:start + SEND_MESSAGE_BATCH_MAX_ENTRIES]
+			response = self.client.send_message_batch(
+				QueueUrl=self.queue_url,
+				Entries=[
+					{
+						"Id": str(index),
+						"MessageBody": json.dumps(entry),
+						"MessageGroupId": message_group(entry),
+						"MessageDeduplicationId": entry['key']
+					}
+					for index, entry in enumerate(batch)
+				]
+			)
+			for failure in response.get('Failed', []):
+				logger.error(f"Error queueing outbox entry: {failure.get('Code')} {failure.get('Message')}")
+				rejected.append(batch[int(failure['Id'])]['key'])
+		return rejected
+
+	# Function to make a received entry visible again after a delay
+	def retry(self, receipt_handle, delay_seconds):
+		# The visibility timeout is in whole seconds, and a timeout of 0 would make the entry visible immediately
+		self.client.change_message_visibility(QueueUrl=self.queue_url, ReceiptHandle=receipt_handle, VisibilityTimeout=max(1, math.ceil(delay_seconds)))
+
+class InMemoryOutbox:
+
+	def __init__(self, clock=time.monotonic):
+		self.clock = clock
+		# key -> {"entry", "attempts", "visible_at"}
+		self.entries = {}
+		# key -> time the key was last queued (for deduplication)
+		self.queued = {}
+
+	def put(self, entries):
+		now = self.clock()
+		for entry in entries:
+			if now - self.queued.get(entry['key'], -DEDUPLICATION_SECONDS) < DEDUPLICATION_SECONDS:
+				continue
+			self.queued[entry['key']] = now
+			self.entries[entry['key']] = {"entry": entry, "attempts": 0, "visible_at": now}
+		return []
+
+	# Function to receive the visible entries as (receipt handle, entry, attempt) tuples
+	def receive(self):
+		now = self.clock()
+		received = []
+		for key, item in self.entries.items():
+			if item['visible_at'] <= now:
+				item['attempts'] += 1
+				received.append((key, item['entry'], item['attempts']))
+		return received
+
+	def retry(self, receipt_handle, delay_seconds):
+		self.entries[receipt_handle]['visible_at'] = self.clock() + delay_seconds
+
+	def delete(self, receipt_handle):
+		self.entries.pop(receipt_handle, None)
+
+	# Function to deliver the visible entries as the worker would, deleting the entries that were delivered and
+	# returning their number
+	def drain(self, deliver):
+		received = self.receive()
+		failed = set(process(self, received, deliver))
+		for receipt_handle, entry, attempt in received:
+			if receipt_handle not in failed:
+				self.delete(receipt_handle)
+		return len(received) - len(failed)
+
+# Function to deliver received entries, scheduling a retry with backoff for each entry that fails and returning
+# the receipt handles of the entries that failed. The entries after a failed entry of the same message group are
+# not delivered, and are returned as failed with the same delay so that the group stays in order.
+# received: a list of (receipt handle, entry, attempt) tuples, in the order of the queue
+# deliver: a function that sends an entry (or decides it is no longer needed) and raises if it failed
+def process(outbox, received, deliver):
+	failed = []
+	# message group -> delay before the failed entry of the group is retried
+	blocked = {}
+	for receipt_handle, entry, attempt in received:
+		group = message_group(entry)
+		if group in blocked:
+			delay = blocked[group]
+			logger.info(f"Returning outbox entry {entry['key'][:12]} to the queue - an earlier entry of its group failed")
+		else:
+			try:
+				deliver(entry)
+				continue
+			except Exception as e:
+				delay = backoff_seconds(attempt)
+				blocked[group] = delay
+				logger.error(f"Error delivering outbox entry {entry['key'][:12]} (attempt {attempt}), retrying in {delay:.1f} seconds: {str(e)}")
+		try:
+			outbox.retry(receipt_handle, delay)
+		except Exception as retry_error:
+			# The entry is retried after the queue's visibility timeout instead
+			logger.error(f"Error scheduling the retry of outbox entry {entry['key'][:12]}: {str(retry_error)}")
+		failed.append(receipt_handle)
+	return failed
+
+# Function to create the outbox configured by the environment, or None if failed sends are not queued
+def outbox_from_environment(client_factory):
+	queue_url = os.environ.get('OUTBOX_QUEUE_URL')
+	if not queue_url:
+		return None
+	return SqsOutbox(client_factory(), queue_url)
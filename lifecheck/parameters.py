@@ -0,0 +1,167 @@
+"""
+lifecheck/parameters.py
+
+A read-through cache of Parameter Store values shared by the Lambda functions.
+
+Values are kept in the warm Lambda container and are only re-read from Parameter Store once their
+time-to-live has expired. Parameters that are updated by other functions (e.g. last_verification)
+should be read with a TTL of 0 so that they are always current, while configuration such as the
+Google client details can be cached for longer. Writes and deletes made through the cache update
+it immediately, and all stale names requested together are coalesced into the fewest possible
+GetParameters calls, which are issued concurrently when there is more than one.
+
+The cache counts hits, misses and SSM calls so that the savings can be logged for each invocation.
+"""
+
+import time
+import logging
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger()
+
+# GetParameters and DeleteParameters accept at most 10 names per call
+GET_PARAMETERS_MAX_NAMES = 10
+DELETE_PARAMETERS_MAX_NAMES = 10
+DEFAULT_TTL_SECONDS = 300
+# GetParameters calls for more than 10 names are issued concurrently on a shared executor (only used for the
+# calls themselves, so a read running on another executor can wait for them without risk of deadlock)
+GET_PARAMETERS_WORKERS = 4
+executor = ThreadPoolExecutor(max_workers=GET_PARAMETERS_WORKERS)
+
+class ParameterCache:
+
+	def __init__(self, ssm, default_ttl=DEFAULT_TTL_SECONDS, ttls=None, clock=time.monotonic):
+		self.ssm = ssm
+		self.default_ttl = default_ttl
+		self.ttls = dict(ttls or {})
+		self.clock = clock
+		# name -> (value, version, expires_at), where a value of None records a parameter that does not exist
+		self.entries = {}
+		# The cache may be used from several threads when writes are issued concurrently
+		self.stats_lock = threading.Lock()
+		self.reset_stats()
+
+	def count_ssm_call(self):
+		with self.stats_lock:
+			self.ssm_calls += 1
+
+	def count_lookup(self, hit):
+		with self.stats_lock:
+			if hit:
+				self.hits += 1
+			else:
+				self.misses += 1
+
+	def reset_stats(self):
+		self.hits = 0
+		self.misses = 0
+		self.ssm_calls = 0
+
+	def stats(self):
+		return {"hits": self.hits, "misses": self.misses, "ssm_calls": self.ssm_calls}
+
+	def log_stats(self):
+		logger.info(f"Parameter cache: hits={self.hits} misses={self.misses} ssm_calls={self.ssm_calls}")
+
+	# Decorator for a lambda_handler that resets the counters at the start of each invocation and logs them at the end
+	def per_invocation_stats(self, handler):
+		@functools.wraps(handler)
+		def wrapper(event, context):
+			self.reset_stats()
+			try:
+				return handler(event, context)
+			finally:
+				self.log_stats()
+		return wrapper
+
+	def ttl(self, name, ttl=None):
+		if ttl is not None:
+			return ttl
+		return self.ttls.get(name, self.default_ttl)
+
+	def _store(self, name, value, version, ttl=None):
+		self.entries[name] = (value, version, self.clock() + self.ttl(name, ttl))
+
+	def _fresh_entry(self, name):
+		entry = self.entries.get(name)
+		if entry is not None and self.clock() < entry[2]:
+			return entry
+		return None
+
+	# Function to retrieve several parameters, returning a dict of name to value for the parameters that exist
+	# (ttl overrides the configured time-to-live of the requested names)
+	def get_many(self, names, ttl=None):
+		names = [name for name in dict.fromkeys(names) if name]
+		stale = []
+		for name in names:
+			entry = self._fresh_entry(name)
+			hit = entry is not None and ttl != 0
+			self.count_lookup(hit)
+			if not hit:
+				stale.append(name)
+
+		batches = [stale[start:start + GET_PARAMETERS_MAX_NAMES] for start in range(0, len(stale), GET_PARAMETERS_MAX_NAMES)]
+		if len(batches) > 1:
+			list(executor.map(lambda batch: self._fetch(batch, ttl), batches))
+		elif batches:
+			self._fetch(batches[0], ttl)
+
+		values = {}
+		for name in names:
+			value = self.entries[name][0]
+			if value is not None:
+				values[name] = value
+		return values
+
+	# Function to read a batch of up to 10 parameters with GetParameters and store them in the cache
+	def _fetch(self, batch, ttl=None):
+		self.count_ssm_call()
+		response = self.ssm.get_parameters(Names=batch, WithDecryption=False)
+		found = set()
+		for param in response['Parameters']:
+			self._store(param['Name'], param['Value'], param.get('Version'), ttl)
+			found.add(param['Name'])
+		for name in batch:
+			if name not in found:
+				self._store(name, None, None, ttl)
+
+	# Function to retrieve a single parameter, returning None if it does not exist
+	def get(self, name, ttl=None):
+		return self.get_many([name], ttl).get(name)
+
+	# Function to return the cached version of a parameter (None if it has not been read or does not exist)
+	def version(self, name):
+		entry = self.entries.get(name)
+		return entry[1] if entry else None
+
+	# Function to write a parameter to Parameter Store and update the cache, returning the new version (if overwrite
+	# is False and the parameter already exists, ParameterAlreadyExists is raised)
+	def put(self, name, value, tier=None, overwrite=True):
+		self.count_ssm_call()
+		if tier:
+			response = self.ssm.put_parameter(Name=name, Value=value, Type='String', Overwrite=overwrite, Tier=tier)
+		else:
+			response = self.ssm.put_parameter(Name=name, Value=value, Type='String', Overwrite=overwrite)
+		version = response.get('Version') if response else None
+		self._store(name, value, version)
+		return version
+
+	# Function to delete several parameters with DeleteParameters and update the cache. Parameters that do not
+	# exist are ignored, so that one missing parameter does not prevent the others from being deleted.
+	def delete_many(self, names):
+		names = list(dict.fromkeys(names))
+		for start in range(0, len(names), DELETE_PARAMETERS_MAX_NAMES):
+			batch = names[start:start + DELETE_PARAMETERS_MAX_NAMES]
+			self.count_ssm_call()
+			self.ssm.delete_parameters(Names=batch)
+			for name in batch:
+				self._store(name, None, None)
+
+	def invalidate(self, names=None):
+		if names is None:
+			self.entries.clear()
+		else:
+			for name in names:
+				self.entries.pop(name, None)
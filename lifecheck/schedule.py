@@ -0,0 +1,145 @@
+"""
+lifecheck/schedule.py
+
+Deadline-driven scheduling of the notification poller.
+
+Rather than polling on a fixed interval, the time at which the next notification tier becomes due is
+calculated from the last verification and the notifications already sent, and a one-shot timer is
+armed to invoke the poller at that moment. The poller re-arms the timer after each run, and a
+verification re-arms it for the first threshold after the check-in.
+
+Timers are EventBridge Scheduler one-time schedules (one per subject in multi-subject mode) that are
+created in the schedule group named by the NOTIFICATION_SCHEDULE_GROUP environment variable. If the
+group is not configured, no timers are armed and the poller only runs on its fixed schedule. The
+InMemoryScheduler can be used in place of EventBridge Scheduler when testing.
+
+A timer that could not be armed is counted as a TimerArm failure metric (see lifecheck/metrics.py),
+which raises an alarm, as a missed timer delays the next notification until the fixed schedule runs.
+"""
+
+import os
+import json
+import datetime
+import logging
+
+from lifecheck import escalation
+from lifecheck import metrics
+
+logger = logging.getLogger()
+
+# The source included in the event sent by a timer, to distinguish it from the fixed schedule
+DEADLINE_EVENT_SOURCE = "lifecheck.deadline"
+
+# The schedule name used when monitoring a single person (subject IDs are used in multi-subject mode)
+SINGLE_SUBJECT_SCHEDULE_NAME = "lifecheck"
+
+# The thresholds are exclusive, so timers fire shortly after the deadline has passed
+SCHEDULE_MARGIN_SECONDS = 60
+# If a tier is already due (e.g. because sending failed), the poller is retried after this delay
+RETRY_DELAY_SECONDS = 900
+
+class EventBridgeScheduler:
+
+	def __init__(self, client, group_name, target_arn, role_arn):
+		self.client = client
+		self.group_name = group_name
+		self.target_arn = target_arn
+		self.role_arn = role_arn
+
+	# Function to create or move the one-time schedule that invokes the poller at the given (UTC) time
+	def arm(self, name, at, subject_id=None):
+		request = {
+			"Name": name,
+			"GroupName": self.group_name,
+			"ScheduleExpression": f"at({at.strftime('%Y-%m-%dT%H:%M:%S')})",
+			"FlexibleTimeWindow": {"Mode": "OFF"},
+			"Target": {
+				"Arn": self.target_arn,
+				"RoleArn": self.role_arn,
+				"Input": json.dumps(deadline_event(at, subject_id))
+			},
+			# The schedule is kept after it fires so that it can be updated rather than recreated
+			"ActionAfterCompletion": "NONE"
+		}
+		try:
+			self.client.update_schedule(**request)
+		except self.client.exceptions.ResourceNotFoundException:
+			self.client.create_schedule(**request)
+
+class InMemoryScheduler:
+
+	def __init__(self):
+		# schedule name -> (time, subject ID)
+		self.schedules = {}
+
+	def arm(self, name, at, subject_id=None):
+		self.schedules[name] = (at, subject_id)
+
+	# Function to remove and return the events of the schedules that have fired by the given time
+	def fire(self, current_time):
+		fired = [name for name, (at, subject_id) in self.schedules.items() if at <= current_time]
+		return [deadline_event(*self.schedules.pop(name)) for name in fired]
+
+# Function to create the scheduler configured by the environment variables, or None if timers are not enabled
+# (target_arn overrides the NOTIFICATION_FUNCTION_ARN environment variable)
+def scheduler_from_environment(client, target_arn=None):
+	group_name = os.environ.get('NOTIFICATION_SCHEDULE_GROUP')
+	role_arn = os.environ.get('NOTIFICATION_SCHEDULE_ROLE_ARN')
+	target_arn = target_arn or os.environ.get('NOTIFICATION_FUNCTION_ARN')
+	if not group_name or not role_arn or not target_arn:
+		return None
+	return EventBridgeScheduler(client, group_name, target_arn, role_arn)
+
+def schedule_name(subject_id=None):
+	return subject_id or SINGLE_SUBJECT_SCHEDULE_NAME
+
+# Function to return the event sent by the timer armed for the given time
+def deadline_event(at, subject_id=None):
+	return {"source": DEADLINE_EVENT_SOURCE, "subject": subject_id, "at": at.isoformat()}
+
+def is_deadline_event(event):
+	return isinstance(event, dict) and event.get('source') == DEADLINE_EVENT_SOURCE
+
+# Function to determine whether an invocation was made by the timer armed for the given deadline, in which case
+# arming it again would not change it. Invocations by the fixed schedule always re-arm the timer, so that a timer
+# that was lost (e.g. because arming it failed) is restored.
+def is_armed_for(event, deadline, current_time):
+	at = run_time(deadline, current_time)
+	return is_deadline_event(event) and at is not None and event.get('at') == at.isoformat()
+
+# Function to determine when the poller should next run given the next deadline, or None if there is nothing
+# left to notify
+def run_time(deadline, current_time):
+	if deadline is None or deadline == escalation.NO_ACTION:
+		return None
+	if deadline <= current_time:
+		return current_time + datetime.timedelta(seconds=RETRY_DELAY_SECONDS)
+	return deadline + datetime.timedelta(seconds=SCHEDULE_MARGIN_SECONDS)
+
+# Function to arm the timer of a subject for the next time the poller should run given its state. Errors are
+# logged and counted as failures rather than raised, as the fixed schedule of the poller acts as a fallback.
+def arm_next_run(scheduler, values, current_time, subject_id=None):
+	try:
+		deadline = escalation.deadline_from_values(values, current_time)
+	except ValueError as e:
+		logger.error(f"Error calculating the next deadline for '{schedule_name(subject_id)}': {str(e)}")
+		metrics.failure('TimerArm')
+		return None
+	return arm_deadline(scheduler, deadline, current_time, subject_id)
+
+# Function to arm the timer of a subject for a known deadline
+def arm_deadline(scheduler, deadline, current_time, subject_id=None):
+	if scheduler is None:
+		return None
+	try:
+		at = run_time(deadline, current_time)
+		if at is None:
+			logger.info(f"No further notifications are due for '{schedule_name(subject_id)}' - timer not armed")
+			return None
+		scheduler.arm(schedule_name(subject_id), at, subject_id)
+		logger.info(f"Armed the notification timer for '{schedule_name(subject_id)}' at '{at}'")
+		return at
+	except Exception as e:
+		logger.error(f"Error arming the notification timer for '{schedule_name(subject_id)}': {str(e)}")
+		metrics.failure('TimerArm')
+		return None
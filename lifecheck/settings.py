@@ -0,0 +1,37 @@
+"""
+lifecheck/settings.py
+
+A concurrent fetch stage for the reads that a handler needs before it can do any work.
+
+Reads that do not depend on each other (e.g. the runtime state, the sending address and the
+subjects in multi-subject mode) are started together on a shared executor that is reused across
+warm invocations, so the time spent waiting for Parameter Store is roughly that of the slowest
+single read rather than the sum of them all. The results are merged into one Settings object.
+"""
+
+import logging
+import dataclasses
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger()
+
+FETCH_WORKERS = 4
+executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+
+@dataclasses.dataclass
+class Settings:
+	# The loaded state fields of the person being monitored (see lifecheck/state.py)
+	state: dict = dataclasses.field(default_factory=dict)
+	# The address that notifications are sent from
+	google_account_email: str | None = None
+	# The state of every subject in multi-subject mode (see lifecheck/subjects.py)
+	subjects: dict | None = None
+	# The number of check-ins in each recent period, as (period start, count) tuples (see lifecheck/history.py)
+	check_ins: list | None = None
+
+# Function to run independent reads concurrently and merge their results into a Settings object. Each keyword
+# argument names a Settings field and provides a function that performs the read. An error raised by a read is
+# raised to the caller.
+def fetch_settings(**reads):
+	futures = {field: executor.submit(read) for field, read in reads.items()}
+	return Settings(**{field: future.result() for field, future in futures.items()})
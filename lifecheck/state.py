@@ -0,0 +1,240 @@
+"""
+lifecheck/state.py
+
+Access to the runtime state of a person being monitored (last verification, notification datetimes
+and contact details).
+
+The state can be stored in one of the following ways:
+- ParameterState: one Parameter Store parameter per field (the default), with the parameter names
+  provided by the <FIELD>_PARAM environment variables.
+- DocumentState: a single JSON document stored in one parameter, enabled by setting the
+  STATE_DOCUMENT_PARAM environment variable. The whole state is read in one call and every update
+  is written in one call. Parameter Store has no conditional write, so concurrent updates are
+  best-effort last-writer-wins (see DocumentState.save()); use DynamoState where concurrent writers
+  must never lose an update.
+- DynamoState: one item per subject in a DynamoDB table, enabled by setting the STATE_TABLE
+  environment variable, for deployments that need more throughput than Parameter Store allows
+  (see lifecheck/state_dynamodb.py).
+- SqliteState: one row per subject in a local SQLite database, enabled by setting the
+  STATE_DATABASE environment variable, for development and testing (see lifecheck/state_sqlite.py).
+
+Every store provides the same methods, so the handlers do not depend on the backend: load() the
+fields that are needed, save() changes (where a value of None removes the field), versions() of the
+loaded fields, missing_fields() that cannot be stored and reset_verification(). The configuration
+parameters (e.g. the Google client details) are always read from Parameter Store.
+
+Changes to the verification or notification state also update next_action_at (see
+lifecheck/escalation.py).
+
+A verification is only written if it moves last_verification forwards by at least the debounce
+window, so repeated check-ins (e.g. from several devices) do not each write the state.
+"""
+
+import os
+import json
+import datetime
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from lifecheck import escalation
+from lifecheck import subjects
+
+logger = logging.getLogger()
+
+STATE_FIELDS = [
+	'last_verification',
+	'primary_contact_email',
+	'primary_contact_message',
+	'primary_contact_datetime',
+	'secondary_contact_email',
+	'secondary_contact_message',
+	'secondary_contact_datetime',
+	'emergency_contact_email',
+	'emergency_contact_phone',
+	'emergency_contact_message',
+	'emergency_contact_datetime',
+	'next_action_at'
+]
+
+# Fields of any additional escalation tiers configured by ESCALATION_TIERS
+STATE_FIELDS += [field for field in escalation.tier_fields() if field not in STATE_FIELDS]
+
+# The fields that are cleared when a verification is performed
+VERIFICATION_RESET_FIELDS = escalation.tier_datetime_fields()
+
+# Writes to individual parameters are issued concurrently on a shared executor
+PARAMETER_WRITE_WORKERS = 8
+executor = ThreadPoolExecutor(max_workers=PARAMETER_WRITE_WORKERS)
+
+# The state document includes the contact messages so it may exceed the 4 KB limit of a standard parameter
+DOCUMENT_PARAMETER_TIER = 'Intelligent-Tiering'
+
+# Function to determine whether a verification at current_time should be recorded: a verification within the
+# debounce window after the stored one is skipped, and last_verification is never moved backwards
+def should_record_verification(last_verification, current_time, debounce_seconds=0):
+	if not last_verification:
+		return True
+	elapsed_seconds = (current_time - datetime.datetime.fromisoformat(last_verification)).total_seconds()
+	return elapsed_seconds > 0 and elapsed_seconds >= debounce_seconds
+
+# Function to return the changes that record a verification: the notification datetimes are
+# cleared, and the next action is the first threshold after the verification
+# values: if provided, the current values of the reset fields, so that only the fields that are set are cleared
+def verification_changes(current_time, values=None):
+	changes = {field: None for field in VERIFICATION_RESET_FIELDS if values is None or values.get(field) is not None}
+	changes['last_verification'] = current_time.isoformat()
+	changes['next_action_at'] = escalation.next_action_at({'last_verification': changes['last_verification']}, current_time)
+	return changes
+
+class ParameterState:
+
+	def __init__(self, parameters, names):
+		self.parameters = parameters
+		self.names = names
+
+	def load(self, fields=STATE_FIELDS):
+		fields = [field for field in fields if field in self.names]
+		values = self.parameters.get_many([self.names[field] for field in fields])
+		return {field: values[self.names[field]] for field in fields if self.names[field] in values}
+
+	# Function to return the Parameter Store versions of the loaded fields (None for fields that do not exist)
+	def versions(self, fields=STATE_FIELDS):
+		return {field: self.parameters.version(self.names[field]) for field in fields if field in self.names}
+
+	# Function to return the fields that cannot be stored because they have no configured parameter
+	def missing_fields(self, fields=STATE_FIELDS):
+		return [field for field in fields if field not in self.names]
+
+	# Function to write the changed fields, issuing the puts and a single batched delete concurrently
+	def save(self, changes):
+		# Fields without a configured parameter (e.g. next_action_at when NEXT_ACTION_AT_PARAM is not set) are not stored
+		changes = {field: value for field, value in changes.items() if field in self.names}
+		futures = [executor.submit(self.parameters.put, self.names[field], value) for field, value in changes.items() if value is not None]
+		deletes = [self.names[field] for field, value in changes.items() if value is None]
+		if deletes:
+			futures.append(executor.submit(self.parameters.delete_many, deletes))
+		for future in futures:
+			future.result()
+
+	# Function to record a verification and clear the notification datetimes that are set,
+	# returning False if the verification was not recorded (see should_record_verification)
+	# values: the loaded values of last_verification and the reset fields (read from Parameter Store if not provided)
+	def reset_verification(self, current_time, debounce_seconds=0, values=None):
+		if values is None:
+			values = self.load(['last_verification'] + VERIFICATION_RESET_FIELDS)
+		if not should_record_verification(values.get('last_verification'), current_time, debounce_seconds):
+			return False
+		self.save(verification_changes(current_time, values))
+		return True
+
+class DocumentState:
+
+	def __init__(self, parameters, name):
+		self.parameters = parameters
+		self.name = name
+		self.document = None
+		self.version = None
+
+	def _read(self):
+		value = self.parameters.get(self.name, ttl=0)
+		if value is None:
+			self.document = {}
+			self.version = None
+		else:
+			self.document = json.loads(value)
+			self.version = self.parameters.version(self.name)
+
+	def load(self, fields=STATE_FIELDS):
+		self._read()
+		return {field: self.document[field] for field in fields if field in self.document}
+
+	# Function to return the version of the loaded document, which changes whenever any field changes
+	def versions(self, fields=STATE_FIELDS):
+		return {'state': self.version}
+
+	def missing_fields(self, fields=STATE_FIELDS):
+		return []
+
+	# Function to write the changes to the document, returning False if they were not written. Parameter Store has
+	# no conditional write, so this is best-effort last-writer-wins: the latest document is read immediately before
+	# the write and the changes are applied on top of it, which limits the window in which a concurrent write can be
+	# lost to the time between that read and the write. If the version returned by the write shows that another write
+	# landed in that window, it is logged, as its changes may have been overwritten.
+	# condition: if provided, a function of the latest document that must return True for the changes to be written
+	def save(self, changes, condition=None):
+		self._read()
+		if condition is not None and not condition(self.document):
+			return False
+
+		document = dict(self.document)
+		for field, value in changes.items():
+			if value is None:
+				document.pop(field, None)
+			else:
+				document[field] = value
+
+		expected_version = (self.version or 0) + 1
+		version = self.parameters.put(self.name, json.dumps(document, separators=(',', ':')), tier=DOCUMENT_PARAMETER_TIER)
+		if version is not None and version != expected_version:
+			logger.warning(f"State document '{self.name}' was modified concurrently (expected version {expected_version} but wrote {version}) - the last write wins")
+		self.document = document
+		self.version = version
+		return True
+
+	# Function to record a verification and clear the notification datetimes in one write,
+	# returning False if the verification was not recorded. The debounce and never-backwards rules are checked against
+	# the latest document rather than the one loaded by the handler.
+	def reset_verification(self, current_time, debounce_seconds=0, values=None):
+		return self.save(
+			verification_changes(current_time),
+			condition=lambda document: should_record_verification(document.get('last_verification'), current_time, debounce_seconds)
+		)
+
+# The key of the state in the DynamoDB and SQLite backends when monitoring a single person
+SINGLE_SUBJECT_ID = 'default'
+
+# Function to create the state store configured by the environment variables (for the subject identified in the
+# request when running in multi-subject mode)
+def state_from_environment(parameters, subject_id=None):
+	document_param = os.environ.get('STATE_DOCUMENT_PARAM')
+	subjects_path = os.environ.get('SUBJECTS_PATH')
+	table = os.environ.get('STATE_TABLE')
+	database_path = os.environ.get('STATE_DATABASE')
+
+	# The other backends are only imported when they are configured, so that they do not add to cold starts
+	if table or database_path:
+		key = subjects.check_subject_id(subject_id) if subjects_path and subject_id else SINGLE_SUBJECT_ID
+		if table:
+			from lifecheck import state_dynamodb
+			return state_dynamodb.DynamoState(table, key)
+		from lifecheck import state_sqlite
+		return state_sqlite.SqliteState(state_sqlite.database(database_path), key)
+
+	if subjects_path and subject_id:
+		if document_param:
+			return DocumentState(parameters, subjects.subject_parameter_name(subjects_path, subject_id, 'state'))
+		return ParameterState(parameters, subjects.subject_parameter_names(subjects_path, subject_id, STATE_FIELDS))
+
+	if document_param:
+		return DocumentState(parameters, document_param)
+	names = {field: os.environ.get(f"{field.upper()}_PARAM") for field in STATE_FIELDS}
+	return ParameterState(parameters, {field: name for field, name in names.items() if name})
+
+# The number of subjects above which loading them from one parameter per field is logged as a warning
+PARAMETER_SUBJECTS_WARNING_COUNT = 50
+
+# Function to load the state of every subject in multi-subject mode from the configured backend, grouped by
+# subject ID
+def subjects_from_environment(ssm, subjects_path):
+	table = os.environ.get('STATE_TABLE')
+	database_path = os.environ.get('STATE_DATABASE')
+	if table:
+		from lifecheck import state_dynamodb
+		return state_dynamodb.load_subjects(table)
+	if database_path:
+		from lifecheck import state_sqlite
+		return state_sqlite.database(database_path).load_subjects()
+	loaded = subjects.load_subjects(ssm, subjects_path)
+	if not os.environ.get('STATE_DOCUMENT_PARAM') and len(loaded) > PARAMETER_SUBJECTS_WARNING_COUNT:
+		logger.warning(f"Loaded {len(loaded)} subjects stored as one parameter per field, which takes about one GetParametersByPath call per subject - set STATE_DOCUMENT_PARAM or STATE_TABLE")
+	return loaded
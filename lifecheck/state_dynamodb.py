@@ -0,0 +1,179 @@
+"""
+lifecheck/state_dynamodb.py
+
+A DynamoDB backend for the runtime state, enabled by setting the STATE_TABLE environment variable
+to the name of the table.
+
+The table uses a single-table layout with a string partition key (pk) and sort key (sk). The state
+of each subject is one item with the key SUBJECT#<subject_id> / STATE, holding each field as a
+string attribute and a version number that is incremented by every write.
+
+Every write to a state item also sets its subject_id attribute, which is the partition key of the
+sparse SubjectIndex global secondary index. Only the state items have that attribute, so the
+notification handler loads every subject by scanning the index without reading the verification
+history items stored in the same partitions. An item written before the index was added is indexed
+when it is next written.
+
+Writes are UpdateItem calls that only set or remove the changed fields, so concurrent writes to
+different fields do not overwrite each other. A verification is recorded with a condition on the
+stored last_verification, so that it is debounced and never moves last_verification backwards even
+when several check-ins arrive at the same time.
+"""
+
+import boto3
+import datetime
+import logging
+import contextlib
+
+from lifecheck import metrics
+from lifecheck.state import STATE_FIELDS, verification_changes
+
+logger = logging.getLogger()
+
+SUBJECT_KEY_PREFIX = 'SUBJECT#'
+STATE_SORT_KEY = 'STATE'
+HISTORY_SORT_KEY_PREFIX = 'HISTORY#'
+SUBJECT_INDEX = 'SubjectIndex'
+SUBJECT_ID_ATTRIBUTE = 'subject_id'
+KEY_ATTRIBUTES = ('pk', 'sk', 'version', SUBJECT_ID_ATTRIBUTE)
+
+# The client is created when the backend is first used in a warm container
+client = None
+
+def dynamodb():
+	global client
+	if client is None:
+		client = metrics.instrument(boto3.client('dynamodb'))
+	return client
+
+def state_key(subject_id):
+	return {'pk': {'S': f"{SUBJECT_KEY_PREFIX}{subject_id}"}, 'sk': {'S': STATE_SORT_KEY}}
+
+# Function to convert an item to a dict of field to value
+def item_values(item):
+	return {name: value['S'] for name, value in item.items() if name not in KEY_ATTRIBUTES and 'S' in value}
+
+class DynamoState:
+
+	def __init__(self, table, subject_id):
+		self.table = table
+		self.subject_id = subject_id
+		self.version = None
+
+	def load(self, fields=STATE_FIELDS):
+		response = dynamodb().get_item(TableName=self.table, Key=state_key(self.subject_id), ConsistentRead=True)
+		item = response.get('Item', {})
+		self.version = int(item['version']['N']) if 'version' in item else None
+		values = item_values(item)
+		return {field: values[field] for field in fields if field in values}
+
+	# Function to return the version of the loaded item, which changes whenever any field changes
+	def versions(self, fields=STATE_FIELDS):
+		return {'state': self.version}
+
+	def missing_fields(self, fields=STATE_FIELDS):
+		return []
+
+	# Function to set and remove the changed fields in one UpdateItem call, returning False if the condition
+	# expression (if provided) was not met
+	def save(self, changes, condition=None, condition_names=None, condition_values=None):
+		names = {'#version': 'version', '#subject_id': SUBJECT_ID_ATTRIBUTE}
+		values = {':zero': {'N': '0'}, ':one': {'N': '1'}, ':subject_id': {'S': self.subject_id}}
+		sets = ['#version = if_not_exists(#version, :zero) + :one', '#subject_id = :subject_id']
+		removes = []
+		for index, (field, value) in enumerate(changes.items()):
+			names[f"#f{index}"] = field
+			if value is None:
+				removes.append(f"#f{index}")
+			else:
+				values[f":v{index}"] = {'S': value}
+				sets.append(f"#f{index} = :v{index}")
+
+		expression = f"SET {', '.join(sets)}"
+		if removes:
+			expression += f" REMOVE {', '.join(removes)}"
+
+		request = {
+			"TableName": self.table,
+			"Key": state_key(self.subject_id),
+			"UpdateExpression": expression,
+			"ExpressionAttributeNames": {**names, **(condition_names or {})},
+			"ExpressionAttributeValues": {**values, **(condition_values or {})},
+			"ReturnValues": "UPDATED_NEW"
+		}
+		if condition:
+			request["ConditionExpression"] = condition
+
+		try:
+			response = dynamodb().update_item(**request)
+		except dynamodb().exceptions.ConditionalCheckFailedException:
+			return False
+		self.version = int(response['Attributes']['version']['N'])
+		return True
+
+	# Function to record a verification and clear the notification datetimes in one conditional
+	# update, returning False if a verification was already recorded within the debounce window (or later)
+	def reset_verification(self, current_time, debounce_seconds=0, values=None):
+		if debounce_seconds > 0:
+			threshold = (current_time - datetime.timedelta(seconds=debounce_seconds)).isoformat()
+			condition = "attribute_not_exists(#last_verification) OR #last_verification <= :threshold"
+		else:
+			threshold = current_time.isoformat()
+			condition = "attribute_not_exists(#last_verification) OR #last_verification < :threshold"
+
+		# The datetimes are stored as ISO 8601 strings, which sort in time order
+		return self.save(
+			verification_changes(current_time),
+			condition=condition,
+			condition_names={'#last_verification': 'last_verification'},
+			condition_values={':threshold': {'S': threshold}}
+		)
+
+# The records of the verification history of a subject (see lifecheck/history.py) are items in the same
+# partition as its state, with the key SUBJECT#<subject_id> / HISTORY#<record key>
+class DynamoHistoryStore:
+
+	def __init__(self, table, subject_id):
+		self.table = table
+		self.subject_id = subject_id
+
+	def key(self, key):
+		return {'pk': {'S': f"{SUBJECT_KEY_PREFIX}{self.subject_id}"}, 'sk': {'S': f"{HISTORY_SORT_KEY_PREFIX}{key}"}}
+
+	def get(self, key, sealed=False):
+		# Sealed chunks never change, so they do not need a consistent read
+		response = dynamodb().get_item(TableName=self.table, Key=self.key(key), ConsistentRead=not sealed)
+		return response.get('Item', {}).get('value', {}).get('S')
+
+	def put(self, key, value, sealed=False):
+		dynamodb().put_item(TableName=self.table, Item={**self.key(key), 'value': {'S': value}})
+
+	# Function to write a record only if it still holds the expected value (or does not exist if expected is None),
+	# returning False if it was changed by another append
+	def replace(self, key, expected, value):
+		request = {"TableName": self.table, "Item": {**self.key(key), 'value': {'S': value}}}
+		if expected is None:
+			request["ConditionExpression"] = "attribute_not_exists(pk)"
+		else:
+			request["ConditionExpression"] = "#value = :expected"
+			request["ExpressionAttributeNames"] = {'#value': 'value'}
+			request["ExpressionAttributeValues"] = {':expected': {'S': expected}}
+		try:
+			dynamodb().put_item(**request)
+		except dynamodb().exceptions.ConditionalCheckFailedException:
+			return False
+		return True
+
+	# The head is replaced with a conditional write, so appends do not need to be serialized
+	def exclusive(self):
+		return contextlib.nullcontext()
+
+# Function to load the state of every subject in the table, grouped by subject ID, with a scan of the sparse
+# subject index (which holds only the state items, not the history items)
+def load_subjects(table):
+	subjects = {}
+	paginator = dynamodb().get_paginator('scan')
+	for page in paginator.paginate(TableName=table, IndexName=SUBJECT_INDEX):
+		for item in page['Items']:
+			subjects[item[SUBJECT_ID_ATTRIBUTE]['S']] = item_values(item)
+	return subjects
@@ -0,0 +1,167 @@
+"""
+lifecheck/state_sqlite.py
+
+A local SQLite backend for the runtime state, for developing and testing the handlers without AWS.
+It is enabled by setting the STATE_DATABASE environment variable to the path of the database file,
+which is created if it does not exist.
+
+The state of each subject is stored as a JSON document in one row with a version that is
+incremented by every write. Each write is made in an immediate transaction, so reading the current
+document, checking any condition and writing the changes is atomic across processes.
+"""
+
+import json
+import sqlite3
+import threading
+import contextlib
+
+from lifecheck.state import STATE_FIELDS, should_record_verification, verification_changes
+
+CREATE_TABLE = "CREATE TABLE IF NOT EXISTS state (subject TEXT PRIMARY KEY, document TEXT NOT NULL, version INTEGER NOT NULL)"
+CREATE_HISTORY_TABLE = "CREATE TABLE IF NOT EXISTS history (subject TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (subject, key))"
+BUSY_TIMEOUT_SECONDS = 30
+
+class SqliteDatabase:
+
+	def __init__(self, path):
+		# Transactions are managed explicitly, and the connection is shared by threads (one at a time)
+		self.connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT_SECONDS, isolation_level=None, check_same_thread=False)
+		self.connection.execute(CREATE_TABLE)
+		self.connection.execute(CREATE_HISTORY_TABLE)
+		self.lock = threading.Lock()
+
+	def _read(self, subject_id):
+		row = self.connection.execute("SELECT document, version FROM state WHERE subject = ?", (subject_id,)).fetchone()
+		if row is None:
+			return {}, None
+		return json.loads(row[0]), row[1]
+
+	def read(self, subject_id):
+		with self.lock:
+			return self._read(subject_id)
+
+	# Function to apply the changes to the document of a subject in one transaction, returning the new version, or
+	# None if the condition (a function of the current document) was not met
+	def update(self, subject_id, changes, condition=None):
+		with self.lock:
+			self.connection.execute("BEGIN IMMEDIATE")
+			try:
+				document, version = self._read(subject_id)
+				if condition is not None and not condition(document):
+					self.connection.execute("ROLLBACK")
+					return None
+				for field, value in changes.items():
+					if value is None:
+						document.pop(field, None)
+					else:
+						document[field] = value
+				version = (version or 0) + 1
+				self.connection.execute(
+					"INSERT INTO state (subject, document, version) VALUES (?, ?, ?) ON CONFLICT (subject) DO UPDATE SET document = excluded.document, version = excluded.version",
+					(subject_id, json.dumps(document, separators=(',', ':')), version)
+				)
+				self.connection.execute("COMMIT")
+				return version
+			except Exception:
+				self.connection.execute("ROLLBACK")
+				raise
+
+	# Functions to read and write the records of the verification history of a subject (see lifecheck/history.py)
+	def read_history(self, subject_id, key):
+		with self.lock:
+			row = self.connection.execute("SELECT value FROM history WHERE subject = ? AND key = ?", (subject_id, key)).fetchone()
+			return row[0] if row else None
+
+	def write_history(self, subject_id, key, value):
+		with self.lock:
+			self.connection.execute(
+				"INSERT INTO history (subject, key, value) VALUES (?, ?, ?) ON CONFLICT (subject, key) DO UPDATE SET value = excluded.value",
+				(subject_id, key, value)
+			)
+
+	# Function to write a record of the history in one transaction only if it still holds the expected value (or does
+	# not exist if expected is None), returning False if it was changed by another append
+	def replace_history(self, subject_id, key, expected, value):
+		with self.lock:
+			self.connection.execute("BEGIN IMMEDIATE")
+			try:
+				row = self.connection.execute("SELECT value FROM history WHERE subject = ? AND key = ?", (subject_id, key)).fetchone()
+				if (row[0] if row else None) != expected:
+					self.connection.execute("ROLLBACK")
+					return False
+				self.connection.execute(
+					"INSERT INTO history (subject, key, value) VALUES (?, ?, ?) ON CONFLICT (subject, key) DO UPDATE SET value = excluded.value",
+					(subject_id, key, value)
+				)
+				self.connection.execute("COMMIT")
+				return True
+			except Exception:
+				self.connection.execute("ROLLBACK")
+				raise
+
+	# Function to load the state of every subject, grouped by subject ID
+	def load_subjects(self):
+		with self.lock:
+			return {subject_id: json.loads(document) for subject_id, document in self.connection.execute("SELECT subject, document FROM state")}
+
+# Databases are opened once per process and shared by the stores
+databases = {}
+databases_lock = threading.Lock()
+
+def database(path):
+	with databases_lock:
+		if path not in databases:
+			databases[path] = SqliteDatabase(path)
+		return databases[path]
+
+class SqliteState:
+
+	def __init__(self, database, subject_id):
+		self.database = database
+		self.subject_id = subject_id
+		self.version = None
+
+	def load(self, fields=STATE_FIELDS):
+		document, self.version = self.database.read(self.subject_id)
+		return {field: document[field] for field in fields if field in document}
+
+	def versions(self, fields=STATE_FIELDS):
+		return {'state': self.version}
+
+	def missing_fields(self, fields=STATE_FIELDS):
+		return []
+
+	# Function to write the changes, returning False if the condition (a function of the current document) was not met
+	def save(self, changes, condition=None):
+		version = self.database.update(self.subject_id, changes, condition)
+		if version is None:
+			return False
+		self.version = version
+		return True
+
+	# Function to record a verification and clear the notification datetimes in one transaction,
+	# returning False if the verification was not recorded
+	def reset_verification(self, current_time, debounce_seconds=0, values=None):
+		return self.save(
+			verification_changes(current_time),
+			condition=lambda document: should_record_verification(document.get('last_verification'), current_time, debounce_seconds)
+		)
+
+class SqliteHistoryStore:
+
+	def __init__(self, database, subject_id):
+		self.database = database
+		self.subject_id = subject_id
+
+	def get(self, key, sealed=False):
+		return self.database.read_history(self.subject_id, key)
+
+	def put(self, key, value, sealed=False):
+		self.database.write_history(self.subject_id, key, value)
+
+	def replace(self, key, expected, value):
+		return self.database.replace_history(self.subject_id, key, expected, value)
+
+	# The head is replaced in a transaction, so appends do not need to be serialized
+	def exclusive(self):
+		return contextlib.nullcontext()
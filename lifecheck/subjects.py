@@ -0,0 +1,62 @@
+"""
+lifecheck/subjects.py
+
+Support for monitoring many people (subjects) from a single deployment.
+
+Each subject's parameters live under a shared Parameter Store path, e.g.:
+
+	/lifecheck/subjects/<subject_id>/last_verification
+	/lifecheck/subjects/<subject_id>/primary_contact_email
+	...
+
+This allows the state of every subject to be loaded in bulk with GetParametersByPath, rather
+than one set of get_parameter calls per subject. GetParametersByPath returns at most 10 parameters
+per page and the pages are read one after another, so with one parameter per field the load takes
+about one call per subject. Deployments monitoring more than a few subjects should store the state
+of each subject as one document (STATE_DOCUMENT_PARAM), so that each page holds 10 subjects, or use
+the DynamoDB backend (STATE_TABLE), which loads the subjects with a scan of a few large pages of
+an index that holds only the state items.
+"""
+
+import re
+import json
+
+# Subject IDs form a single level of the parameter hierarchy
+SUBJECT_ID_PATTERN = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+# Function to confirm that a subject ID (which is provided in requests) is valid before it is used in a key
+def check_subject_id(subject_id):
+	if not SUBJECT_ID_PATTERN.match(subject_id):
+		raise ValueError(f"Invalid subject ID '{subject_id}'")
+	return subject_id
+
+def subject_parameter_name(subjects_path, subject_id, field):
+	return f"{subjects_path.rstrip('/')}/{check_subject_id(subject_id)}/{field}"
+
+def subject_parameter_names(subjects_path, subject_id, fields):
+	return {field: subject_parameter_name(subjects_path, subject_id, field) for field in fields}
+
+# Function to load the parameters of every subject under the subjects path, grouped by subject ID
+def load_subjects(ssm, subjects_path):
+	prefix = subjects_path.rstrip('/') + '/'
+	subjects = {}
+
+	paginator = ssm.get_paginator('get_parameters_by_path')
+	for page in paginator.paginate(Path=prefix, Recursive=True, WithDecryption=False):
+		for param in page['Parameters']:
+			subject_id, _, field = param['Name'][len(prefix):].partition('/')
+			if subject_id and field:
+				subjects.setdefault(subject_id, {})[field] = param['Value']
+
+	# Expand the fields of subjects whose state is stored as a single document
+	for fields in subjects.values():
+		if 'state' in fields:
+			fields.update(json.loads(fields.pop('state')))
+
+	return subjects
+
+# Function to select the subjects whose stored next action time has passed or is not stored, so that the
+# thresholds only need to be evaluated for them. The times are naive ISO datetimes, which sort as strings.
+def due_subject_ids(subjects, current_time):
+	current = current_time.isoformat()
+	return [subject_id for subject_id, state in subjects.items() if not state.get('next_action_at') or state['next_action_at'] <= current]
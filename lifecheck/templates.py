@@ -0,0 +1,111 @@
+"""
+lifecheck/templates.py
+
+SES stored templates for the notification emails of each escalation tier.
+
+Rather than building and sending each email separately, the subject and layout of each tier's email
+are stored once as an SES template, and the emails of a tier are sent with SendBulkTemplatedEmail
+(up to 50 recipients per call). Each recipient's contact message and verification URL are passed
+as replacement data.
+
+The templates are named <prefix>-<contact> using the prefix in the SES_TEMPLATE_PREFIX environment
+variable, and are created (or updated if the tier table has changed) the first time they are used
+in a warm Lambda container.
+"""
+
+import os
+import json
+import logging
+import threading
+
+from lifecheck import escalation
+
+logger = logging.getLogger()
+
+# SendBulkTemplatedEmail accepts at most 50 destinations per call
+SEND_BULK_TEMPLATED_EMAIL_MAX_DESTINATIONS = 50
+
+def template_name(prefix, tier):
+	return f"{prefix}-{tier['contact'].replace('_', '-')}"
+
+# Function to return the stored template of a tier. Triple braces are used so that the message and URL are
+# substituted as they are rather than being HTML-escaped.
+def template_content(prefix, tier):
+	text = "{{{message}}}"
+	if tier['verification_link']:
+		text += "\n\nVerification URL: {{{verification_url}}}"
+	return {
+		"TemplateName": template_name(prefix, tier),
+		"SubjectPart": tier['subject'],
+		"TextPart": text
+	}
+
+class TemplateStore:
+
+	def __init__(self, ses, prefix, tiers=escalation.TIERS):
+		self.ses = ses
+		self.prefix = prefix
+		self.tiers = tiers
+		self.ready = False
+		self.lock = threading.Lock()
+
+	# Function to create or update the template of each tier (once per warm container). The tiers' emails are
+	# dispatched in parallel, so the lock stops two deliveries from creating the same template at once.
+	def ensure(self):
+		with self.lock:
+			if not self.ready:
+				self.create_templates()
+				self.ready = True
+
+	def create_templates(self):
+		for tier in self.tiers:
+			content = template_content(self.prefix, tier)
+			try:
+				stored = self.ses.get_template(TemplateName=content['TemplateName'])['Template']
+				if any(stored.get(key) != value for key, value in content.items()):
+					self.ses.update_template(Template=content)
+					logger.info(f"Updated SES template '{content['TemplateName']}'")
+			except self.ses.exceptions.TemplateDoesNotExistException:
+				self.ses.create_template(Template=content)
+				logger.info(f"Created SES template '{content['TemplateName']}'")
+
+	# Function to send the emails of a tier in bulk, returning an error message (or None if it was sent) for each
+	# recipient. A call that fails only fails the recipients of its own batch, so the batches already sent are
+	# still reported as sent.
+	# recipients: a list of (email address, message, verification URL) tuples
+	def send_bulk(self, source, tier, recipients):
+		self.ensure()
+		errors = []
+		for start in range(0, len(recipients), SEND_BULK_TEMPLATED_EMAIL_MAX_DESTINATIONS):
+			batch = recipients[start:start + SEND_BULK_TEMPLATED_EMAIL_MAX_DESTINATIONS]
+			try:
+				response = self.send_batch(source, tier, batch)
+			except Exception as e:
+				logger.error(f"Failed to send {len(batch)} '{template_name(self.prefix, tier)}' emails: {str(e)}")
+				errors.extend([str(e)] * len(batch))
+				continue
+			for status in response['Status']:
+				errors.append(None if status['Status'] == 'Success' else f"{status['Status']}: {status.get('Error', '')}")
+			logger.info(f"Sent {len(batch)} '{template_name(self.prefix, tier)}' emails with SendBulkTemplatedEmail")
+		return errors
+
+	def send_batch(self, source, tier, batch):
+		return self.ses.send_bulk_templated_email(
+			Source=source,
+			Template=template_name(self.prefix, tier),
+			DefaultTemplateData=json.dumps({"message": "", "verification_url": ""}),
+			Destinations=[
+				{
+					"Destination": {"ToAddresses": [email]},
+					"ReplacementTemplateData": json.dumps({"message": message, "verification_url": verification_url or ""})
+				}
+				for email, message, verification_url in batch
+			]
+		)
+
+# Function to create the template store configured by the environment, or None if templates are not enabled
+def template_store_from_environment(ses):
+	prefix = os.environ.get('SES_TEMPLATE_PREFIX')
+	if not prefix:
+		return None
+	return TemplateStore(ses, prefix)
@@ -0,0 +1,166 @@
+"""
+lifecheck/tokens.py
+
+Self-contained signed tokens for the verification link included in the notification emails, and
+for the check-in requests of each subject in multi-subject mode.
+
+A token carries the subject it verifies (None when monitoring a single person), its expiry time and
+the ID of the key that signed it, and is signed with HMAC-SHA256:
+
+	<base64url payload>.<base64url signature>
+
+so minting a token needs no state to be written and validating one needs no state to be read. Each
+reminder has its own token, so the links in earlier reminders keep working until they expire.
+
+The signing keys are stored as a keyring in the parameter named by the TOKEN_KEYS_PARAM
+environment variable: {"active": "<key ID>", "keys": {"<key ID>": "<base64url secret>", ...}}. New
+tokens are signed with the active key, and tokens signed with any key in the keyring are accepted,
+so keys can be rotated without invalidating the links already sent. The keyring is created by the
+notification poller the first time it mints a token, and can be rotated with:
+
+	python -m lifecheck.tokens rotate --param /lifecheck/token_keys
+
+Check-in tokens are long-lived tokens with the "check_in" purpose, which bind the check-in requests
+of a client to the subject they were issued for (the API key of the verification endpoint is shared
+by every subject). They are not accepted as verification links, nor the other way round, and are
+issued with:
+
+	python -m lifecheck.tokens issue --param /lifecheck/token_keys --subject jane --days 365
+
+As only the previous key is kept when the keys are rotated, check-in tokens must be issued again
+after the second rotation.
+"""
+
+import sys
+import hmac
+import json
+import base64
+import hashlib
+import secrets
+import logging
+import argparse
+import datetime
+
+logger = logging.getLogger()
+
+TOKEN_VALID_HOURS = 2
+CHECK_IN_PURPOSE = 'check_in'
+KEY_BYTES = 32
+KEY_ID_BYTES = 6
+
+class InvalidTokenError(Exception):
+	pass
+
+class ExpiredTokenError(InvalidTokenError):
+	pass
+
+def _encode(data):
+	return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def _decode(value):
+	return base64.urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+def _signature(keyring, key_id, payload):
+	secret = keyring['keys'].get(key_id)
+	if secret is None:
+		raise InvalidTokenError(f"Unknown signing key '{key_id}'")
+	return hmac.new(_decode(secret), payload.encode('ascii'), hashlib.sha256).digest()
+
+# Function to return a keyring with a new active key, keeping the previous active key (if any) so that the tokens
+# it signed remain valid until they expire
+def rotated_keyring(keyring=None):
+	keys = {}
+	if keyring and keyring.get('active') in keyring.get('keys', {}):
+		keys[keyring['active']] = keyring['keys'][keyring['active']]
+	key_id = secrets.token_hex(KEY_ID_BYTES)
+	keys[key_id] = _encode(secrets.token_bytes(KEY_BYTES))
+	return {"active": key_id, "keys": keys}
+
+# Function to mint a token for a subject that expires at the given time (verification links have no purpose)
+def mint(keyring, subject_id, expires_at, purpose=None):
+	key_id = keyring['active']
+	claims = {"kid": key_id, "sub": subject_id, "exp": int(expires_at.timestamp())}
+	if purpose:
+		claims['use'] = purpose
+	payload = _encode(json.dumps(claims, separators=(',', ':')).encode())
+	return f"{payload}.{_encode(_signature(keyring, key_id, payload))}"
+
+# Function to return the key ID of a token (without validating it), so that the keyring can be refreshed if the key
+# is not known yet
+def key_id(token):
+	try:
+		return json.loads(_decode(token.partition('.')[0]))['kid']
+	except Exception:
+		raise InvalidTokenError("Malformed token")
+
+# Function to validate a token for a purpose at the given time and return the subject ID it verifies
+def validate(keyring, token, current_time, purpose=None):
+	payload, _, signature = token.partition('.')
+	try:
+		claims = json.loads(_decode(payload))
+		provided_signature = _decode(signature)
+	except Exception:
+		raise InvalidTokenError("Malformed token")
+	# The payload may be any JSON value, but only an object holds claims
+	if not isinstance(claims, dict):
+		raise InvalidTokenError("Malformed token")
+
+	if not hmac.compare_digest(_signature(keyring, claims.get('kid'), payload), provided_signature):
+		raise InvalidTokenError("Invalid signature")
+	if claims.get('use') != purpose:
+		raise InvalidTokenError("Token was not issued for this purpose")
+	if current_time.timestamp() >= claims['exp']:
+		raise ExpiredTokenError("Token has expired")
+	return claims.get('sub')
+
+# Function to load the keyring from Parameter Store (refreshing it if the cached keyring does not contain key_id),
+# creating it if it does not exist and create is True
+def load_keyring(parameters, name, key_id=None, create=False):
+	value = parameters.get(name)
+	if value is not None and key_id is not None and key_id not in json.loads(value)['keys']:
+		# The keys may have been rotated since the keyring was cached
+		value = parameters.get(name, ttl=0)
+
+	if value is None:
+		if not create:
+			raise InvalidTokenError("No token signing keys are configured")
+		try:
+			parameters.put(name, json.dumps(rotated_keyring()), overwrite=False)
+			logger.info(f"Created the token signing keyring '{name}'")
+		except parameters.ssm.exceptions.ParameterAlreadyExists:
+			# Another invocation created the keyring first
+			pass
+		value = parameters.get(name, ttl=0)
+
+	return json.loads(value)
+
+def main():
+	import boto3
+
+	parser = argparse.ArgumentParser(description="Manage the keys used to sign verification tokens, and issue check-in tokens")
+	parser.add_argument('command', choices=['rotate', 'issue'])
+	parser.add_argument('--param', default='/lifecheck/token_keys', help="name of the keyring parameter")
+	parser.add_argument('--subject', help="subject ID to issue a check-in token for")
+	parser.add_argument('--days', type=int, default=365, help="number of days the check-in token is valid for")
+	args = parser.parse_args()
+
+	ssm = boto3.client('ssm')
+	try:
+		keyring = json.loads(ssm.get_parameter(Name=args.param)['Parameter']['Value'])
+	except ssm.exceptions.ParameterNotFound:
+		keyring = None
+
+	if args.command == 'issue':
+		if not args.subject or keyring is None:
+			parser.error("issue requires --subject and an existing keyring (run rotate first)")
+		expires_at = datetime.datetime.now() + datetime.timedelta(days=args.days)
+		print(mint(keyring, args.subject, expires_at, purpose=CHECK_IN_PURPOSE))
+		return 0
+
+	keyring = rotated_keyring(keyring)
+	ssm.put_parameter(Name=args.param, Value=json.dumps(keyring), Type='String', Overwrite=True)
+	print(f"The active signing key is now '{keyring['active']}' ({len(keyring['keys'])} keys in the keyring)")
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,13 @@
+"""
+tests/conftest.py
+
+Makes the lifecheck package importable when the tests are run from any directory:
+
+	python -m pytest tests
+"""
+
+import os
+import sys
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY_ROOT)
@@ -0,0 +1,116 @@
+"""
+tests/test_escalation.py
+
+Tests of the escalation thresholds (which tiers are due and when the next one becomes due) and of
+the notification timers armed from them, using the default tiers (primary at 30 hours with hourly
+reminders, secondary at 40 hours and emergency at 48 hours) and the InMemoryScheduler.
+"""
+
+import datetime
+
+import pytest
+
+from lifecheck import escalation, schedule
+from lifecheck.escalation import NEVER
+
+TIERS = escalation.load_tiers()
+LAST_VERIFICATION = datetime.datetime(2024, 1, 1, 8, 0, 0)
+
+def hours(value):
+	return LAST_VERIFICATION + datetime.timedelta(hours=value)
+
+def test_load_tiers_sorts_by_threshold():
+	tiers = escalation.load_tiers('[{"contact": "late", "threshold_hours": 10}, {"contact": "early", "threshold_hours": 5, "resend_hours": 2}]')
+	assert [tier['contact'] for tier in tiers] == ['early', 'late']
+	assert tiers[0]['resend_hours'] == 2.0
+	assert tiers[1]['resend_hours'] is None
+	assert tiers[1]['channels'] == ['email']
+
+@pytest.mark.parametrize('value', [
+	'[]',
+	'[{"contact": "Primary", "threshold_hours": 1}]',
+	'[{"contact": "a", "threshold_hours": 1}, {"contact": "a", "threshold_hours": 2}]',
+	'[{"contact": "a", "threshold_hours": 1, "channels": ["pager"]}]'
+])
+def test_load_tiers_rejects_invalid_tables(value):
+	with pytest.raises(ValueError):
+		escalation.load_tiers(value)
+
+def test_tier_fields_include_the_phone_of_sms_tiers():
+	assert 'emergency_contact_phone' in escalation.tier_fields(TIERS)
+	assert 'primary_contact_phone' not in escalation.tier_fields(TIERS)
+
+# The thresholds are exclusive, so a tier is only due once its threshold has passed
+@pytest.mark.parametrize('elapsed, due', [
+	(29.9, []),
+	(30, []),
+	(30.1, [0]),
+	(40.1, [0, 1]),
+	(48.1, [0, 1, 2])
+])
+def test_due_tiers_not_notified(elapsed, due):
+	assert escalation.due_tiers(elapsed, [NEVER] * 3, TIERS) == due
+
+def test_due_tiers_resends_the_primary_reminder_after_an_hour():
+	assert escalation.due_tiers(31, [0.5, NEVER, NEVER], TIERS) == []
+	assert escalation.due_tiers(31, [1, NEVER, NEVER], TIERS) == []
+	assert escalation.due_tiers(31.5, [1.5, NEVER, NEVER], TIERS) == [0]
+
+def test_due_tiers_stops_reminders_once_the_next_tier_takes_over():
+	assert escalation.due_tiers(41, [2, NEVER, NEVER], TIERS) == [1]
+	assert escalation.due_tiers(41, [2, 1, NEVER], TIERS) == []
+
+def test_hours_since():
+	assert escalation.hours_since(hours(2.5), LAST_VERIFICATION.isoformat()) == 2.5
+	assert escalation.hours_since(hours(2.5), None) == NEVER
+
+def test_next_deadline_is_the_first_threshold():
+	assert escalation.next_deadline(LAST_VERIFICATION, [None, None, None], hours(1), TIERS) == hours(30)
+
+def test_next_deadline_is_the_primary_reminder():
+	assert escalation.next_deadline(LAST_VERIFICATION, [hours(30.5), None, None], hours(31), TIERS) == hours(31.5)
+
+def test_next_deadline_skips_a_reminder_after_the_next_threshold():
+	assert escalation.next_deadline(LAST_VERIFICATION, [hours(39.5), None, None], hours(39.6), TIERS) == hours(40)
+	assert escalation.next_deadline(LAST_VERIFICATION, [hours(39), hours(40.5), None], hours(41), TIERS) == hours(48)
+
+def test_next_deadline_may_be_in_the_past():
+	assert escalation.next_deadline(LAST_VERIFICATION, [None, None, None], hours(45), TIERS) == hours(30)
+
+def test_next_deadline_is_none_once_every_tier_is_notified():
+	assert escalation.next_deadline(LAST_VERIFICATION, [hours(31), hours(41), hours(49)], hours(50), TIERS) is None
+
+def test_next_action_at():
+	values = {'last_verification': LAST_VERIFICATION.isoformat()}
+	assert escalation.next_action_at(values, LAST_VERIFICATION, TIERS) == hours(30).isoformat()
+	values.update({field: hours(49).isoformat() for field in escalation.tier_datetime_fields(TIERS)})
+	assert escalation.next_action_at(values, hours(50), TIERS) == escalation.NO_ACTION.isoformat()
+
+def test_timer_fires_after_the_threshold():
+	scheduler = schedule.InMemoryScheduler()
+	at = schedule.arm_next_run(scheduler, {'last_verification': LAST_VERIFICATION.isoformat()}, LAST_VERIFICATION, 'jane')
+	assert at == hours(30) + datetime.timedelta(seconds=schedule.SCHEDULE_MARGIN_SECONDS)
+	assert scheduler.fire(hours(30)) == []
+	assert scheduler.fire(at) == [schedule.deadline_event(at, 'jane')]
+	assert scheduler.fire(at) == []
+
+def test_timer_retries_a_tier_that_is_already_due():
+	scheduler = schedule.InMemoryScheduler()
+	current_time = hours(31)
+	at = schedule.arm_next_run(scheduler, {'last_verification': LAST_VERIFICATION.isoformat()}, current_time)
+	assert at == current_time + datetime.timedelta(seconds=schedule.RETRY_DELAY_SECONDS)
+	assert scheduler.schedules == {schedule.schedule_name(): (at, None)}
+
+def test_timer_is_not_armed_once_every_tier_is_notified():
+	scheduler = schedule.InMemoryScheduler()
+	values = {'last_verification': LAST_VERIFICATION.isoformat(), **{field: hours(49).isoformat() for field in escalation.tier_datetime_fields()}}
+	assert schedule.arm_next_run(scheduler, values, hours(50)) is None
+	assert scheduler.schedules == {}
+
+def test_timer_event_is_recognised_as_armed_for_its_deadline():
+	at = schedule.run_time(hours(30), LAST_VERIFICATION)
+	event = schedule.deadline_event(at)
+	assert schedule.is_deadline_event(event)
+	assert schedule.is_armed_for(event, hours(30), LAST_VERIFICATION)
+	assert not schedule.is_armed_for(event, hours(31.5), LAST_VERIFICATION)
+	assert not schedule.is_armed_for({'source': 'aws.events'}, hours(30), LAST_VERIFICATION)
@@ -0,0 +1,164 @@
+"""
+tests/test_history.py
+
+Tests of the verification history: delta-encoded chunks, sealing the open chunk, rolling full levels
+of the index into index records, and reading ranges back, using the SQLite store on an in-memory
+database. Most tests shrink the chunk and index sizes so that several levels are rolled with a few
+appends.
+"""
+
+import json
+import datetime
+
+import pytest
+
+from lifecheck import history
+from lifecheck.state_sqlite import SqliteDatabase, SqliteHistoryStore
+
+START = datetime.datetime(2024, 1, 1, 8, 0, 0)
+
+@pytest.fixture
+def store():
+	return SqliteHistoryStore(SqliteDatabase(':memory:'), 'jane')
+
+@pytest.fixture
+def small(monkeypatch):
+	monkeypatch.setattr(history, 'CHUNK_SIZE', 4)
+	monkeypatch.setattr(history, 'INDEX_SIZE', 2)
+
+def check_ins(count):
+	return [START + datetime.timedelta(minutes=7 * index) for index in range(count)]
+
+def keys(store, prefix):
+	rows = store.database.connection.execute("SELECT key FROM history WHERE subject = ? AND key LIKE ? ORDER BY key", (store.subject_id, f"{prefix}%"))
+	return [row[0] for row in rows]
+
+def head(store):
+	return json.loads(store.get(history.HEAD_KEY))
+
+def test_encode_and_decode_chunk():
+	times = [1700000000, 1700000001, 1700086400, 1800000000]
+	assert history.decode_chunk(history.encode_chunk(times)) == times
+	assert history.decode_chunk(history.encode_chunk([])) == []
+	assert history.decode_chunk(None) == []
+
+def test_full_chunk_fits_in_a_standard_parameter():
+	times = [1700000000 + 86400 * index for index in range(history.CHUNK_SIZE)]
+	assert len(history.encode_chunk(times)) < 4096
+
+def test_append_and_read(store):
+	log = history.VerificationHistory(store)
+	times = check_ins(10)
+	assert all(log.append(value) for value in times)
+	assert log.count() == 10
+	assert list(log.read()) == times
+	assert list(log.read(reverse=True)) == times[::-1]
+	assert log.recent(3) == times[:-4:-1]
+
+def test_append_ignores_times_that_are_not_later(store):
+	log = history.VerificationHistory(store)
+	assert log.append(START)
+	assert not log.append(START)
+	assert not log.append(START - datetime.timedelta(seconds=1))
+	assert log.count() == 1
+
+def test_full_chunk_is_sealed(store, small):
+	log = history.VerificationHistory(store)
+	times = check_ins(5)
+	for value in times[:4]:
+		log.append(value)
+	last = history.to_epoch(times[3])
+	assert keys(store, 'chunks/') == [history.chunk_key(0, last)]
+	assert history.decode_chunk(store.get(history.chunk_key(0, last))) == [history.to_epoch(value) for value in times[:4]]
+	assert head(store)['sealed'] == [[history.to_epoch(times[0]), last, 4]]
+	assert head(store)['open'] == ''
+
+	# The next check-in starts a new open chunk rather than changing the sealed one
+	log.append(times[4])
+	assert head(store)['open'] == history.encode_chunk([history.to_epoch(times[4])])
+	assert keys(store, 'chunks/') == [history.chunk_key(0, last)]
+
+def test_full_levels_are_rolled_into_index_records(store, small):
+	log = history.VerificationHistory(store)
+	# 9 chunks: 4 index records of level 1, rolled into 2 records of level 2 and 1 of level 3
+	times = check_ins(4 * 9 + 1)
+	for value in times:
+		log.append(value)
+	epochs = [history.to_epoch(value) for value in times]
+
+	stored = head(store)
+	assert stored['count'] == len(times)
+	assert [len(entries) for entries in [stored['sealed']] + stored['indexes']] == [1, 0, 0, 1]
+	# The head holds at most INDEX_SIZE entries per level
+	assert all(len(entries) < history.INDEX_SIZE for entries in [stored['sealed']] + stored['indexes'])
+	assert len(keys(store, 'chunks/')) == 9
+	assert keys(store, 'indexes/1/') == [history.index_key(1, number, epochs[4 * 2 * (number + 1) - 1]) for number in range(4)]
+	assert keys(store, 'indexes/2/') == [history.index_key(2, number, epochs[4 * 4 * (number + 1) - 1]) for number in range(2)]
+	assert keys(store, 'indexes/3/') == [history.index_key(3, 0, epochs[31])]
+	assert stored['indexes'][-1] == [[epochs[0], epochs[31], 32]]
+
+	# Each index record holds the entries it replaced
+	assert json.loads(store.get(history.index_key(2, 1, epochs[31]))) == [[epochs[16], epochs[23], 8], [epochs[24], epochs[31], 8]]
+
+	assert list(log.read()) == times
+	assert list(log.read(reverse=True)) == times[::-1]
+
+def test_read_range_only_reads_the_overlapping_records(store, small):
+	log = history.VerificationHistory(store)
+	times = check_ins(4 * 9 + 1)
+	for value in times:
+		log.append(value)
+
+	read = []
+	get = store.get
+	store.get = lambda key, sealed=False: read.append(key) or get(key, sealed)
+	assert list(log.read(times[33], times[35])) == times[33:35]
+	# The head, the sealed chunk holding the range and nothing from the rolled levels
+	assert read == [history.HEAD_KEY, history.chunk_key(8, history.to_epoch(times[35]))]
+
+	read.clear()
+	assert list(log.read(times[5], times[7])) == times[5:7]
+	assert history.chunk_key(1, history.to_epoch(times[7])) in read
+	assert not any(key.startswith('chunks/') and key != history.chunk_key(1, history.to_epoch(times[7])) for key in read)
+
+def test_summary_counts_each_bucket(store):
+	log = history.VerificationHistory(store)
+	for value in check_ins(20):
+		log.append(value)
+	# Check-ins every 7 minutes from 08:00, counted in half-hour buckets
+	summary = log.summary(START, START + datetime.timedelta(hours=3), 1800)
+	assert [count for bucket, count in summary] == [5, 4, 4, 5, 2, 0]
+	assert summary[1][0] == START + datetime.timedelta(minutes=30)
+
+def test_rolling_with_the_default_sizes(store):
+	log = history.VerificationHistory(store)
+	times = check_ins(history.CHUNK_SIZE * history.INDEX_SIZE + 1)
+	for value in times:
+		log.append(value)
+	stored = head(store)
+	assert stored['sealed'] == []
+	assert len(stored['indexes']) == 1 and len(stored['indexes'][0]) == 1
+	assert len(keys(store, 'indexes/1/')) == 1
+	assert log.recent(2) == times[:-3:-1]
+	assert list(log.read(times[0], times[2])) == times[:2]
+
+def test_append_retries_after_losing_the_race(store):
+	log = history.VerificationHistory(store)
+	log.append(START)
+	replace = store.replace
+	# Another check-in replaces the head between this append's read and its write
+	def racing_replace(key, expected, value):
+		store.replace = replace
+		replace(key, expected, json.dumps({**json.loads(expected), 'count': 2, 'open': history.encode_chunk([history.to_epoch(START), history.to_epoch(START) + 60])}))
+		return replace(key, expected, value)
+	store.replace = racing_replace
+
+	assert log.append(START + datetime.timedelta(minutes=5))
+	assert log.count() == 3
+	assert len(list(log.read())) == 3
+
+def test_append_gives_up_after_repeated_conflicts(store):
+	log = history.VerificationHistory(store)
+	store.replace = lambda key, expected, value: False
+	with pytest.raises(history.HistoryConflictError):
+		log.append(START)
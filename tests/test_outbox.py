@@ -0,0 +1,127 @@
+"""
+tests/test_outbox.py
+
+Tests of the notification outbox: idempotency keys, deduplication, backoff and keeping the entries
+of each FIFO message group in order when one of them fails, using the InMemoryOutbox on a manual
+clock.
+"""
+
+import pytest
+
+from lifecheck import outbox
+
+LAST_VERIFICATION = '2024-01-01T08:00:00'
+
+class Clock:
+
+	def __init__(self):
+		self.now = 0.0
+
+	def __call__(self):
+		return self.now
+
+def entry(subject_id, contact, previous_notification=None):
+	return {
+		"key": outbox.idempotency_key(subject_id, contact, LAST_VERIFICATION, previous_notification),
+		"subject_id": subject_id,
+		"contact": contact
+	}
+
+# Function to return a deliver function that records the entries it is given and fails for the given keys
+def deliverer(delivered, failing=()):
+	def deliver(item):
+		delivered.append(item['key'])
+		if item['key'] in failing:
+			raise RuntimeError("SES is unavailable")
+	return deliver
+
+@pytest.fixture
+def clock():
+	return Clock()
+
+def test_idempotency_key_is_stable():
+	assert outbox.idempotency_key('jane', 'primary_contact', LAST_VERIFICATION, None) == outbox.idempotency_key('jane', 'primary_contact', LAST_VERIFICATION, None)
+
+@pytest.mark.parametrize('changed', [
+	('john', 'primary_contact', LAST_VERIFICATION, None),
+	('jane', 'secondary_contact', LAST_VERIFICATION, None),
+	('jane', 'primary_contact', '2024-01-02T08:00:00', None),
+	('jane', 'primary_contact', LAST_VERIFICATION, '2024-01-02T14:00:00')
+])
+def test_idempotency_key_changes_with_each_notification(changed):
+	assert outbox.idempotency_key(*changed) != outbox.idempotency_key('jane', 'primary_contact', LAST_VERIFICATION, None)
+
+def test_message_group():
+	assert outbox.message_group(entry('jane', 'primary_contact')) == 'jane'
+	assert outbox.message_group(entry(None, 'primary_contact')) == outbox.SINGLE_SUBJECT_GROUP
+
+def test_backoff_doubles_up_to_the_cap():
+	longest = lambda low, high: high
+	assert [outbox.backoff_seconds(attempt, uniform=longest) for attempt in (1, 2, 3, 4)] == [1, 2, 4, 8]
+	assert outbox.backoff_seconds(20, uniform=longest) == outbox.BACKOFF_CAP_SECONDS
+	assert outbox.backoff_seconds(3, uniform=lambda low, high: low) == 2
+
+def test_duplicate_entries_are_queued_once(clock):
+	queue = outbox.InMemoryOutbox(clock)
+	queue.put([entry('jane', 'primary_contact')])
+	queue.put([entry('jane', 'primary_contact')])
+	assert len(queue.receive()) == 1
+
+def test_deduplication_window(clock):
+	queue = outbox.InMemoryOutbox(clock)
+	item = entry('jane', 'primary_contact')
+	queue.put([item])
+	assert queue.drain(deliverer([])) == 1
+	clock.now = outbox.DEDUPLICATION_SECONDS - 1
+	queue.put([item])
+	assert queue.receive() == []
+	clock.now = outbox.DEDUPLICATION_SECONDS
+	queue.put([item])
+	assert len(queue.receive()) == 1
+
+def test_failed_entry_blocks_the_rest_of_its_group(clock):
+	queue = outbox.InMemoryOutbox(clock)
+	first, second, other = entry('jane', 'primary_contact'), entry('jane', 'secondary_contact'), entry('john', 'primary_contact')
+	queue.put([first, second, other])
+
+	delivered = []
+	assert queue.drain(deliverer(delivered, failing={first['key']})) == 1
+	# The second entry of the failed group is not attempted, while the other group is delivered
+	assert delivered == [first['key'], other['key']]
+	assert list(queue.entries) == [first['key'], second['key']]
+	# Both entries of the group are retried after the same delay, so they stay in order
+	assert queue.entries[first['key']]['visible_at'] == queue.entries[second['key']]['visible_at'] > clock.now
+
+	assert queue.drain(deliverer(delivered)) == 0
+	clock.now = queue.entries[first['key']]['visible_at']
+	delivered.clear()
+	assert queue.drain(deliverer(delivered)) == 2
+	assert delivered == [first['key'], second['key']]
+	assert queue.entries == {}
+
+def test_process_returns_the_failed_and_blocked_entries(clock):
+	queue = outbox.InMemoryOutbox(clock)
+	items = [entry('jane', 'primary_contact'), entry('john', 'primary_contact'), entry('jane', 'secondary_contact')]
+	queue.put(items)
+	received = queue.receive()
+	failed = outbox.process(queue, received, deliverer([], failing={items[0]['key']}))
+	assert failed == [items[0]['key'], items[2]['key']]
+
+def test_entry_is_returned_to_the_queue_if_its_retry_cannot_be_scheduled(clock):
+	class FailingRetry(outbox.InMemoryOutbox):
+		def retry(self, receipt_handle, delay_seconds):
+			raise RuntimeError("ChangeMessageVisibility failed")
+
+	queue = FailingRetry(clock)
+	item = entry('jane', 'primary_contact')
+	queue.put([item])
+	assert outbox.process(queue, queue.receive(), deliverer([], failing={item['key']})) == [item['key']]
+
+def test_attempts_are_counted(clock):
+	queue = outbox.InMemoryOutbox(clock)
+	item = entry(None, 'primary_contact')
+	queue.put([item])
+	for attempt in (1, 2, 3):
+		clock.now += outbox.BACKOFF_CAP_SECONDS
+		assert queue.receive() == [(item['key'], item, attempt)]
+		queue.retry(item['key'], 1)
@@ -0,0 +1,80 @@
+"""
+tests/test_tokens.py
+
+Tests of the signed verification and check-in tokens: the key ID, expiry and purpose checks, and
+key rotation.
+"""
+
+import json
+import datetime
+
+import pytest
+
+from lifecheck import tokens
+
+NOW = datetime.datetime(2024, 1, 1, 8, 0, 0)
+EXPIRES_AT = NOW + datetime.timedelta(hours=tokens.TOKEN_VALID_HOURS)
+
+# Function to return a token with its payload replaced (keeping the original signature)
+def with_payload(token, claims):
+	return f"{tokens._encode(json.dumps(claims).encode())}.{token.partition('.')[2]}"
+
+def test_mint_and_validate():
+	keyring = tokens.rotated_keyring()
+	assert tokens.validate(keyring, tokens.mint(keyring, 'jane', EXPIRES_AT), NOW) == 'jane'
+	assert tokens.validate(keyring, tokens.mint(keyring, None, EXPIRES_AT), NOW) is None
+
+def test_key_id_is_the_active_key():
+	keyring = tokens.rotated_keyring()
+	assert tokens.key_id(tokens.mint(keyring, 'jane', EXPIRES_AT)) == keyring['active']
+
+def test_token_expires_at_its_expiry_time():
+	keyring = tokens.rotated_keyring()
+	token = tokens.mint(keyring, 'jane', EXPIRES_AT)
+	assert tokens.validate(keyring, token, EXPIRES_AT - datetime.timedelta(seconds=1)) == 'jane'
+	with pytest.raises(tokens.ExpiredTokenError):
+		tokens.validate(keyring, token, EXPIRES_AT)
+
+def test_purpose_must_match():
+	keyring = tokens.rotated_keyring()
+	link = tokens.mint(keyring, 'jane', EXPIRES_AT)
+	check_in = tokens.mint(keyring, 'jane', EXPIRES_AT, purpose=tokens.CHECK_IN_PURPOSE)
+	assert tokens.validate(keyring, check_in, NOW, purpose=tokens.CHECK_IN_PURPOSE) == 'jane'
+	with pytest.raises(tokens.InvalidTokenError):
+		tokens.validate(keyring, link, NOW, purpose=tokens.CHECK_IN_PURPOSE)
+	with pytest.raises(tokens.InvalidTokenError):
+		tokens.validate(keyring, check_in, NOW)
+
+def test_changed_claims_are_rejected():
+	keyring = tokens.rotated_keyring()
+	token = tokens.mint(keyring, 'jane', EXPIRES_AT)
+	claims = json.loads(tokens._decode(token.partition('.')[0]))
+	for changes in ({'sub': 'john'}, {'exp': claims['exp'] + 3600}, {'use': tokens.CHECK_IN_PURPOSE}):
+		with pytest.raises(tokens.InvalidTokenError, match="Invalid signature"):
+			tokens.validate(keyring, with_payload(token, {**claims, **changes}), NOW, purpose=changes.get('use'))
+
+def test_token_signed_with_another_keyring_is_rejected():
+	keyring = tokens.rotated_keyring()
+	other = tokens.rotated_keyring()
+	# The same key ID with a different secret
+	impostor = {"active": keyring['active'], "keys": {keyring['active']: other['keys'][other['active']]}}
+	with pytest.raises(tokens.InvalidTokenError, match="Invalid signature"):
+		tokens.validate(keyring, tokens.mint(impostor, 'jane', EXPIRES_AT), NOW)
+
+def test_previous_key_is_accepted_until_the_second_rotation():
+	keyring = tokens.rotated_keyring()
+	token = tokens.mint(keyring, 'jane', EXPIRES_AT)
+	rotated = tokens.rotated_keyring(keyring)
+	assert rotated['active'] != keyring['active']
+	assert tokens.validate(rotated, token, NOW) == 'jane'
+	with pytest.raises(tokens.InvalidTokenError, match="Unknown signing key"):
+		tokens.validate(tokens.rotated_keyring(rotated), token, NOW)
+
+@pytest.mark.parametrize('token', ['', 'not-a-token', '!!!.!!!', f"{tokens._encode(b'[1, 2]')}.c2ln"])
+def test_malformed_tokens_are_rejected(token):
+	with pytest.raises(tokens.InvalidTokenError):
+		tokens.validate(tokens.rotated_keyring(), token, NOW)
+
+def test_key_id_of_a_malformed_token():
+	with pytest.raises(tokens.InvalidTokenError, match="Malformed token"):
+		tokens.key_id('not-a-token')